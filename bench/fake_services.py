@@ -0,0 +1,245 @@
+"""ベンチマーク用に LINE と Google (OAuth / Docs / Drive) の API を 1 つのポートで真似るサーバー。
+
+遅延・エラー (5xx)・クォータ超過 (429) を確率で注入できる。受け付けた件数は GET /_stats で取得する。
+
+    python bench/fake_services.py --port 9100 --latency-ms 50 --quota-rate 0.02
+"""
+import os
+import re
+import json
+import uuid
+import random
+import asyncio
+import argparse
+import hashlib
+from collections import Counter
+
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse
+
+# 注入する遅延 (ミリ秒) と、429 / 503 を返す確率。起動時の引数 (または環境変数) で設定する
+FAKE_LATENCY_MS = float(os.environ.get('FAKE_LATENCY_MS', 0))
+FAKE_JITTER_MS = float(os.environ.get('FAKE_JITTER_MS', 0))
+FAKE_ERROR_RATE = float(os.environ.get('FAKE_ERROR_RATE', 0))
+FAKE_QUOTA_RATE = float(os.environ.get('FAKE_QUOTA_RATE', 0))
+# メッセージコンテンツ (画像・動画) のバイト数
+FAKE_CONTENT_SIZE = int(os.environ.get('FAKE_CONTENT_SIZE', 256 * 1024))
+# 有効にすると、すべてのメッセージで同じ内容のコンテンツを返す (重複排除の確認用)
+FAKE_SAME_CONTENT = os.environ.get('FAKE_SAME_CONTENT', 'false').lower() in ('1', 'true', 'yes')
+# 画像メッセージで返す本物の JPEG の大きさ (例: 3000x2000)。未設定ならランダムなバイト列を返す (Pillow が必要)
+FAKE_IMAGE_DIMENSIONS = os.environ.get('FAKE_IMAGE_DIMENSIONS', '')
+
+app = FastAPI()
+stats = Counter()
+# upload_id -> 受け取ったバイト数
+uploads = {}
+_jpeg_cache = {}
+
+
+def _fake_jpeg(dimensions: str, message_id: str) -> bytes:
+    # 生成は重いので 1 枚だけ作り、メッセージごとに COM セグメントを差し込んで内容 (ハッシュ) を変える
+    if dimensions not in _jpeg_cache:
+        import io
+        from PIL import Image
+
+        width, height = (int(v) for v in dimensions.lower().split('x'))
+        image = Image.effect_noise((width, height), 64).convert('RGB')
+        out = io.BytesIO()
+        image.save(out, 'JPEG', quality=92)
+        _jpeg_cache[dimensions] = out.getvalue()
+    base = _jpeg_cache[dimensions]
+    comment = (b'same' if FAKE_SAME_CONTENT else message_id.encode())[:60000]
+    return base[:2] + b'\xff\xfe' + (len(comment) + 2).to_bytes(2, 'big') + comment + base[2:]
+
+
+def _endpoint(request: Request) -> str:
+    path = request.url.path
+    if path == '/token':
+        return 'oauth.token'
+    if path == '/v2/bot/message/reply':
+        return 'line.reply'
+    if path.startswith('/v2/bot/message/') and path.endswith('/content'):
+        return 'line.content'
+    if path.endswith(':batchUpdate'):
+        return 'docs.batchUpdate'
+    if path.startswith('/v1/documents/'):
+        return 'docs.get'
+    if path.startswith('/upload/drive/'):
+        return 'drive.upload'
+    if path.endswith('/permissions'):
+        return 'drive.permissions'
+    if path.startswith('/batch'):
+        return 'drive.batch'
+    return 'other'
+
+
+@app.middleware('http')
+async def inject_faults(request: Request, call_next):
+    endpoint = _endpoint(request)
+    if endpoint == 'other' or endpoint == 'oauth.token':
+        return await call_next(request)
+    stats[f'{endpoint}.requests'] += 1
+    latency = FAKE_LATENCY_MS + random.uniform(0, FAKE_JITTER_MS)
+    if latency > 0:
+        await asyncio.sleep(latency / 1000.0)
+    roll = random.random()
+    if roll < FAKE_QUOTA_RATE:
+        stats[f'{endpoint}.429'] += 1
+        return JSONResponse(
+            {'error': {'code': 429, 'message': 'Quota exceeded (fake).', 'status': 'RESOURCE_EXHAUSTED'}},
+            status_code=429,
+            headers={'Retry-After': '1'},
+        )
+    if roll < FAKE_QUOTA_RATE + FAKE_ERROR_RATE:
+        stats[f'{endpoint}.503'] += 1
+        return JSONResponse({'error': {'code': 503, 'message': 'Backend error (fake).'}}, status_code=503)
+    return await call_next(request)
+
+
+@app.get('/_stats')
+async def get_stats():
+    return dict(stats)
+
+
+@app.post('/_reset')
+async def reset_stats():
+    stats.clear()
+    uploads.clear()
+    return {}
+
+
+# --- Google OAuth ---
+
+@app.post('/token')
+async def token():
+    stats['oauth.token.requests'] += 1
+    return {'access_token': uuid.uuid4().hex, 'expires_in': 3600, 'token_type': 'Bearer'}
+
+
+# --- LINE Messaging API ---
+
+@app.post('/v2/bot/message/reply')
+async def line_reply(request: Request):
+    await request.body()
+    return {'sentMessages': [{'id': uuid.uuid4().hex, 'quoteToken': 'q'}]}
+
+
+@app.get('/v2/bot/message/{message_id}/content')
+async def line_content(message_id: str):
+    if FAKE_IMAGE_DIMENSIONS and not message_id.startswith('vid'):
+        body = _fake_jpeg(FAKE_IMAGE_DIMENSIONS, message_id)
+        stats['line.content.bytes'] += len(body)
+        return Response(content=body, media_type='image/jpeg')
+    seed = b'same' if FAKE_SAME_CONTENT else message_id.encode()
+    block = hashlib.sha256(seed).digest() * 2048  # 64 KiB
+    body = (block * (FAKE_CONTENT_SIZE // len(block) + 1))[:FAKE_CONTENT_SIZE]
+    media_type = 'video/mp4' if message_id.startswith('vid') else 'image/jpeg'
+    stats['line.content.bytes'] += len(body)
+    return Response(content=body, media_type=media_type)
+
+
+# --- Google Docs API ---
+
+@app.get('/v1/documents/{document_id}')
+async def docs_get(document_id: str):
+    return {'documentId': document_id, 'body': {'content': [{'endIndex': 1}]}}
+
+
+@app.post('/v1/documents/{document_id}:batchUpdate')
+async def docs_batch_update(document_id: str, request: Request):
+    body = await request.json()
+    stats['docs.batchUpdate.ops'] += len(body.get('requests', []))
+    return {'documentId': document_id, 'replies': [{} for _ in body.get('requests', [])]}
+
+
+# --- Google Drive API ---
+
+def _file_resource(file_id: str) -> dict:
+    return {
+        'id': file_id,
+        'webContentLink': f'https://drive.google.com/uc?id={file_id}&export=download',
+        'webViewLink': f'https://drive.google.com/file/d/{file_id}/view',
+    }
+
+
+@app.post('/upload/drive/v3/files')
+async def drive_upload_start(request: Request):
+    await request.body()
+    if request.query_params.get('uploadType') != 'resumable':
+        return _file_resource(uuid.uuid4().hex)
+    upload_id = uuid.uuid4().hex
+    uploads[upload_id] = 0
+    location = f"{request.base_url}upload/drive/v3/files?uploadType=resumable&upload_id={upload_id}"
+    return Response(status_code=200, headers={'Location': location})
+
+
+@app.put('/upload/drive/v3/files')
+async def drive_upload_chunk(request: Request):
+    upload_id = request.query_params.get('upload_id')
+    if upload_id not in uploads:
+        return JSONResponse({'error': {'code': 404, 'message': 'Unknown upload.'}}, status_code=404)
+    body = await request.body()
+    match = re.match(r'bytes (?:(\d+)-(\d+)|\*)/(\d+|\*)', request.headers.get('Content-Range', ''))
+    if not match:
+        return JSONResponse({'error': {'code': 400, 'message': 'Bad Content-Range.'}}, status_code=400)
+    uploads[upload_id] += len(body)
+    stats['drive.upload.bytes'] += len(body)
+    total = match.group(3)
+    if total != '*' and uploads[upload_id] >= int(total):
+        del uploads[upload_id]
+        return _file_resource(uuid.uuid4().hex)
+    # まだ何も受け取っていなければ Range を返さない (状態の問い合わせに対する Drive と同じ応答)
+    headers = {'Range': f'bytes=0-{uploads[upload_id] - 1}'} if uploads[upload_id] else {}
+    return Response(status_code=308, headers=headers)
+
+
+@app.post('/drive/v3/files/{file_id}/permissions')
+async def drive_permissions(file_id: str):
+    return {'id': 'anyoneWithLink'}
+
+
+@app.post('/batch/drive/v3')
+async def drive_batch(request: Request):
+    body = (await request.body()).decode('utf-8', errors='replace')
+    content_ids = re.findall(r'Content-ID: <([^>]+)>', body, flags=re.IGNORECASE)
+    stats['drive.batch.parts'] += len(content_ids)
+    boundary = f'batch_{uuid.uuid4().hex}'
+    parts = []
+    for content_id in content_ids:
+        parts.append(
+            f'--{boundary}\r\nContent-Type: application/http\r\nContent-ID: <response-{content_id}>\r\n\r\n'
+            f'HTTP/1.1 200 OK\r\nContent-Type: application/json; charset=UTF-8\r\n\r\n'
+            f'{json.dumps({"id": "anyoneWithLink"})}\r\n'
+        )
+    payload = ''.join(parts) + f'--{boundary}--\r\n'
+    return Response(content=payload, media_type=f'multipart/mixed; boundary={boundary}')
+
+
+def main():
+    global FAKE_LATENCY_MS, FAKE_JITTER_MS, FAKE_ERROR_RATE, FAKE_QUOTA_RATE, FAKE_CONTENT_SIZE, FAKE_SAME_CONTENT, FAKE_IMAGE_DIMENSIONS
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9100)
+    parser.add_argument('--latency-ms', type=float, default=FAKE_LATENCY_MS)
+    parser.add_argument('--jitter-ms', type=float, default=FAKE_JITTER_MS)
+    parser.add_argument('--error-rate', type=float, default=FAKE_ERROR_RATE, help='503 を返す確率')
+    parser.add_argument('--quota-rate', type=float, default=FAKE_QUOTA_RATE, help='429 を返す確率')
+    parser.add_argument('--content-size', type=int, default=FAKE_CONTENT_SIZE)
+    parser.add_argument('--same-content', action='store_true', default=FAKE_SAME_CONTENT)
+    parser.add_argument('--image-dimensions', default=FAKE_IMAGE_DIMENSIONS, help='画像を本物の JPEG で返す (例: 3000x2000)')
+    parser.add_argument('--keep-alive', type=int, default=120, help='keep-alive 接続を保つ秒数')
+    args = parser.parse_args()
+
+    FAKE_LATENCY_MS, FAKE_JITTER_MS = args.latency_ms, args.jitter_ms
+    FAKE_ERROR_RATE, FAKE_QUOTA_RATE = args.error_rate, args.quota_rate
+    FAKE_CONTENT_SIZE, FAKE_SAME_CONTENT = args.content_size, args.same_content
+    FAKE_IMAGE_DIMENSIONS = args.image_dimensions
+    # Google のフロントエンドと同様に keep-alive を長めに保つ (uvicorn の既定の 5 秒だと、
+    # レート制限で待っている間にプール済みの接続が切られて Broken pipe になる)
+    uvicorn.run(app, host=args.host, port=args.port, log_level='warning', timeout_keep_alive=args.keep_alive)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,315 @@
+"""/callback のスループットとレイテンシを、偽の LINE / Google API サーバーを相手に計測する。
+
+偽サーバー (bench/fake_services.py) とアプリ (uvicorn main:app) を別プロセスで起動し、
+署名済みの Webhook を指定したレートで送って p50/p95/p99・スループット・ピーク RSS を出力する。
+
+    python bench/run_benchmark.py --requests 500 --rate 50 --mix text=70,image=20,video=10
+    python bench/run_benchmark.py --batch-size 5 --app-env WEBHOOK_QUEUE_ENABLED=true --latency-ms 80
+
+アプリの設定は --app-env KEY=VALUE で渡す (複数可)。結果は --output に JSON でも保存できる。
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import base64
+import hashlib
+import hmac
+import random
+import signal
+import socket
+import asyncio
+import argparse
+import tempfile
+import subprocess
+
+import httpx
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CHANNEL_SECRET = 'bench-channel-secret'
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _service_account_json(token_uri: str) -> str:
+    # 偽の OAuth サーバーに JWT を送るだけなので、その場で作った鍵でよい
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    pem = key.private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+    ).decode()
+    return json.dumps({
+        'type': 'service_account',
+        'project_id': 'bench',
+        'private_key_id': 'bench',
+        'private_key': pem,
+        'client_email': 'bench@bench.iam.gserviceaccount.com',
+        'client_id': '0',
+        'token_uri': token_uri,
+    })
+
+
+def _sign(body: bytes) -> str:
+    return base64.b64encode(hmac.new(CHANNEL_SECRET.encode(), body, hashlib.sha256).digest()).decode()
+
+
+def _message_event(kind: str, user_id: str, text: str | None = None) -> dict:
+    message_id = f"{kind[:3]}{uuid.uuid4().hex[:12]}"
+    message = {'id': message_id, 'type': kind, 'quoteToken': 'q'}
+    if kind == 'text':
+        message['text'] = text or f"bench note {message_id}"
+    else:
+        message['contentProvider'] = {'type': 'line'}
+        if kind == 'video':
+            message['duration'] = 1000
+    return {
+        'type': 'message',
+        'mode': 'active',
+        'timestamp': int(time.time() * 1000),
+        'webhookEventId': uuid.uuid4().hex,
+        'deliveryContext': {'isRedelivery': False},
+        'source': {'type': 'user', 'userId': user_id},
+        'replyToken': uuid.uuid4().hex,
+        'message': message,
+    }
+
+
+def _webhook_body(events: list) -> bytes:
+    return json.dumps({'destination': 'Ubench', 'events': events}).encode()
+
+
+def _parse_mix(mix: str) -> tuple:
+    kinds, weights = [], []
+    for part in mix.split(','):
+        kind, _, weight = part.partition('=')
+        kinds.append(kind.strip())
+        weights.append(float(weight or 1))
+    return kinds, weights
+
+
+def _rss_kb(pid: int, field: str = 'VmRSS') -> int:
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def _percentile(values: list, pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def _wait_until_up(url: str, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(url, timeout=1).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.1)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+async def _drive_load(app_url: str, args, users: list) -> dict:
+    kinds, weights = _parse_mix(args.mix)
+    latencies, statuses = [], {}
+    interval = 1.0 / args.rate if args.rate > 0 else 0
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async with httpx.AsyncClient(timeout=args.timeout, limits=httpx.Limits(max_connections=args.concurrency)) as client:
+        async def send(body: bytes):
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    response = await client.post(f'{app_url}/callback', content=body, headers={
+                        'X-Line-Signature': _sign(body), 'Content-Type': 'application/json',
+                    })
+                    status = str(response.status_code)
+                except httpx.HTTPError as e:
+                    status = type(e).__name__
+                latencies.append(time.perf_counter() - start)
+                statuses[status] = statuses.get(status, 0) + 1
+
+        # 開ループ: 応答を待たずに一定間隔で送る (応答が遅れてもレートを落とさない)
+        tasks = []
+        started = time.perf_counter()
+        for i in range(args.requests):
+            events = [_message_event(random.choices(kinds, weights)[0], random.choice(users)) for _ in range(args.batch_size)]
+            tasks.append(asyncio.create_task(send(_webhook_body(events))))
+            if interval:
+                await asyncio.sleep(max(0.0, started + (i + 1) * interval - time.perf_counter()))
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - started
+
+    return {'latencies': latencies, 'statuses': statuses, 'elapsed': elapsed}
+
+
+def _wait_for_replies(fake_url: str, expected: int, timeout: float) -> float | None:
+    # キューモードでは 200 を返した後に処理されるので、返信が全部届くまでを処理完了とみなす
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        replies = httpx.get(f'{fake_url}/_stats').json().get('line.reply.requests', 0)
+        if replies >= expected:
+            return time.monotonic()
+        time.sleep(0.05)
+    return None
+
+
+def run(args) -> dict:
+    fake_port, app_port = _free_port(), _free_port()
+    fake_url, app_url = f'http://127.0.0.1:{fake_port}', f'http://127.0.0.1:{app_port}'
+    workdir = tempfile.mkdtemp(prefix='linebot-bench-')
+    procs = []
+    try:
+        fake_cmd = [
+            sys.executable, os.path.join(REPO_ROOT, 'bench', 'fake_services.py'), '--port', str(fake_port),
+            '--latency-ms', str(args.latency_ms), '--jitter-ms', str(args.jitter_ms),
+            '--error-rate', str(args.error_rate), '--quota-rate', str(args.quota_rate),
+            '--content-size', str(args.content_size),
+        ]
+        if args.image_dimensions:
+            fake_cmd += ['--image-dimensions', args.image_dimensions]
+        procs.append(subprocess.Popen(fake_cmd))
+        _wait_until_up(f'{fake_url}/_stats')
+
+        env = dict(os.environ)
+        env.update({
+            'LINE_CHANNEL_SECRET': CHANNEL_SECRET,
+            'LINE_CHANNEL_ACCESS_TOKEN': 'bench-access-token',
+            'LINE_API_BASE_URL': fake_url,
+            'LINE_DATA_API_BASE_URL': fake_url,
+            'GOOGLE_DOCS_API_BASE_URL': fake_url,
+            'GOOGLE_DRIVE_API_BASE_URL': fake_url,
+            'CREDENTIALS_JSON': _service_account_json(f'{fake_url}/token'),
+            'DATABASE_URL': f"sqlite:///{os.path.join(workdir, 'bench.db')}",
+            'LOG_LEVEL': 'WARNING',
+        })
+        for item in args.app_env:
+            key, _, value = item.partition('=')
+            env[key] = value
+        app_cmd = [sys.executable, '-m', 'uvicorn', 'main:app', '--host', '127.0.0.1', '--port', str(app_port),
+                   '--log-level', 'warning', '--no-access-log']
+        app_proc = subprocess.Popen(app_cmd, cwd=REPO_ROOT, env=env)
+        procs.append(app_proc)
+        _wait_until_up(f'{app_url}/')
+
+        # 各ユーザーにドキュメントを設定してから計測を始める
+        users = [f'Ubench{i:04d}' for i in range(args.users)]
+        for i, user_id in enumerate(users):
+            # 同じドキュメントを共有するユーザーはドキュメントごとの書き込みレートを取り合う
+            doc_id = f'benchdoc{i % (args.docs or args.users):032d}'
+            body = _webhook_body([_message_event('text', user_id, text=f'!setdoc {doc_id}')])
+            httpx.post(f'{app_url}/callback', content=body, headers={'X-Line-Signature': _sign(body)}, timeout=30)
+        setup_replies = httpx.get(f'{fake_url}/_stats').json().get('line.reply.requests', 0)
+        httpx.post(f'{fake_url}/_reset')
+
+        peak_rss = [_rss_kb(app_proc.pid)]
+        stop_sampling = False
+
+        async def sample_rss():
+            while not stop_sampling:
+                peak_rss.append(_rss_kb(app_proc.pid))
+                await asyncio.sleep(0.1)
+
+        async def main():
+            nonlocal stop_sampling
+            sampler = asyncio.create_task(sample_rss())
+            try:
+                return await _drive_load(app_url, args, users)
+            finally:
+                stop_sampling = True
+                await sampler
+
+        load_started = time.monotonic()
+        result = asyncio.run(main())
+        expected_replies = args.requests * args.batch_size
+        done_at = _wait_for_replies(fake_url, expected_replies, args.drain_timeout)
+        peak_rss.append(_rss_kb(app_proc.pid))
+
+        latencies = result['latencies']
+        events_done = expected_replies if done_at else httpx.get(f'{fake_url}/_stats').json().get('line.reply.requests', 0)
+        e2e_elapsed = (done_at or time.monotonic()) - load_started
+        return {
+            'config': {k: v for k, v in vars(args).items() if k != 'output'},
+            'setup_replies': setup_replies,
+            'requests': len(latencies),
+            'statuses': result['statuses'],
+            'latency_ms': {
+                'p50': _percentile(latencies, 50) * 1000,
+                'p95': _percentile(latencies, 95) * 1000,
+                'p99': _percentile(latencies, 99) * 1000,
+                'max': max(latencies) * 1000 if latencies else 0,
+            },
+            'request_throughput_rps': len(latencies) / result['elapsed'] if result['elapsed'] else 0,
+            'events_completed': events_done,
+            'event_throughput_eps': events_done / e2e_elapsed if e2e_elapsed else 0,
+            'all_events_completed': done_at is not None,
+            'peak_rss_mb': max(max(peak_rss), _rss_kb(app_proc.pid, 'VmHWM')) / 1024,
+            'fake_api_stats': httpx.get(f'{fake_url}/_stats').json(),
+        }
+    finally:
+        for proc in reversed(procs):
+            proc.send_signal(signal.SIGTERM)
+        for proc in reversed(procs):
+            try:
+                proc.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
+
+def _print_report(report: dict):
+    lat = report['latency_ms']
+    print(f"requests          : {report['requests']} {report['statuses']}")
+    print(f"latency (ms)      : p50={lat['p50']:.1f} p95={lat['p95']:.1f} p99={lat['p99']:.1f} max={lat['max']:.1f}")
+    print(f"request throughput: {report['request_throughput_rps']:.1f} req/s")
+    print(f"event throughput  : {report['event_throughput_eps']:.1f} events/s "
+          f"({report['events_completed']} completed{'' if report['all_events_completed'] else ', TIMED OUT'})")
+    print(f"peak RSS          : {report['peak_rss_mb']:.1f} MiB")
+    print(f"fake API calls    : {json.dumps(report['fake_api_stats'], sort_keys=True)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=200, help='送信する Webhook リクエスト数')
+    parser.add_argument('--rate', type=float, default=20, help='1 秒あたりの送信数 (0 ならできるだけ速く)')
+    parser.add_argument('--concurrency', type=int, default=100, help='同時に送信中にするリクエスト数の上限')
+    parser.add_argument('--batch-size', type=int, default=1, help='1 リクエストに含めるイベント数')
+    parser.add_argument('--mix', default='text=1', help='イベントの種類と比率 (例: text=70,image=20,video=10)')
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--docs', type=int, default=0, help='ユーザーに割り当てるドキュメント数 (0 ならユーザーごとに別)')
+    parser.add_argument('--timeout', type=float, default=60, help='1 リクエストのタイムアウト秒数')
+    parser.add_argument('--drain-timeout', type=float, default=120, help='全イベントの返信を待つ最大秒数')
+    parser.add_argument('--latency-ms', type=float, default=0, help='偽 API の応答遅延')
+    parser.add_argument('--jitter-ms', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0, help='偽 API が 503 を返す確率')
+    parser.add_argument('--quota-rate', type=float, default=0, help='偽 API が 429 を返す確率')
+    parser.add_argument('--content-size', type=int, default=256 * 1024, help='画像・動画コンテンツのバイト数')
+    parser.add_argument('--image-dimensions', help='画像を指定した大きさの本物の JPEG にする (例: 3000x2000、Pillow が必要)')
+    parser.add_argument('--app-env', action='append', default=[], metavar='KEY=VALUE', help='アプリに渡す環境変数')
+    parser.add_argument('--output', help='結果を JSON で保存するパス')
+    args = parser.parse_args()
+
+    report = run(args)
+    _print_report(report)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,14 +2,22 @@
 
 import os
 import sys
+import hashlib
 import logging
-from sqlalchemy import create_engine, Column, String
+import datetime
+import contextlib
+from sqlalchemy import create_engine, make_url, event, select, bindparam, text, Column, String, Integer, BigInteger, Boolean, Text, DateTime
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
 from sqlalchemy.exc import SQLAlchemyError
 
-# --- ロギング設定（デバッグ用） ---
-logging.basicConfig(level=logging.DEBUG)
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# ロギングの設定 (レベル・出力先) はアプリ側 (logging_util) で行う
 logger = logging.getLogger(__name__)
 
 # ------------------------------------------------------------
@@ -20,37 +28,87 @@ logger = logging.getLogger(__name__)
 #    - ローカル開発時は環境変数が未設定の可能性があるため、
 #      その場合は SQLite のファイルをフォールバックで利用する
 # ------------------------------------------------------------
+def _masked_url(url: str) -> str:
+    # ログに出すときはパスワードを伏せる
+    try:
+        return make_url(url).render_as_string(hide_password=True)
+    except Exception:
+        return "<unparseable URL>"
+
+
 raw_url = os.environ.get("DATABASE_URL")
 if raw_url:
     # Koyeb や一部プロバイダでは "postgres://" を渡してくる場合があるので置換
     if raw_url.startswith("postgres://"):
         corrected = raw_url.replace("postgres://", "postgresql://", 1)
-        logger.debug(f"`postgres://` を検知したため自動で `postgresql://` に置換しました: {corrected}")
+        logger.debug("`postgres://` を検知したため自動で `postgresql://` に置換しました: %s", _masked_url(corrected))
         DATABASE_URL = corrected
     else:
         DATABASE_URL = raw_url
-    logger.debug(f"使用する DATABASE_URL: {DATABASE_URL}")
+    logger.debug("使用する DATABASE_URL: %s", _masked_url(DATABASE_URL))
 else:
     # 環境変数が設定されていない場合はローカル開発用に SQLite を使用
     DATABASE_URL = "sqlite:///./app.db"
     logger.warning("DATABASE_URL が環境変数に設定されていません。ローカル開発用に SQLite を使用します。")
-    logger.debug(f"フォールバックの DATABASE_URL: {DATABASE_URL}")
+    logger.debug("フォールバックの DATABASE_URL: %s", DATABASE_URL)
 
 # ------------------------------------------------------------
 # 2. SQLAlchemy エンジンを作成
-#    - SQLite の場合は connect_args={"check_same_thread": False} を付与
+#    - PostgreSQL などはコネクションプールの大きさ・再接続の設定を環境変数から読む
+#    - SQLite の場合は connect_args={"check_same_thread": False} を付与し、WAL モードにする
+#    - インメモリの SQLite は 1 本の接続を全スレッドで共有する (接続ごとに別の DB になるため)
 # ------------------------------------------------------------
+# 常時保持する接続数と、混雑時に追加で開く接続数
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 10))
+# プールが空いていないときに待つ秒数
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 30))
+# この秒数より古い接続は使う前に張り直す (DB やプロキシ側のアイドル切断対策)。-1 で無効
+DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", 1800))
+# 接続を貸し出す前に生きているか確認する
+DB_POOL_PRE_PING = os.environ.get("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+# SQLite でロックの解放を待つ秒数
+SQLITE_BUSY_TIMEOUT = float(os.environ.get("SQLITE_BUSY_TIMEOUT", 5))
+
+IS_SQLITE = DATABASE_URL.startswith("sqlite")
+IS_SQLITE_MEMORY = IS_SQLITE and make_url(DATABASE_URL).database in (None, "", ":memory:")
+
 engine_kwargs = {}
-if DATABASE_URL.startswith("sqlite"):
+if IS_SQLITE:
     # SQLite はマルチスレッドで使うとエラーになる場合があるのでチェックをオフにする
-    engine_kwargs["connect_args"] = {"check_same_thread": False}
+    engine_kwargs["connect_args"] = {"check_same_thread": False, "timeout": SQLITE_BUSY_TIMEOUT}
+    if IS_SQLITE_MEMORY:
+        engine_kwargs["poolclass"] = StaticPool
+else:
+    engine_kwargs.update(
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=DB_POOL_PRE_PING,
+    )
 
 try:
     engine = create_engine(DATABASE_URL, echo=False, **engine_kwargs)
 except SQLAlchemyError as e:
-    logger.error(f"SQLAlchemy エンジンの作成に失敗しました。URL={DATABASE_URL} エラー: {e}")
+    logger.error("SQLAlchemy エンジンの作成に失敗しました。URL=%s エラー: %s", _masked_url(DATABASE_URL), e)
     sys.exit(1)
 
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL にすると読み込みが書き込みを待たなくなる。synchronous=NORMAL は WAL での推奨値
+    cursor = dbapi_connection.cursor()
+    try:
+        if not IS_SQLITE_MEMORY:
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute("PRAGMA synchronous=NORMAL")
+    finally:
+        cursor.close()
+
+
+if IS_SQLITE:
+    event.listen(engine, "connect", _set_sqlite_pragmas)
+
 # ------------------------------------------------------------
 # 3. ORM 用のベースクラスとセッション設定
 # ------------------------------------------------------------
@@ -71,15 +129,370 @@ class UserDocMapping(Base):
     def __repr__(self):
         return f"<UserDocMapping(user_id='{self.user_id}', doc_id='{self.doc_id}')>"
 
+# ------------------------------------------------------------
+# 4-2. テーブル定義（MediaBlob）
+#    - アップロード済みメディアの SHA-256 と Drive のファイル/リンクの対応
+#    - 同じ画像・動画が再度送られた場合はアップロードせずに既存のファイルを使う
+#    - 共有設定が済んだファイルだけを記録する (共有できなかったファイルを使い回さない)
+# ------------------------------------------------------------
+class MediaBlob(Base):
+    __tablename__ = 'media_blobs'
+
+    # コンテンツの SHA-256 (16進 64 文字) を主キーとして使用
+    sha256 = Column(String(64), primary_key=True)
+    file_id = Column(String, nullable=False)
+    file_name = Column(String, nullable=False)
+    mime_type = Column(String, nullable=False)
+    size = Column(BigInteger, nullable=False)
+    direct_link = Column(String)
+    webview_link = Column(String)
+    created_at = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+    def __repr__(self):
+        return f"<MediaBlob(sha256='{self.sha256[:12]}...', file_id='{self.file_id}')>"
+
+# ------------------------------------------------------------
+# 4-3. テーブル定義（DocWriteOutbox）
+#    - Google ドキュメントへの未反映の追記 (アウトボックス)
+#    - Webhook の処理では行を追加するだけにし、バックグラウンドで seq 順に反映する
+#    - 反映中の行は status='applying' にし、next_attempt_at をリースの期限に使う
+#    - 反映できたら行を削除する。再試行しても反映できないものは status='failed' で残す
+# ------------------------------------------------------------
+class DocWriteOutbox(Base):
+    __tablename__ = 'doc_write_outbox'
+
+    # 追加順の連番。同じドキュメントへの追記はこの順で反映する
+    seq = Column(Integer, primary_key=True, autoincrement=True)
+    doc_id = Column(String, nullable=False, index=True)
+    user_id = Column(String)
+    # text と image_uri のどちらか一方を保存
+    text = Column(Text)
+    image_uri = Column(Text)
+    status = Column(String(16), nullable=False, default='pending', index=True)
+    attempts = Column(Integer, nullable=False, default=0)
+    last_error = Column(Text)
+    next_attempt_at = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+    created_at = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+    def __repr__(self):
+        return f"<DocWriteOutbox(seq={self.seq}, doc_id='{self.doc_id}', status='{self.status}')>"
+
+# ------------------------------------------------------------
+# 4-4. 読み込み専用の軽量なクエリ
+#    - ORM のセッションやオブジェクトを作らず、Core の SELECT で 1 列だけ取得する
+#    - ステートメントは使い回し、コンパイル結果はエンジンのキャッシュに載る
+# ------------------------------------------------------------
+_DOC_ID_BY_USER = (
+    select(UserDocMapping.__table__.c.doc_id)
+    .where(UserDocMapping.__table__.c.user_id == bindparam("user_id"))
+)
+
+
+def fetch_doc_id(user_id: str) -> str | None:
+    """user_id に紐づく doc_id を取得する (見つからなければ None)。"""
+    with engine.connect() as conn:
+        return conn.execute(_DOC_ID_BY_USER, {"user_id": user_id}).scalar_one_or_none()
+
+
+# GoogleドキュメントIDの正規表現 (簡易的なチェック)。!setdoc と一括取り込み (mapping_cli) で同じ条件を使う
+DOC_ID_REGEX = r"^[a-zA-Z0-9_-]{20,}$" # 少なくとも20文字以上など、もう少し厳密に
+
+
+def _doc_mapping_upsert(dialect_name: str):
+    # 1 文で INSERT か UPDATE を行う。ON CONFLICT / ON DUPLICATE KEY がない方言では None
+    table = UserDocMapping.__table__
+    if dialect_name in ("postgresql", "sqlite"):
+        if dialect_name == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert
+        else:
+            from sqlalchemy.dialects.sqlite import insert
+        stmt = insert(table)
+        return stmt.on_conflict_do_update(index_elements=[table.c.user_id], set_={"doc_id": stmt.excluded.doc_id})
+    if dialect_name in ("mysql", "mariadb"):
+        from sqlalchemy.dialects.mysql import insert
+
+        stmt = insert(table)
+        return stmt.on_duplicate_key_update(doc_id=stmt.inserted.doc_id)
+    return None
+
+
+def upsert_doc_mappings(db, rows) -> int:
+    """(user_id, doc_id) の組をまとめて登録・更新する (コミットは呼び出し側で行う)。登録した件数を返す。
+
+    db は Session でも Connection でもよい。同じ user_id が複数あれば後のものを使う。
+    """
+    # 1 文の中で同じ行を 2 回更新できない方言があるので、先に重複を除いておく
+    latest = dict(rows)
+    if not latest:
+        return 0
+    params = [{"user_id": user_id, "doc_id": doc_id} for user_id, doc_id in latest.items()]
+    stmt = _doc_mapping_upsert(engine.dialect.name)
+    if stmt is not None:
+        db.execute(stmt, params)
+        return len(params)
+    # 対応していない方言では行ごとに UPDATE し、なければ INSERT する
+    table = UserDocMapping.__table__
+    for param in params:
+        updated = db.execute(
+            table.update().where(table.c.user_id == param["user_id"]).values(doc_id=param["doc_id"])
+        ).rowcount
+        if not updated:
+            db.execute(table.insert(), param)
+    return len(params)
+
+
+# ------------------------------------------------------------
+# 4-5. 非同期エンジン (任意)
+#    - DB_ASYNC_ENABLED=true のとき、asyncpg / aiosqlite でイベントループから直接クエリする
+#    - ドライバが入っていない場合は警告を出して無効にする (同期の読み込みにフォールバック)
+# ------------------------------------------------------------
+DB_ASYNC_ENABLED = os.environ.get("DB_ASYNC_ENABLED", "false").lower() in ("1", "true", "yes")
+
+_ASYNC_DRIVERS = {"postgresql": "postgresql+asyncpg", "sqlite": "sqlite+aiosqlite"}
+_async_engine = None
+# 作成に失敗したら再試行しない (毎回警告を出さないように)
+_async_engine_unavailable = False
+
+
+def _async_database_url(url: str) -> str | None:
+    parsed = make_url(url)
+    drivername = _ASYNC_DRIVERS.get(parsed.get_backend_name())
+    return parsed.set(drivername=drivername).render_as_string(hide_password=False) if drivername else None
+
+
+def get_async_engine():
+    """非同期エンジンを返す。無効な場合や作成できない場合は None。"""
+    global _async_engine, _async_engine_unavailable
+    if not DB_ASYNC_ENABLED or _async_engine_unavailable:
+        return None
+    if _async_engine is None:
+        async_url = _async_database_url(DATABASE_URL)
+        if async_url is None:
+            logger.warning("DB_ASYNC_ENABLED ですが、%s には非同期ドライバがありません。", make_url(DATABASE_URL).get_backend_name())
+            _async_engine_unavailable = True
+            return None
+        try:
+            from sqlalchemy.ext.asyncio import create_async_engine
+
+            kwargs = {} if IS_SQLITE else dict(
+                pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT,
+                pool_recycle=DB_POOL_RECYCLE, pool_pre_ping=DB_POOL_PRE_PING,
+            )
+            _async_engine = create_async_engine(async_url, **kwargs)
+        except (ImportError, SQLAlchemyError, ValueError) as e:
+            logger.warning("非同期エンジンを作成できませんでした (同期の読み込みを使います): %s", e)
+            _async_engine_unavailable = True
+            return None
+        if IS_SQLITE:
+            event.listen(_async_engine.sync_engine, "connect", _set_sqlite_pragmas)
+    return _async_engine
+
+
+async def fetch_doc_ids_async(user_ids) -> dict:
+    """複数の user_id の doc_id をまとめて取得する ({user_id: doc_id})。非同期エンジンがなければ空の dict。"""
+    async_engine = get_async_engine()
+    user_ids = list(user_ids)
+    if async_engine is None or not user_ids:
+        return {}
+    table = UserDocMapping.__table__
+    async with async_engine.connect() as conn:
+        result = await conn.execute(select(table.c.user_id, table.c.doc_id).where(table.c.user_id.in_(user_ids)))
+        return dict(result.all())
+
+
+async def dispose_async_engine():
+    global _async_engine
+    if _async_engine is not None:
+        await _async_engine.dispose()
+        _async_engine = None
+
+
+# ------------------------------------------------------------
+# 4-6. テーブル定義（SchemaState）
+#    - 作成済みのスキーマのフィンガープリント (DDL の SHA-256)
+#    - 一致していればワーカーの起動ごとに create_all (テーブルごとの存在確認) をしない
+# ------------------------------------------------------------
+class SchemaState(Base):
+    __tablename__ = 'schema_state'
+
+    fingerprint = Column(String(64), primary_key=True)
+    applied_at = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+    def __repr__(self):
+        return f"<SchemaState(fingerprint='{self.fingerprint[:12]}...')>"
+
+# ------------------------------------------------------------
+# 4-7. テーブル定義（ProcessedWebhookEvent）
+#    - 処理済み (処理中) の Webhook イベントの webhookEventId
+#    - LINE が再送したイベントを、別のワーカーが受け取った場合でも 2 回処理しないようにする
+#    - 処理中 (status='processing') の行は claimed_at からリースの期限が過ぎると、再送を受けたワーカーが引き継ぐ
+#    - 有効期限を過ぎた行は event_dedup が定期的に削除する
+# ------------------------------------------------------------
+class ProcessedWebhookEvent(Base):
+    __tablename__ = 'processed_webhook_events'
+
+    webhook_event_id = Column(String(64), primary_key=True)
+    is_redelivery = Column(Boolean, nullable=False, default=False)
+    # 'processing' (処理中) か 'done' (処理済み)
+    status = Column(String(16), nullable=False, default='processing')
+    claimed_at = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+    received_at = Column(DateTime, nullable=False, default=datetime.datetime.utcnow, index=True)
+
+    def __repr__(self):
+        return f"<ProcessedWebhookEvent(webhook_event_id='{self.webhook_event_id}')>"
+
+# ------------------------------------------------------------
+# 4-8. テーブル定義（NoteEntry）
+#    - ドキュメントに追記したテキスト・画像リンクの控え (検索用)
+#    - SQLite では FTS5 (trigram) の仮想テーブル notes_fts をトリガーで同期する
+#    - PostgreSQL では tsvector の生成列 search_vector に GIN インデックスを張る
+# ------------------------------------------------------------
+class NoteEntry(Base):
+    __tablename__ = 'notes'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    user_id = Column(String, nullable=False, index=True)
+    doc_id = Column(String, nullable=False)
+    # text と image_uri のどちらか一方を保存
+    text = Column(Text)
+    image_uri = Column(Text)
+    created_at = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+    def __repr__(self):
+        return f"<NoteEntry(id={self.id}, user_id='{self.user_id}')>"
+
+# ------------------------------------------------------------
+# 4-9. テーブル定義（DriveUploadSession）
+#    - 途中まで送った Drive の resumable upload のセッション URI と送信済みバイト数
+#    - ワーカーが途中で止まっても、同じメッセージを処理し直すときに続きから送る
+#    - アップロードが終わったら行を削除する
+# ------------------------------------------------------------
+class DriveUploadSession(Base):
+    __tablename__ = 'drive_upload_sessions'
+
+    # アップロード元の識別子 (例: "video:<メッセージ ID>")
+    source_key = Column(String, primary_key=True)
+    session_uri = Column(Text, nullable=False)
+    file_name = Column(String, nullable=False)
+    mime_type = Column(String, nullable=False)
+    total_size = Column(BigInteger)
+    committed_bytes = Column(BigInteger, nullable=False, default=0)
+    created_at = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+    updated_at = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+    def __repr__(self):
+        return f"<DriveUploadSession(source_key='{self.source_key}', committed_bytes={self.committed_bytes})>"
+
+
+_NOTES_FTS_DDL = {
+    "sqlite": [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts USING fts5("
+        "text, image_uri, content='notes', content_rowid='id', tokenize='trigram')",
+        "CREATE TRIGGER IF NOT EXISTS notes_fts_insert AFTER INSERT ON notes BEGIN "
+        "INSERT INTO notes_fts(rowid, text, image_uri) VALUES (new.id, new.text, new.image_uri); END",
+        "CREATE TRIGGER IF NOT EXISTS notes_fts_delete AFTER DELETE ON notes BEGIN "
+        "INSERT INTO notes_fts(notes_fts, rowid, text, image_uri) VALUES ('delete', old.id, old.text, old.image_uri); END",
+    ],
+    "postgresql": [
+        "ALTER TABLE notes ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS "
+        "(to_tsvector('simple', coalesce(text, '') || ' ' || coalesce(image_uri, ''))) STORED",
+        "CREATE INDEX IF NOT EXISTS ix_notes_search_vector ON notes USING GIN (search_vector)",
+    ],
+}
+
+
+@event.listens_for(NoteEntry.__table__, "after_create")
+def _create_notes_search_index(target, connection, **kw):
+    # 全文検索のインデックスは方言ごとの DDL で作る。作れない場合 (FTS5 のない SQLite など) は LIKE で検索する
+    statements = _NOTES_FTS_DDL.get(connection.dialect.name)
+    if not statements:
+        return
+    try:
+        with connection.begin_nested():
+            for statement in statements:
+                connection.execute(text(statement))
+    except SQLAlchemyError as e:
+        logger.warning("Could not create the full-text index for notes; search falls back to LIKE: %s", e)
+
 # ------------------------------------------------------------
 # 5. テーブル作成関数
 #    - create_tables() を呼ぶと、まだテーブルが存在しなければ作成する
+#    - ensure_schema() はスキーマが変わったとき (デプロイごとに最初の 1 回) だけ create_tables() を行う
 #    - エラー発生時はプロセスを終了
 # ------------------------------------------------------------
+# PostgreSQL で複数のワーカーが同時にテーブルを作らないようにするための advisory lock のキー
+_SCHEMA_LOCK_KEY = 0x6C696E65626F74  # "linebot"
+
+
 def create_tables():
     try:
         Base.metadata.create_all(engine)
         logger.info("Database tables created successfully (or already exist).")
     except SQLAlchemyError as e:
-        logger.error(f"Error creating database tables: {e}")
+        logger.error("Error creating database tables: %s", e)
         sys.exit(1)
+
+
+def schema_fingerprint() -> str:
+    # テーブル・インデックスの DDL から計算するので、モデルを変更すると値が変わる
+    from sqlalchemy.schema import CreateIndex, CreateTable
+
+    ddl = []
+    for table in Base.metadata.sorted_tables:
+        ddl.append(str(CreateTable(table).compile(dialect=engine.dialect)))
+        ddl.extend(str(CreateIndex(index).compile(dialect=engine.dialect)) for index in sorted(table.indexes, key=lambda i: i.name))
+    return hashlib.sha256("\n".join(ddl).encode("utf-8")).hexdigest()
+
+
+def _schema_applied(fingerprint: str) -> bool:
+    try:
+        with engine.connect() as conn:
+            return conn.execute(
+                select(SchemaState.fingerprint).where(SchemaState.fingerprint == fingerprint)
+            ).first() is not None
+    except SQLAlchemyError:
+        # 初回 (schema_state テーブルがまだない) など
+        return False
+
+
+@contextlib.contextmanager
+def _schema_lock():
+    if engine.dialect.name == "postgresql":
+        with engine.connect() as conn:
+            conn.execute(text("SELECT pg_advisory_lock(:key)"), {"key": _SCHEMA_LOCK_KEY})
+            try:
+                yield
+            finally:
+                conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": _SCHEMA_LOCK_KEY})
+                conn.commit()
+    elif IS_SQLITE and not IS_SQLITE_MEMORY and fcntl is not None:
+        # 同じホストのワーカー同士はロックファイルで排他する
+        with open(f"{make_url(DATABASE_URL).database}.schema.lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+    else:
+        yield
+
+
+def ensure_schema() -> bool:
+    """スキーマが最新でなければテーブルを作成し、作成した場合は True を返す。"""
+    fingerprint = schema_fingerprint()
+    if _schema_applied(fingerprint):
+        logger.info("Database schema is up to date (%s). Skipping table creation.", fingerprint[:12])
+        return False
+    with _schema_lock():
+        # ロックを待っている間に他のワーカーが作成を終えていれば何もしない
+        if _schema_applied(fingerprint):
+            logger.info("Database schema was created by another worker (%s).", fingerprint[:12])
+            return False
+        create_tables()
+        try:
+            with engine.begin() as conn:
+                conn.execute(SchemaState.__table__.insert(), {"fingerprint": fingerprint, "applied_at": datetime.datetime.utcnow()})
+        except SQLAlchemyError as e:
+            # 記録できなくても次回の起動で create_all をやり直すだけなので続行する
+            logger.warning("Could not record schema fingerprint: %s", e)
+    return True
@@ -0,0 +1,249 @@
+import os
+import random
+import logging
+import datetime
+import itertools
+import threading
+from collections import namedtuple
+
+from sqlalchemy import func, text
+from googleapiclient.errors import HttpError
+
+from database import DocWriteOutbox
+from google_rate_limit_util import NON_IDEMPOTENT_RETRYABLE_STATUSES
+
+logger = logging.getLogger(__name__)
+
+# 新しい追記がなくても未反映の行を確認する間隔 (秒)
+DOC_OUTBOX_POLL_INTERVAL = float(os.environ.get('DOC_OUTBOX_POLL_INTERVAL', 5))
+# 1 回の batchUpdate にまとめる最大件数
+DOC_OUTBOX_BATCH_SIZE = int(os.environ.get('DOC_OUTBOX_BATCH_SIZE', 50))
+# これを超えて失敗した追記は status='failed' にして、後続の追記を先に進める
+DOC_OUTBOX_MAX_ATTEMPTS = int(os.environ.get('DOC_OUTBOX_MAX_ATTEMPTS', 20))
+# 再試行の待ち時間 (秒)。試行ごとに倍にし、上限で頭打ちにする
+DOC_OUTBOX_BACKOFF_BASE = float(os.environ.get('DOC_OUTBOX_BACKOFF_BASE', 2))
+DOC_OUTBOX_BACKOFF_MAX = float(os.environ.get('DOC_OUTBOX_BACKOFF_MAX', 600))
+# 反映中 (status='applying') の行を他のプロセスに取らせない秒数。反映中のプロセスが止まった場合は、この後に取り直す
+# (batchUpdate の再試行を含めた所要時間より長くする)
+DOC_OUTBOX_LEASE_SECONDS = float(os.environ.get('DOC_OUTBOX_LEASE_SECONDS', 300))
+
+# 反映のために取った行の内容 (status と next_attempt_at は取る前の値)
+_OutboxEntry = namedtuple('_OutboxEntry', 'seq text image_uri attempts status next_attempt_at')
+
+
+def enqueue_doc_write(db, doc_id: str, text: str | None = None, image_uri: str | None = None, user_id: str | None = None):
+    """ドキュメントへの追記をアウトボックスに記録する (コミットまで行う)。"""
+    if (text and image_uri) or (not text and not image_uri):
+        raise ValueError("Specify exactly one of text or image_uri.")
+    entry = DocWriteOutbox(doc_id=doc_id, user_id=user_id, text=text, image_uri=image_uri)
+    db.add(entry)
+    db.commit()
+    return entry.seq
+
+
+def _is_permanent(error: Exception) -> bool:
+    # 送り直してはいけないエラー (リクエストの内容や権限の問題と、反映されたか分からない 5xx)
+    return isinstance(error, HttpError) and error.resp.status not in NON_IDEMPOTENT_RETRYABLE_STATUSES
+
+
+def _may_have_applied(error: Exception) -> bool:
+    # 429 / 503 以外の 5xx は、Docs 側で反映済みの場合がある
+    return _is_permanent(error) and error.resp.status >= 500
+
+
+class DocOutboxDrainer:
+    """アウトボックスの追記をドキュメントごとに seq 順で反映するバックグラウンドスレッド。
+
+    反映する行は先に status='applying' にしてリース (next_attempt_at までの期限) を取ってからコミットし、
+    Google の呼び出しはトランザクションの外で行う。リースを取れるのは 1 プロセスだけなので、複数のワーカーで動かしても
+    同じ追記を 2 回反映したり、順序が入れ替わったりしない。先頭の追記が再試行待ちの間は、同じドキュメントの後続の追記も待たせる。
+    """
+
+    def __init__(self, session_factory, engine, append_func, poll_interval=DOC_OUTBOX_POLL_INTERVAL,
+                 batch_size=DOC_OUTBOX_BATCH_SIZE, max_attempts=DOC_OUTBOX_MAX_ATTEMPTS, lease=DOC_OUTBOX_LEASE_SECONDS):
+        self._session_factory = session_factory
+        self._use_advisory_lock = engine.dialect.name == 'postgresql'
+        self._append = append_func
+        self._poll_interval = poll_interval
+        self._batch_size = max(1, batch_size)
+        self._max_attempts = max_attempts
+        self._lease = lease
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="doc-outbox-drainer", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float | None = None):
+        # 未反映の行は DB に残るので、次回の起動時 (または他のプロセス) で反映される
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def wake(self):
+        # 追記を記録した直後に呼び、ポーリング間隔を待たずに反映させる
+        self._wakeup.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wakeup.clear()
+            try:
+                while self.drain_once() and not self._stop.is_set():
+                    pass
+            except Exception as e:
+                logger.exception('Doc outbox drain failed: %s', e)
+            self._wakeup.wait(self._poll_interval)
+
+    def drain_once(self) -> int:
+        """反映できる追記を一巡して反映し、反映した件数を返す。"""
+        now = datetime.datetime.utcnow()
+        db = self._session_factory()
+        try:
+            # 'applying' の行は、反映中のプロセスが止まってリースが切れていれば取り直す
+            doc_ids = [
+                row[0] for row in db.query(DocWriteOutbox.doc_id)
+                .filter(DocWriteOutbox.status.in_(('pending', 'applying')))
+                .group_by(DocWriteOutbox.doc_id)
+                .having(func.min(DocWriteOutbox.next_attempt_at) <= now)
+                .all()
+            ]
+        finally:
+            db.close()
+        return sum(self._drain_document(doc_id) for doc_id in doc_ids)
+
+    def _drain_document(self, doc_id: str) -> int:
+        entries = self._claim(doc_id, datetime.datetime.utcnow())
+        if not entries:
+            return 0
+        # Google の呼び出し (と再試行) の間は DB のトランザクションを開いたままにしない
+        applied, failures = self._apply(doc_id, entries)
+        self._finish(doc_id, entries, applied, failures)
+        return len(applied)
+
+    def _claim(self, doc_id: str, now: datetime.datetime) -> list:
+        # 先頭から batch_size 件を 'applying' にしてリースを取り、コミットする。
+        # 他のプロセスが先に取った場合 (更新できた件数が足りない場合) は何もしない
+        db = self._session_factory()
+        try:
+            # ロックはトランザクションの終了 (commit / rollback) で解放される
+            if self._use_advisory_lock and not db.execute(
+                text("SELECT pg_try_advisory_xact_lock(hashtext(:doc_id))"), {"doc_id": doc_id}
+            ).scalar():
+                return []
+
+            # 先頭から読む。先頭が再試行待ちか、他のプロセスが反映中 (リースが有効) なら、後続の追記を先に反映しない
+            rows = (
+                db.query(DocWriteOutbox)
+                .filter(DocWriteOutbox.doc_id == doc_id, DocWriteOutbox.status.in_(('pending', 'applying')))
+                .order_by(DocWriteOutbox.seq)
+                .limit(self._batch_size)
+                .all()
+            )
+            rows = list(itertools.takewhile(lambda row: row.next_attempt_at <= now, rows))
+            if not rows:
+                db.rollback()
+                return []
+
+            entries = [
+                _OutboxEntry(row.seq, row.text, row.image_uri, row.attempts, row.status, row.next_attempt_at)
+                for row in rows
+            ]
+            # 読んだ後に他のプロセスが取った行は更新されないので、件数で確かめる
+            claimed = db.query(DocWriteOutbox).filter(
+                DocWriteOutbox.seq.in_([entry.seq for entry in entries]),
+                DocWriteOutbox.status.in_(('pending', 'applying')),
+                DocWriteOutbox.next_attempt_at <= now,
+            ).update(
+                {"status": 'applying', "next_attempt_at": now + datetime.timedelta(seconds=self._lease)},
+                synchronize_session=False,
+            )
+            if claimed != len(entries):
+                db.rollback()
+                return []
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+        if entries[0].status == 'applying':
+            # 前に反映していたプロセスが途中で止まった。反映済みかどうか分からないので、もう一度反映する
+            logger.warning('Reclaiming %d outbox writes to doc %s whose lease expired.', len(entries), doc_id)
+        return entries
+
+    def _apply(self, doc_id: str, entries: list):
+        # (反映できた追記, [(失敗した追記, 例外)]) を返す
+        try:
+            self._append(doc_id, [(entry.text, entry.image_uri) for entry in entries])
+        except Exception as e:
+            if len(entries) > 1 and _is_permanent(e) and not _may_have_applied(e):
+                # まとめた中のどれが原因か分からないので、1 件ずつ反映し直す
+                return self._apply_one_by_one(doc_id, entries)
+            return [], [(entries, e)]
+        logger.debug('Applied %d outbox writes to doc %s.', len(entries), doc_id)
+        return entries, []
+
+    def _apply_one_by_one(self, doc_id: str, entries: list):
+        applied = []
+        failures = []
+        for entry in entries:
+            try:
+                self._append(doc_id, [(entry.text, entry.image_uri)])
+            except Exception as e:
+                failures.append(([entry], e))
+                if not _is_permanent(e) and entry.attempts + 1 < self._max_attempts:
+                    # 一時的なエラーなら後続の追記も待たせて順序を保つ
+                    break
+                continue
+            applied.append(entry)
+        return applied, failures
+
+    def _finish(self, doc_id: str, entries: list, applied: list, failures: list):
+        # 結果を短いトランザクションで記録する。反映しなかった追記は元の状態に戻す
+        db = self._session_factory()
+        try:
+            rows = {
+                row.seq: row for row in db.query(DocWriteOutbox)
+                .filter(DocWriteOutbox.seq.in_([entry.seq for entry in entries]))
+            }
+            for entry in applied:
+                if entry.seq in rows:
+                    db.delete(rows.pop(entry.seq))
+            for failed, error in failures:
+                self._record_failure(doc_id, [rows.pop(entry.seq) for entry in failed if entry.seq in rows], error)
+            for entry in entries:
+                row = rows.get(entry.seq)
+                if row is not None:
+                    row.status = 'pending'
+                    row.next_attempt_at = entry.next_attempt_at
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def _record_failure(self, doc_id: str, rows: list, error: Exception):
+        if not rows:
+            return
+        for row in rows:
+            row.attempts += 1
+            row.last_error = f"{type(error).__name__}: {error}"[:1000]
+        head = rows[0]
+        # 反映されたか分からない追記は、2 回追記しないよう送り直さずに failed にする
+        if (_is_permanent(error) and (len(rows) == 1 or _may_have_applied(error))) or head.attempts >= self._max_attempts:
+            for row in rows:
+                row.status = 'failed'
+            logger.error('Giving up on %d outbox writes to doc %s after %d attempts: %s', len(rows), doc_id, head.attempts, error)
+            return
+        delay = min(DOC_OUTBOX_BACKOFF_MAX, DOC_OUTBOX_BACKOFF_BASE * (2 ** (head.attempts - 1)))
+        delay *= random.uniform(0.5, 1.0)
+        next_attempt_at = datetime.datetime.utcnow() + datetime.timedelta(seconds=delay)
+        for row in rows:
+            row.status = 'pending'
+            row.next_attempt_at = next_attempt_at
+        logger.warning('Outbox write to doc %s failed (attempt %d). Retrying in %.1fs: %s', doc_id, head.attempts, delay, error)
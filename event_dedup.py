@@ -0,0 +1,150 @@
+import time
+import logging
+import datetime
+import threading
+from collections import OrderedDict
+
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+
+from database import ProcessedWebhookEvent
+
+logger = logging.getLogger(__name__)
+
+# 期限切れの行を DB から削除する間隔 (秒)
+_PURGE_INTERVAL = 300
+
+
+class WebhookEventDeduplicator:
+    """webhookEventId を有効期限つきで記録し、LINE が再送した同じイベントを 2 回処理しないようにする。
+
+    記録はプロセス内の件数上限つきのセットで行い、engine を渡した場合は DB (processed_webhook_events) にも記録して
+    別のワーカーが受け取った再送も弾く。DB に書けない場合は処理を止めないよう、新しいイベントとして扱う。
+    DB の行は処理中 ('processing') として記録し、complete() で処理済み ('done') にする。処理中のワーカーが
+    release() できずに止まった場合は、lease 秒を過ぎた後に届いた再送が処理を引き継ぐ。
+    """
+
+    def __init__(self, maxsize=100000, ttl=86400.0, engine=None, lease=600.0):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._engine = engine
+        self._lease = lease
+        self._lock = threading.Lock()
+        # event_id -> 有効期限。有効期限は一定なので、先頭ほど古い
+        self._seen = OrderedDict()
+        self._next_purge = 0.0
+        self.duplicates = 0
+        self.redeliveries = 0
+
+    def claim(self, event_id: str, is_redelivery: bool = False) -> bool:
+        """初めて見るイベントなら記録して True を、処理済み (処理中) なら False を返す。"""
+        now = time.monotonic()
+        with self._lock:
+            if is_redelivery:
+                self.redeliveries += 1
+            while self._seen and next(iter(self._seen.values())) <= now:
+                self._seen.popitem(last=False)
+            if event_id in self._seen:
+                self.duplicates += 1
+                return False
+            self._seen[event_id] = now + self._ttl
+            while len(self._seen) > self._maxsize:
+                self._seen.popitem(last=False)
+        if self._engine is not None and not self._claim_in_database(event_id, is_redelivery):
+            with self._lock:
+                # 別のワーカーが処理中のイベントは、リースが切れた後の再送で引き継げるよう DB で判定し直す
+                self._seen.pop(event_id, None)
+                self.duplicates += 1
+            return False
+        return True
+
+    def complete(self, event_id: str):
+        """処理を終えたイベントを処理済みにする (以後の再送は、リースの期限に関係なく弾く)。"""
+        if self._engine is None:
+            return
+        table = ProcessedWebhookEvent.__table__
+        try:
+            with self._engine.begin() as conn:
+                conn.execute(table.update().where(table.c.webhook_event_id == event_id).values(status='done'))
+        except SQLAlchemyError as e:
+            logger.warning('Could not mark webhook event %s as done: %s', event_id, e)
+
+    def release(self, event_id: str):
+        """処理に失敗したイベントの記録を消し、再送されたときに処理し直せるようにする。"""
+        with self._lock:
+            self._seen.pop(event_id, None)
+        if self._engine is None:
+            return
+        table = ProcessedWebhookEvent.__table__
+        try:
+            with self._engine.begin() as conn:
+                conn.execute(table.delete().where(table.c.webhook_event_id == event_id))
+        except SQLAlchemyError as e:
+            logger.warning('Could not release webhook event %s: %s', event_id, e)
+
+    def _claim_in_database(self, event_id: str, is_redelivery: bool) -> bool:
+        table = ProcessedWebhookEvent.__table__
+        self._purge_expired()
+        now = datetime.datetime.utcnow()
+        try:
+            with self._engine.begin() as conn:
+                conn.execute(table.insert(), {
+                    "webhook_event_id": event_id,
+                    "is_redelivery": is_redelivery,
+                    "status": 'processing',
+                    "claimed_at": now,
+                    "received_at": now,
+                })
+            return True
+        except IntegrityError:
+            pass
+        except SQLAlchemyError as e:
+            logger.warning('Could not record webhook event %s; processing it anyway: %s', event_id, e)
+            return True
+        return self._take_over_in_database(event_id, is_redelivery, now)
+
+    def _take_over_in_database(self, event_id: str, is_redelivery: bool, now: datetime.datetime) -> bool:
+        # 処理中のまま lease 秒が過ぎた行は、処理していたワーカーが止まったとみなして引き継ぐ。
+        # 同時に再送を受けたワーカーのうち、更新できた 1 つだけが処理する
+        table = ProcessedWebhookEvent.__table__
+        expired = now - datetime.timedelta(seconds=self._lease)
+        try:
+            with self._engine.begin() as conn:
+                taken = conn.execute(
+                    table.update()
+                    .where(table.c.webhook_event_id == event_id, table.c.status == 'processing', table.c.claimed_at < expired)
+                    .values(claimed_at=now, is_redelivery=is_redelivery)
+                ).rowcount
+        except SQLAlchemyError as e:
+            logger.warning('Could not take over webhook event %s: %s', event_id, e)
+            return False
+        if taken:
+            logger.warning('Taking over webhook event %s whose previous claim expired without completing.', event_id)
+        return bool(taken)
+
+    def _purge_expired(self):
+        now = time.monotonic()
+        with self._lock:
+            if now < self._next_purge:
+                return
+            self._next_purge = now + _PURGE_INTERVAL
+        table = ProcessedWebhookEvent.__table__
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=self._ttl)
+        try:
+            with self._engine.begin() as conn:
+                purged = conn.execute(table.delete().where(table.c.received_at < cutoff)).rowcount
+            if purged:
+                logger.debug('Purged %d expired webhook event records.', purged)
+        except SQLAlchemyError as e:
+            logger.warning('Could not purge expired webhook event records: %s', e)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._seen),
+                "maxsize": self._maxsize,
+                "ttl": self._ttl,
+                "lease": self._lease,
+                "database": self._engine is not None,
+                "duplicates": self.duplicates,
+                "redeliveries": self.redeliveries,
+            }
@@ -0,0 +1,167 @@
+import os
+import time
+import asyncio
+import logging
+
+import httpx
+import httplib2
+from googleapiclient.errors import HttpError
+
+from google_service_util import get_credentials, api_operation
+from metrics_util import record_api_call, record_api_bytes
+# レート制限と 429 / 5xx の再試行は同期版と同じスケジューラーで行う
+from google_rate_limit_util import google_api_scheduler, RETRYABLE_STATUSES, NON_IDEMPOTENT_RETRYABLE_STATUSES
+
+logger = logging.getLogger(__name__)
+
+DOCS_API_BASE_URL = os.environ.get('GOOGLE_DOCS_API_BASE_URL', 'https://docs.googleapis.com').rstrip('/')
+DRIVE_API_BASE_URL = os.environ.get('GOOGLE_DRIVE_API_BASE_URL', 'https://www.googleapis.com').rstrip('/')
+# 非同期クライアントのコネクションプールの大きさ
+GOOGLE_ASYNC_MAX_CONNECTIONS = int(os.environ.get('GOOGLE_ASYNC_MAX_CONNECTIONS', 20))
+GOOGLE_HTTP_TIMEOUT = float(os.environ.get('GOOGLE_HTTP_TIMEOUT', 60))
+
+
+def _raise_for_status(response: httpx.Response):
+    # 同期版 (googleapiclient) と同じ HttpError を送出し、呼び出し元のエラー処理を共通にする
+    if response.status_code >= 400:
+        resp = httplib2.Response({k.lower(): v for k, v in response.headers.items()})
+        resp.status = response.status_code
+        resp['status'] = str(response.status_code)
+        resp.reason = response.reason_phrase
+        raise HttpError(resp, response.content, uri=str(response.request.url))
+
+
+class AsyncGoogleClient:
+    """Docs / Drive REST API のうち、このアプリで使う呼び出しだけを asyncio で行うクライアント。
+
+    httpx.AsyncClient を 1 つ共有し、コネクションを使い回す。
+    """
+
+    def __init__(self, max_connections: int = GOOGLE_ASYNC_MAX_CONNECTIONS, timeout: float = GOOGLE_HTTP_TIMEOUT):
+        self._max_connections = max_connections
+        self._timeout = timeout
+        self._client = None
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=self._max_connections,
+                    max_keepalive_connections=self._max_connections,
+                ),
+                timeout=self._timeout,
+            )
+        return self._client
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _request(self, method: str, url: str, scopes, rate_key: str | None = None,
+                       retry_statuses=RETRYABLE_STATUSES, **kwargs) -> httpx.Response:
+        # rate_key (ドキュメント ID など) ごとのレート制限もかける
+        api = 'google_docs' if url.startswith(DOCS_API_BASE_URL) else 'google_drive'
+        return await google_api_scheduler.call_async(
+            lambda: self._send(api, method, url, scopes, **kwargs), key=rate_key, api=api, retry_statuses=retry_statuses
+        )
+
+    async def _send(self, api: str, method: str, url: str, scopes, headers=None, **kwargs) -> httpx.Response:
+        # トークンの更新は同期処理なのでスレッドで行う (有効期限内ならネットワークアクセスはしない)
+        creds = await asyncio.to_thread(get_credentials, scopes)
+        headers = dict(headers or {})
+        headers['Authorization'] = f'Bearer {creds.token}'
+        operation = api_operation(method, url)
+        start = time.perf_counter()
+        try:
+            response = await self._get_client().request(method, url, headers=headers, **kwargs)
+        except Exception:
+            record_api_call(api, operation, 'error', time.perf_counter() - start)
+            raise
+        record_api_call(api, operation, response.status_code, time.perf_counter() - start)
+        record_api_bytes(api, 'sent', len(response.request.content))
+        record_api_bytes(api, 'received', len(response.content))
+        _raise_for_status(response)
+        return response
+
+    async def docs_batch_update(self, document_id: str, requests: list, scopes) -> dict:
+        response = await self._request(
+            'POST',
+            f"{DOCS_API_BASE_URL}/v1/documents/{document_id}:batchUpdate",
+            scopes,
+            rate_key=document_id,
+            retry_statuses=NON_IDEMPOTENT_RETRYABLE_STATUSES,
+            json={'requests': requests},
+        )
+        return response.json()
+
+    async def drive_files_create(self, metadata: dict, data, mime_type: str, scopes, chunk_size: int,
+                                 fields: str = 'id', size: int | None = None) -> dict:
+        # resumable upload のセッションを開始する
+        start_headers = {'X-Upload-Content-Type': mime_type}
+        if size is not None:
+            start_headers['X-Upload-Content-Length'] = str(size)
+        response = await self._request(
+            'POST',
+            f"{DRIVE_API_BASE_URL}/upload/drive/v3/files",
+            scopes,
+            params={'uploadType': 'resumable', 'fields': fields},
+            headers=start_headers,
+            json=metadata,
+        )
+        session_uri = response.headers['Location']
+
+        # チャンクを 1 つ先読みしてから送り、最後のチャンクで全体のサイズを伝える
+        buffer = bytearray()
+        offset = 0
+        async for piece in _aiter_bytes(data):
+            buffer += piece
+            while len(buffer) > chunk_size:
+                await self._put_chunk(session_uri, scopes, bytes(buffer[:chunk_size]), offset, None)
+                del buffer[:chunk_size]
+                offset += chunk_size
+        total = offset + len(buffer)
+        response = await self._put_chunk(session_uri, scopes, bytes(buffer), offset, total)
+        return response.json()
+
+    async def _put_chunk(self, session_uri: str, scopes, chunk: bytes, offset: int, total: int | None) -> httpx.Response:
+        if chunk:
+            content_range = f"bytes {offset}-{offset + len(chunk) - 1}/{total if total is not None else '*'}"
+        else:
+            content_range = f"bytes */{total}"
+        response = await self._request('PUT', session_uri, scopes, content=chunk, headers={'Content-Range': content_range})
+        # 途中のチャンクには 308 (Resume Incomplete) が返る
+        if total is None and response.status_code != 308:
+            raise RuntimeError(f"Unexpected status {response.status_code} for intermediate upload chunk ({content_range}).")
+        return response
+
+    async def drive_permissions_create(self, file_id: str, body: dict, scopes, fields: str = 'id') -> dict:
+        response = await self._request(
+            'POST',
+            f"{DRIVE_API_BASE_URL}/drive/v3/files/{file_id}/permissions",
+            scopes,
+            params={'fields': fields},
+            json=body,
+        )
+        return response.json()
+
+
+async def _aiter_bytes(data):
+    # bytes / 非同期イテレータ / 同期イテレータのどれでも受け付ける
+    if isinstance(data, (bytes, bytearray)):
+        yield bytes(data)
+    elif hasattr(data, '__aiter__'):
+        async for piece in data:
+            yield piece
+    else:
+        # 同期イテレータ (urllib3 のストリームなど) の読み込みはイベントループを止めないようスレッドで行う
+        iterator = iter(data)
+        while True:
+            piece = await asyncio.to_thread(next, iterator, None)
+            if piece is None:
+                return
+            yield piece
+
+
+# プロセス全体で共有する非同期クライアント
+async_google_client = AsyncGoogleClient()
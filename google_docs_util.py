@@ -1,22 +1,20 @@
 import os
-import sys
-import json
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
+import logging
+import time
+import threading
+from concurrent.futures import Future
 from googleapiclient.errors import HttpError
 
-# 環境変数からJSON文字列として資格情報を取得
-CREDENTIALS_JSON_STRING = os.environ.get('CREDENTIALS_JSON')
+# 資格情報とサービスオブジェクトはプロセス内で共有・再利用する
+from google_service_util import get_service
+# イベントループ上で使う非同期クライアント
+from google_async_util import async_google_client
+# Google API 呼び出しのレート制限と再試行
+from google_rate_limit_util import google_api_scheduler, NON_IDEMPOTENT_RETRYABLE_STATUSES
+# 画像の縦横比に合わせた埋め込みサイズ
+from image_util import image_object_size
 
-# 環境変数チェック
-if not CREDENTIALS_JSON_STRING:
-    raise ValueError("CREDENTIALS_JSON environment variable is not set. Please set it in Render.")
-
-# JSON文字列をPython辞書にパースする
-try:
-    CREDENTIALS_INFO = json.loads(CREDENTIALS_JSON_STRING)
-except json.JSONDecodeError:
-    raise ValueError("Failed to decode CREDENTIALS_JSON. Ensure it is valid JSON.")
+logger = logging.getLogger(__name__)
 
 
 # DOCUMENT_ID は呼び出し元から受け取るように変更
@@ -26,6 +24,15 @@ except json.JSONDecodeError:
 
 SCOPES = ['https://www.googleapis.com/auth/documents']
 
+# ドキュメント本文 (segmentId が空 = body) の末尾を指す挿入位置
+# 末尾の endIndex を documents().get で取得する必要がなくなり、ドキュメントが大きくなっても追記のコストは一定
+END_OF_BODY_LOCATION = {'endOfSegmentLocation': {'segmentId': ''}}
+
+# 同じドキュメントへの追記をまとめる待ち時間 (ミリ秒)。0 の場合はまとめずに即時書き込む
+DOCS_BATCH_WINDOW_MS = int(os.environ.get('DOCS_BATCH_WINDOW_MS', 0))
+# 1 回の batchUpdate にまとめる最大操作数。これに達したら待ち時間を待たずに書き込む
+DOCS_BATCH_MAX_OPS = int(os.environ.get('DOCS_BATCH_MAX_OPS', 50))
+
 
 # document_id を引数として受け取るように変更
 def send_google_doc(document_id: str, text=None, image_uri=None):
@@ -35,92 +42,170 @@ def send_google_doc(document_id: str, text=None, image_uri=None):
     if (text and image_uri) or (not text and not image_uri):
         raise ValueError("Specify exactly one of text or image_uri.")
 
-    # 資格情報作成とサービスビルド
-    try:
-        creds = service_account.Credentials.from_service_account_info(
-            CREDENTIALS_INFO, scopes=SCOPES
-        )
-        service = build('docs', 'v1', credentials=creds)
-    except Exception as e:
-        print(f"Failed to obtain Google Docs credentials or build service: {e}", file=sys.stderr)
-        raise # 資格情報取得やサービスビルドに失敗した場合は処理を中断
-
-    requests = []
-    # --- 末尾追記のためのロジック ---
-    # ドキュメントの末尾位置を取得
-    end_index = 1 # ドキュメントが完全に空の場合や取得失敗時のデフォルト位置
-
-    try:
-        # ドキュメントボディ全体の endIndex を取得 (前回のエラーが出た方法)
-        # または body(content) の最後の要素の endIndex (その前のエラーが出た方法)
-        # Docs API の挙動が不安定なため、複数の取得方法を試す必要があるかもしれません。
-        # 今回は、body(content) を取得し、最後の要素の endIndex を取得する方法を再度試します。
-        # そして、取得した値から 1 を引いた値を挿入位置として試します。
-
-        document = service.documents().get(documentId=document_id, fields='body(content)').execute()
-        content = document.get('body', {}).get('content')
+    if DOCS_BATCH_WINDOW_MS > 0:
+        # 同じドキュメントへの他の追記とまとめて 1 回の batchUpdate で書き込み、自分の結果を待つ
+        return _write_buffer.submit(document_id, text, image_uri).result()
 
-        if content and content[-1] and content[-1].get('endIndex') is not None:
-             end_index_api = content[-1]['endIndex']
-             # API から取得した endIndex をそのまま使うとエラーになる場合があるため
-             # ここで取得した endIndex から 1 を引いた値を挿入位置として試す
-             # ただし、結果が 0 以下にならないように調整 (インデックスは1から始まる)
-             end_index = max(1, end_index_api - 1)
+    return append_to_document(document_id, [(text, image_uri)])
 
-             print(f"DEBUG: APIから取得した endIndex: {end_index_api}, 挿入位置として試す値: {end_index}", file=sys.stderr)
 
-        else:
-             # ドキュメントが完全に空の場合など
-             end_index = 1 # 先頭に挿入
-             print("DEBUG: ドキュメントコンテンツが空または構造が想定外のため、末尾位置を 1 に設定しました。", file=sys.stderr)
+# send_google_doc の awaitable 版。イベントループを止めずに Docs API を呼び出す
+async def send_google_doc_async(document_id: str, text=None, image_uri=None):
+    if not document_id:
+         raise ValueError("document_id must be provided.")
 
+    if (text and image_uri) or (not text and not image_uri):
+        raise ValueError("Specify exactly one of text or image_uri.")
 
+    try:
+        await async_google_client.docs_batch_update(document_id, [_build_insert_request(text, image_uri)], SCOPES)
+        return f"https://docs.google.com/document/d/{document_id}/edit"
     except HttpError as e:
-        # ドキュメント取得時の API エラー (404 Not Found や 403 Permission Denied など)
-        print(f"Docs API Error while getting document end index: {e}", file=sys.stderr)
-        raise ValueError(f"Failed to get document body content for end index: {e}")
+        logger.error('Docs API Error during async batchUpdate: %s', e)
+        raise
     except Exception as e:
-         print(f"An unexpected error occurred while getting document end index: {e}", file=sys.stderr)
-         raise ValueError(f"Failed to get document end index: {e}")
-
-    # 挿入位置を設定
-    loc = {'index': end_index}
-    # --- 末尾追記のためのロジック ここまで ---
+         logger.error('An unexpected error occurred during async Docs batchUpdate: %s', e)
+         raise
 
 
-    # BatchUpdate リクエストリストを構築
+def _build_insert_request(text=None, image_uri=None) -> dict:
+    # endOfSegmentLocation は本文最後の改行の直前に挿入されるので、従来の endIndex - 1 への挿入と同じ位置になる
+    loc = END_OF_BODY_LOCATION
     if text:
         # テキストの後に改行を自動的に追加（末尾追記なので新しい行として追記されるのが自然）
         text_to_insert = text + '\n'
-        requests.append({
+        return {
             'insertText': {'location': loc, 'text': text_to_insert}
-        })
-    else:
-        # 画像埋め込みの場合も末尾に挿入
-        requests.append({
-            'insertInlineImage': {
-                'location': loc,
-                'uri': image_uri,
-                'objectSize': {
-                    'height': {'magnitude': 200, 'unit': 'PT'}, # 適宜調整してください
-                    'width' : {'magnitude': 200, 'unit': 'PT'}  # 適宜調整してください
-                }
-            }
-        })
+        }
+    # 画像埋め込みの場合も末尾に挿入
+    # 大きさは画像の縦横比を保って枠 (IMAGE_DOC_MAX_WIDTH_PT x IMAGE_DOC_MAX_HEIGHT_PT) に収める
+    return {
+        'insertInlineImage': {
+            'location': loc,
+            'uri': image_uri,
+            'objectSize': image_object_size(image_uri),
+        }
+    }
+
+
+# items: (text, image_uri) のリスト。リストの順番どおりにドキュメント末尾へ追記する
+def append_to_document(document_id: str, items: list) -> str:
+    # キャッシュ済みの資格情報とサービスを取得
+    try:
+        service = get_service('docs', 'v1', SCOPES)
+    except Exception as e:
+        logger.error('Failed to obtain Google Docs credentials or build service: %s', e)
+        raise # 資格情報取得やサービスビルドに失敗した場合は処理を中断
+
+    # BatchUpdate リクエストリストを構築
+    # 各リクエストはその時点の本文末尾に挿入されるので、メッセージ順に並べればそのままの順で追記される
+    requests = [_build_insert_request(text, image_uri) for text, image_uri in items]
 
     # BatchUpdate リクエストを実行
     try:
-        service.documents().batchUpdate(
-            documentId=document_id,
-            body={'requests': requests}
-        ).execute()
+        # ドキュメントごとのレート制限をかけ、429 / 503 は待ってから再試行する (追記は冪等でないので他の 5xx は送り直さない)
+        google_api_scheduler.call(
+            service.documents().batchUpdate(
+                documentId=document_id,
+                body={'requests': requests}
+            ).execute,
+            key=document_id,
+            api='google_docs',
+            retry_statuses=NON_IDEMPOTENT_RETRYABLE_STATUSES,
+        )
         # 成功したら編集リンクを返す
         return f"https://docs.google.com/document/d/{document_id}/edit"
     except HttpError as e:
         # batchUpdate 実行時の API エラー
-        print(f"Docs API Error during batchUpdate: {e}", file=sys.stderr)
+        logger.error('Docs API Error during batchUpdate: %s', e)
         raise # APIエラーは呼び出し元に伝える
     except Exception as e:
          # その他の予期しないエラー
-         print(f"An unexpected error occurred during Docs batchUpdate: {e}", file=sys.stderr)
+         logger.error('An unexpected error occurred during Docs batchUpdate: %s', e)
          raise # その他の予期しないエラーも呼び出し元に伝える
+
+
+class _PendingDoc:
+    __slots__ = ('ops', 'leader')
+
+    def __init__(self):
+        self.ops = []        # (text, image_uri, Future) のリスト
+        self.leader = False  # このドキュメントの書き込みを担当しているスレッドがいるか
+
+
+class DocWriteBuffer:
+    """ドキュメントごとに追記操作を短時間ためて、1 回の batchUpdate にまとめて書き込む。
+
+    最初に追記したスレッドがリーダーとなり、待ち時間の間に届いた追記をまとめて書き込む。
+    後から来たスレッドは自分の Future の結果 (成功 / 失敗) を待つだけでよい。
+    挿入位置は常に本文末尾なので、まとめても追記ごとのインデックス計算は不要。
+    """
+
+    def __init__(self, window_seconds: float, max_ops: int):
+        self._window = window_seconds
+        self._max_ops = max(1, max_ops)
+        self._cond = threading.Condition()
+        self._docs = {}
+
+    def submit(self, document_id: str, text=None, image_uri=None) -> Future:
+        future = Future()
+        with self._cond:
+            entry = self._docs.get(document_id)
+            if entry is None:
+                entry = self._docs[document_id] = _PendingDoc()
+            entry.ops.append((text, image_uri, future))
+            if entry.leader:
+                if len(entry.ops) >= self._max_ops:
+                    self._cond.notify_all()
+                return future
+
+            entry.leader = True
+            deadline = time.monotonic() + self._window
+            while len(entry.ops) < self._max_ops:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+        self._drain(document_id)
+        return future
+
+    def _drain(self, document_id: str):
+        # 書き込み中に届いた追記も、順番を保ったまま続けて書き込む
+        while True:
+            with self._cond:
+                entry = self._docs[document_id]
+                if not entry.ops:
+                    del self._docs[document_id]
+                    return
+                batch = entry.ops[:self._max_ops]
+                del entry.ops[:self._max_ops]
+            self._write_batch(document_id, batch)
+
+    def _write_batch(self, document_id: str, batch: list):
+        try:
+            doc_url = append_to_document(document_id, [(text, image_uri) for text, image_uri, _ in batch])
+        except HttpError as e:
+            if len(batch) > 1 and e.resp.status == 400:
+                # batchUpdate は全体が失敗するため、どの追記が原因かを切り分けて個別に書き込み直す
+                logger.debug('Batched update of %s ops to doc %s was rejected. Retrying one by one.', len(batch), document_id)
+                for text, image_uri, future in batch:
+                    try:
+                        future.set_result(append_to_document(document_id, [(text, image_uri)]))
+                    except Exception as item_error:
+                        future.set_exception(item_error)
+                return
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+        except Exception as e:
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+
+        logger.debug('Appended %s ops to doc %s in one batchUpdate.', len(batch), document_id)
+        for _, _, future in batch:
+            future.set_result(doc_url)
+
+
+_write_buffer = DocWriteBuffer(DOCS_BATCH_WINDOW_MS / 1000.0, DOCS_BATCH_MAX_OPS)
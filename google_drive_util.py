@@ -1,45 +1,65 @@
 import os
 import io
-import sys
 import json
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
+import logging
+import time
+import random
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+import httplib2
 from googleapiclient.errors import HttpError
-from googleapiclient.http import MediaIoBaseUpload
-# from dotenv import load_dotenv
+from googleapiclient.http import MediaIoBaseUpload, MediaUpload
 
-# load_dotenv()
-# サービスアカウントファイルパスは環境変数から読み込む方式に変更するため不要
-# SERVICE_ACCOUNT_FILE = os.path.join(os.path.dirname(__file__), 'credentials.json')
+# 資格情報とサービスオブジェクトはプロセス内で共有・再利用する
+from google_service_util import get_service
+# イベントループ上で使う非同期クライアント
+from google_async_util import async_google_client
+# Google API 呼び出しのレート制限と再試行
+from google_rate_limit_util import (
+    google_api_scheduler, GOOGLE_API_MAX_RETRIES, GOOGLE_API_BACKOFF_BASE, GOOGLE_API_BACKOFF_MAX,
+)
+# チャンクの先読み (読み出しと送信を重ねる)
+from media_util import prefetch_chunks
 
-# 環境変数からJSON文字列として資格情報を取得
-CREDENTIALS_JSON_STRING = os.environ.get('CREDENTIALS_JSON')
-
-# 環境変数チェック
-if not CREDENTIALS_JSON_STRING:
-    raise ValueError("CREDENTIALS_JSON environment variable is not set. Please set it in Render.")
-
-# JSON文字列をPython辞書にパースする
-try:
-    CREDENTIALS_INFO = json.loads(CREDENTIALS_JSON_STRING)
-except json.JSONDecodeError:
-    raise ValueError("Failed to decode CREDENTIALS_JSON. Ensure it is valid JSON.")
+logger = logging.getLogger(__name__)
 
 # GOOGLE_DRIVE_FOLDER_ID も環境変数から取得
 GOOGLE_DRIVE_FOLDER_ID = os.environ.get('GOOGLE_DRIVE_FOLDER_ID')
 
 SCOPES = ['https://www.googleapis.com/auth/drive.file'] # drive.file スコープはアップロードと共有設定に必要
 
+# アップロード後に設定する共有設定 (リンクを知っている全員が閲覧可能)
+ANYONE_READER_PERMISSION = {'type': 'anyone', 'role': 'reader'}
+UPLOAD_FIELDS = 'id,webContentLink,webViewLink'
+
+# アップロード後の共有設定の方法
+#   per_file   : アップロードごとに permissions().create を呼ぶ (従来どおり)
+#   inherit    : 共有済みの GOOGLE_DRIVE_FOLDER_ID の設定を継承させ、ファイルごとの呼び出しを省く
+#   background : 共有設定をバックグラウンドでまとめて Drive の batch エンドポイントに送る
+DRIVE_SHARING_MODE = os.environ.get('DRIVE_SHARING_MODE', 'per_file').lower()
+if DRIVE_SHARING_MODE == 'inherit' and not GOOGLE_DRIVE_FOLDER_ID:
+    logger.warning('DRIVE_SHARING_MODE=inherit requires GOOGLE_DRIVE_FOLDER_ID. Falling back to per_file.')
+    DRIVE_SHARING_MODE = 'per_file'
+# background モードで共有設定をまとめる待ち時間 (ミリ秒)。batch リクエストは最大 100 件まで
+DRIVE_PERMISSION_BATCH_WINDOW_MS = int(os.environ.get('DRIVE_PERMISSION_BATCH_WINDOW_MS', 200))
+_PERMISSION_BATCH_MAX = 100
+
+# resumable upload で 1 リクエストあたりに送るバイト数。Drive API の仕様で 256 KiB の倍数にする
+_UPLOAD_CHUNK_UNIT = 256 * 1024
+DRIVE_UPLOAD_CHUNK_SIZE = max(
+    _UPLOAD_CHUNK_UNIT,
+    int(os.environ.get('DRIVE_UPLOAD_CHUNK_SIZE', 8 * 1024 * 1024)) // _UPLOAD_CHUNK_UNIT * _UPLOAD_CHUNK_UNIT,
+)
+# チャンクを送っている間に、次に送るデータを別スレッドで先読みしておくバイト数。0 なら先読みしない
+DRIVE_UPLOAD_PREFETCH_BYTES = int(os.environ.get('DRIVE_UPLOAD_PREFETCH_BYTES', DRIVE_UPLOAD_CHUNK_SIZE))
+
 
 def get_drive_service():
-    # 資格情報作成とサービスビルド
+    # キャッシュ済みの資格情報とサービスを取得
     try:
-        creds = service_account.Credentials.from_service_account_info(
-            CREDENTIALS_INFO, scopes=SCOPES
-        )
-        return build('drive', 'v3', credentials=creds)
+        return get_service('drive', 'v3', SCOPES)
     except Exception as e:
-        print(f"Failed to obtain Google Drive credentials or build service: {e}", file=sys.stderr)
+        logger.error('Failed to obtain Google Drive credentials or build service: %s', e)
         raise # 資格情報取得やサービスビルドに失敗した場合は処理を中断
 
 
@@ -49,85 +69,431 @@ def upload_file_to_drive(file_data: bytes, file_name: str, mime_type: str):
         # file_data がNoneまたは空の場合はアップロードしない
         return None, None, None # file_id, direct_link, webview_link を返すようにする
 
-    service = get_drive_service()
+    media = MediaIoBaseUpload(io.BytesIO(file_data), mimetype=mime_type, resumable=True) # MIME タイプを引数から取得
+    return _upload_media(media, file_name, mime_type)
+
+
+class StreamingMediaUpload(MediaUpload):
+    """バイト列のイテレータを、全体をメモリに載せずに resumable upload で送るための MediaUpload。
+
+    送信済みのチャンクは捨て、再送に備えて直近のチャンクと次のチャンク分だけを保持する。
+    """
+
+    def __init__(self, chunks, mimetype: str, chunksize: int = DRIVE_UPLOAD_CHUNK_SIZE, size: int | None = None):
+        self._chunks = iter(chunks)
+        self._mimetype = mimetype
+        self._chunksize = chunksize
+        self._size = size  # Content-Length などで全体のサイズが分かっている場合
+        self._buffer = bytearray()
+        self._buffer_start = 0  # _buffer の先頭がストリーム上の何バイト目か
+        self._served_end = 0    # getbytes で最後に返したデータの終端
+        self._eof = False
+
+    def chunksize(self):
+        return self._chunksize
+
+    def mimetype(self):
+        return self._mimetype
+
+    def resumable(self):
+        return True
+
+    def has_stream(self):
+        return False
+
+    def stream(self):
+        return None
+
+    def size(self):
+        if self._size is None and not self._eof:
+            # 次に送るチャンクの終端 + 1 バイトまで先読みし、そこでストリームが終わるなら全体のサイズが確定する
+            # (ちょうどチャンク境界で終わる場合に、最後に空のチャンクを送らずに済むようにする)
+            self._fill(self._served_end + self._chunksize + 1, keep_from=self._buffer_start)
+        if self._size is None and self._eof:
+            self._size = self._buffer_start + len(self._buffer)
+        return self._size
+
+    def getbytes(self, begin, length):
+        if begin < self._buffer_start:
+            raise ValueError(f"Cannot rewind stream to byte {begin}; data before byte {self._buffer_start} was already discarded.")
+        self._fill(begin + length, keep_from=begin)
+        data = bytes(self._buffer[begin - self._buffer_start:begin - self._buffer_start + length])
+        self._served_end = begin + len(data)
+        return data
+
+    def _fill(self, end: int, keep_from: int):
+        # keep_from より前のデータは送信済みなので捨て、end バイト目まで読み進める
+        while True:
+            drop = min(keep_from - self._buffer_start, len(self._buffer))
+            if drop > 0:
+                del self._buffer[:drop]
+                self._buffer_start += drop
+            if self._eof or self._buffer_start + len(self._buffer) >= end:
+                return
+            try:
+                self._buffer += next(self._chunks)
+            except StopIteration:
+                self._eof = True
+
+
+# LINE のコンテンツなど、チャンクのイテレータとして届くデータをそのまま Drive にアップロードする
+# resume_key と sessions (UploadSessionStore) を渡すと、途中まで送ったセッションを保存し、次に同じ resume_key で
+# 呼ばれたときに続きから送る (chunks は先頭から渡し直す。送信済みの部分は読み飛ばす)
+def upload_stream_to_drive(chunks, file_name: str, mime_type: str, size: int | None = None,
+                           resume_key: str | None = None, sessions=None, on_shared=None):
+    prefetched = None
+    if DRIVE_UPLOAD_PREFETCH_BYTES > 0 and (size is None or size > DRIVE_UPLOAD_CHUNK_SIZE):
+        chunks = prefetched = prefetch_chunks(chunks, DRIVE_UPLOAD_PREFETCH_BYTES)
+    try:
+        media = StreamingMediaUpload(chunks, mime_type, size=size)
+        return _upload_media(media, file_name, mime_type, resume_key=resume_key, sessions=sessions if resume_key else None,
+                             on_shared=on_shared)
+    finally:
+        if prefetched is not None:
+            # 失敗した場合も、呼び出し側が元のストリームを閉じる前に先読みのスレッドを止める (同じ接続を 2 つのスレッドで使わない)
+            prefetched.close()
+
+
+def _build_metadata(file_name: str, mime_type: str) -> dict:
     metadata = {'name': file_name, 'mimeType': mime_type} # MIME タイプを引数から取得
 
     # GOOGLE_DRIVE_FOLDER_ID が設定されていれば、そのフォルダにアップロード
     if GOOGLE_DRIVE_FOLDER_ID:
         # フォルダが存在するかどうかのチェックはここでは行っていません
         metadata['parents'] = [GOOGLE_DRIVE_FOLDER_ID]
-        print(f"Uploading to Drive folder: {GOOGLE_DRIVE_FOLDER_ID}", file=sys.stderr) # デバッグログ
+        logger.debug('Uploading to Drive folder: %s', GOOGLE_DRIVE_FOLDER_ID)
+    return metadata
 
-    media = MediaIoBaseUpload(io.BytesIO(file_data), mimetype=mime_type, resumable=True) # MIME タイプを引数から取得
-    try:
-        # Drive APIでファイルをアップロード
-        print(f"Attempting to upload file: {file_name} with MIME type {mime_type}", file=sys.stderr) # デバッグログ
-        # webViewLink も取得する fields='id,webContentLink,webViewLink'
-        file = service.files().create(
-            body=metadata,
-            media_body=media,
-            fields='id,webContentLink,webViewLink'
-        ).execute()
 
-        file_id = file.get('id')
-        direct_link = file.get('webContentLink') # ダイレクトダウンロードリンク (画像などに多い)
-        webview_link = file.get('webViewLink') # Google Drive 上でファイルを開くリンク
+# files().create の結果からファイル ID とリンクを取り出す (リンクがなければ代替リンクを生成する)
+def _resolve_file_links(file: dict):
+    file_id = file.get('id')
+    direct_link = file.get('webContentLink') # ダイレクトダウンロードリンク (画像などに多い)
+    webview_link = file.get('webViewLink') # Google Drive 上でファイルを開くリンク
 
-        print(f"Upload successful. Raw file_id: {file_id}, webContentLink: {direct_link}, webViewLink: {webview_link}", file=sys.stderr) # デバッグログ
+    logger.debug('Upload successful. Raw file_id: %s, webContentLink: %s, webViewLink: %s', file_id, direct_link, webview_link)
 
 
-        # --- file_id のクリーンアップ処理 (念のため残す) ---
-        cleaned_file_id = file_id
-        if isinstance(file_id, str):
-             # ファイルID文字列に'?'が含まれている場合、それ以降を切り捨てる
-             cleaned_file_id = file_id.split('?')[0]
+    # --- file_id のクリーンアップ処理 (念のため残す) ---
+    cleaned_file_id = file_id
+    if isinstance(file_id, str):
+         # ファイルID文字列に'?'が含まれている場合、それ以降を切り捨てる
+         cleaned_file_id = file_id.split('?')[0]
+
+    # 念のため、 cleaned_file_id が空になっていないか、Noneでないかを確認
+    if not cleaned_file_id:
+        # file_idが取得できない場合は、その後の共有設定もリンク生成もできない
+         raise Exception(f"File ID is invalid or empty after upload: {file_id}")
+
+    logger.debug('Cleaned file_id before permissions call: %s', cleaned_file_id)
+    # --- クリーンアップ処理 ここまで ---
+
+
+    # webContentLink が取得できない場合（動画など）の代替手段
+    # 動画の場合は webContentLink がないことが多いので、webViewLink を主に使う
+    if not direct_link and cleaned_file_id:
+         # ファイルIDがあれば、uc?export=view 形式のリンクを生成 (画像向きだが動画でも試せる)
+         direct_link = f"https://drive.google.com/uc?export=view&id={cleaned_file_id}"
+         logger.warning('webContentLink not available, using fallback direct link: %s', direct_link)
+    # webViewLink も重要なリンクとして返す
+    if not webview_link and cleaned_file_id:
+         # webViewLink がない場合の代替
+         webview_link = f"https://drive.google.com/open?id={cleaned_file_id}"
+         logger.warning('webViewLink not available, using fallback webViewLink: %s', webview_link)
+
+    return cleaned_file_id, direct_link, webview_link
+
+
+def _query_upload_status(http, session_uri: str, size: int | None):
+    # resumable upload のセッションの状態を問い合わせる。
+    # 完了済みならファイルのリソース (dict) を、途中なら送信済みのバイト数 (int) を、失効していれば None を返す
+    resp, content = http.request(
+        session_uri, method='PUT', body=b'',
+        headers={'Content-Length': '0', 'Content-Range': f"bytes */{size if size is not None else '*'}"},
+    )
+    if resp.status in (200, 201):
+        return json.loads(content)
+    if resp.status == 308:
+        # Range: bytes=0-N (まだ何も受け取っていなければヘッダーがない)
+        committed = resp.get('range')
+        return int(committed.rsplit('-', 1)[1]) + 1 if committed else 0
+    if resp.status in (404, 410):
+        return None
+    raise HttpError(resp, content, uri=session_uri)
+
+
+def _resume_upload(service, request, media: MediaUpload, saved: dict):
+    # 保存したセッションの続きから送れるよう request を設定する。完了済みならファイルのリソースを返す
+    size = media.size()
+    if saved['total_size'] is not None and size is not None and saved['total_size'] != size:
+        logger.info('Source size changed (%s -> %s). Starting a new upload session.', saved['total_size'], size)
+        return None
+    status = google_api_scheduler.call(
+        lambda: _query_upload_status(request.http, saved['session_uri'], size), api='google_drive'
+    )
+    if status is None:
+        logger.info('Saved upload session has expired. Starting a new upload session.')
+    elif isinstance(status, dict):
+        logger.info('Saved upload session had already completed.')
+        # 状態の問い合わせの応答には UPLOAD_FIELDS (リンク) が含まれないことがあるので、改めて取得する
+        return google_api_scheduler.call(
+            service.files().get(fileId=status['id'], fields=UPLOAD_FIELDS).execute, api='google_drive'
+        )
+    else:
+        request.resumable_uri = saved['session_uri']
+        request.resumable_progress = status
+        logger.info('Resuming upload at byte %d of %s.', status, size if size is not None else 'unknown')
+    return None
 
-        # 念のため、 cleaned_file_id が空になっていないか、Noneでないかを確認
-        if not cleaned_file_id:
-            # file_idが取得できない場合は、その後の共有設定もリンク生成もできない
-             raise Exception(f"File ID is invalid or empty after upload: {file_id}")
 
-        print(f"DEBUG: Cleaned file_id before permissions call: {cleaned_file_id}", file=sys.stderr) # デバッグログ
-        # --- クリーンアップ処理 ここまで ---
+def _next_chunk(request):
+    # チャンクごとにトークンと同時実行数の枠を取り、429 / 5xx はスケジューラーが待ってから送り直す
+    # (失敗した後の next_chunk は、Drive に受け取れた位置を問い合わせてから続きを送る)。
+    # 接続エラーはここで待ってから送り直す
+    for attempt in range(GOOGLE_API_MAX_RETRIES + 1):
+        try:
+            return google_api_scheduler.call(lambda: request.next_chunk(num_retries=0), api='google_drive')
+        except (OSError, httplib2.HttpLib2Error) as e:
+            if attempt >= GOOGLE_API_MAX_RETRIES:
+                raise
+            delay = random.uniform(0, min(GOOGLE_API_BACKOFF_MAX, GOOGLE_API_BACKOFF_BASE * (2 ** attempt)))
+            logger.warning('Drive upload chunk failed (%s). Retrying in %.2fs (attempt %d/%d).', e, delay, attempt + 1, GOOGLE_API_MAX_RETRIES)
+            time.sleep(delay)
 
 
-        # webContentLink が取得できない場合（動画など）の代替手段
-        # 動画の場合は webContentLink がないことが多いので、webViewLink を主に使う
-        if not direct_link and cleaned_file_id:
-             # ファイルIDがあれば、uc?export=view 形式のリンクを生成 (画像向きだが動画でも試せる)
-             direct_link = f"https://drive.google.com/uc?export=view&id={cleaned_file_id}"
-             print(f"Warning: webContentLink not available, using fallback direct link: {direct_link}", file=sys.stderr)
-        # webViewLink も重要なリンクとして返す
-        if not webview_link and cleaned_file_id:
-             # webViewLink がない場合の代替
-             webview_link = f"https://drive.google.com/open?id={cleaned_file_id}"
-             print(f"Warning: webViewLink not available, using fallback webViewLink: {webview_link}", file=sys.stderr)
+def _execute_upload(service, metadata: dict, media: MediaUpload, resume_key: str | None = None, sessions=None):
+    request = service.files().create(body=metadata, media_body=media, fields=UPLOAD_FIELDS)
+    saved = sessions.load(resume_key) if sessions else None
+    response = _resume_upload(service, request, media, saved) if saved else None
+    persisted = saved is not None
+    while response is None:
+        _, response = _next_chunk(request)
+        if response is None and sessions:
+            # 複数のチャンクに分かれる場合だけ、送り終えたところまでを記録する
+            sessions.save(resume_key, request.resumable_uri, request.resumable_progress,
+                          metadata['name'], media.mimetype(), media.size())
+            persisted = True
+    if persisted:
+        sessions.delete(resume_key)
+    return response
 
 
+def _share_later(file_id: str, on_shared):
+    # inherit / background モードの共有設定。on_shared(共有設定が済んだか) は結果が分かった時点で呼ぶ
+    # (background モードでは batch を送ったスレッドから呼ばれる)
+    if DRIVE_SHARING_MODE == 'background':
+        future = _permission_batcher.grant(file_id)
+        if on_shared is not None:
+            future.add_done_callback(lambda f: on_shared(f.result()))
+    elif on_shared is not None:
+        on_shared(True)
+
+
+def _upload_media(media: MediaUpload, file_name: str, mime_type: str, resume_key: str | None = None, sessions=None,
+                  on_shared=None):
+    service = get_drive_service()
+    metadata = _build_metadata(file_name, mime_type)
+
+    try:
+        # Drive APIでファイルをアップロード
+        logger.debug('Attempting to upload file: %s with MIME type %s', file_name, mime_type)
+        # webViewLink も取得する fields='id,webContentLink,webViewLink'
+        # 待ち合わせと再試行はチャンクごとに行う (大きなファイルで同時実行数の枠を占有し続けない)。
+        # 途中で失敗したセッションは sessions に残り、次の呼び出しで続きから送る
+        file = _execute_upload(service, metadata, media, resume_key=resume_key, sessions=sessions)
+
+        cleaned_file_id, direct_link, webview_link = _resolve_file_links(file)
+
+        if DRIVE_SHARING_MODE == 'inherit':
+            # フォルダの共有設定を継承するので、ファイルごとの共有設定は不要
+            _share_later(cleaned_file_id, on_shared)
+            return cleaned_file_id, direct_link, webview_link
+        if DRIVE_SHARING_MODE == 'background':
+            # 共有設定は後でまとめて行い、ファイル ID とリンクが分かった時点で返す
+            _share_later(cleaned_file_id, on_shared)
+            return cleaned_file_id, direct_link, webview_link
+
         # アップロードしたファイルを「リンクを知っている全員が閲覧可能」に設定
         # 修正した cleaned_file_id を使用
         if cleaned_file_id:
             try:
-                print(f"Attempting to set permissions for file ID: {cleaned_file_id}", file=sys.stderr) # デバッグログ
-                service.permissions().create(
-                    fileId=cleaned_file_id, # cleaned_file_id を渡す
-                    body={'type':'anyone','role':'reader'},
-                    fields='id' # 作成されたpermissionのIDを取得（必須ではない）
-                ).execute()
-                print(f"Successfully set permissions for file ID: {cleaned_file_id}", file=sys.stderr)
+                logger.debug('Attempting to set permissions for file ID: %s', cleaned_file_id)
+                google_api_scheduler.call(
+                    service.permissions().create(
+                        fileId=cleaned_file_id, # cleaned_file_id を渡す
+                        body=ANYONE_READER_PERMISSION,
+                        fields='id' # 作成されたpermissionのIDを取得（必須ではない）
+                    ).execute,
+                    api='google_drive',
+                )
+                logger.debug('Successfully set permissions for file ID: %s', cleaned_file_id)
+                shared = True
             except HttpError as perm_error:
                  # 共有設定に失敗してもアップロード自体は成功しているので、処理は続行可能だがログを出す
-                 print(f"Failed to set permissions for file ID {cleaned_file_id}: {perm_error}", file=sys.stderr)
+                 logger.error('Failed to set permissions for file ID %s: %s', cleaned_file_id, perm_error)
+                 shared = False
             except Exception as perm_exception:
                  # 想定外の例外もログに出力
-                 print(f"Unexpected error during permission setting for file ID {cleaned_file_id}: {perm_exception}", file=sys.stderr)
+                 logger.error('Unexpected error during permission setting for file ID %s: %s', cleaned_file_id, perm_exception)
+                 shared = False
+            if on_shared is not None:
+                on_shared(shared)
 
 
         return cleaned_file_id, direct_link, webview_link # file_id, direct_link, webview_link を返す
 
     except HttpError as e:
-        print(f"Drive API Error during upload or permission setting: {e}", file=sys.stderr)
+        logger.error('Drive API Error during upload or permission setting: %s', e)
         raise # APIエラーが発生した場合は呼び出し元に伝える
     except Exception as e:
-        print(f"An unexpected error occurred during Drive upload: {e}", file=sys.stderr)
+        logger.error('An unexpected error occurred during Drive upload: %s', e)
         raise # その他の予期しないエラーも呼び出し元に伝える
+
+
+# upload_file_to_drive / upload_stream_to_drive の awaitable 版
+# data には bytes、またはチャンクの (非同期) イテレータを渡せる
+async def upload_file_to_drive_async(data, file_name: str, mime_type: str, size: int | None = None, on_shared=None):
+    if not data:
+        return None, None, None
+
+    metadata = _build_metadata(file_name, mime_type)
+    try:
+        logger.debug('Attempting to upload file (async): %s with MIME type %s', file_name, mime_type)
+        file = await async_google_client.drive_files_create(
+            metadata, data, mime_type, SCOPES, DRIVE_UPLOAD_CHUNK_SIZE, fields=UPLOAD_FIELDS, size=size
+        )
+        cleaned_file_id, direct_link, webview_link = _resolve_file_links(file)
+
+        if DRIVE_SHARING_MODE in ('inherit', 'background'):
+            _share_later(cleaned_file_id, on_shared)
+            return cleaned_file_id, direct_link, webview_link
+
+        try:
+            await async_google_client.drive_permissions_create(cleaned_file_id, ANYONE_READER_PERMISSION, SCOPES)
+            logger.debug('Successfully set permissions for file ID: %s', cleaned_file_id)
+            shared = True
+        except HttpError as perm_error:
+             # 共有設定に失敗してもアップロード自体は成功しているので、処理は続行する
+             logger.error('Failed to set permissions for file ID %s: %s', cleaned_file_id, perm_error)
+             shared = False
+        if on_shared is not None:
+            on_shared(shared)
+
+        return cleaned_file_id, direct_link, webview_link
+
+    except HttpError as e:
+        logger.error('Drive API Error during async upload: %s', e)
+        raise
+    except Exception as e:
+        logger.error('An unexpected error occurred during async Drive upload: %s', e)
+        raise
+
+
+class PermissionBatcher:
+    """共有設定 (permissions().create) をためておき、Drive の batch エンドポイントでまとめて送る。"""
+
+    def __init__(self, window_seconds: float, max_batch: int = _PERMISSION_BATCH_MAX):
+        self._window = window_seconds
+        self._max_batch = max_batch
+        self._cond = threading.Condition()
+        self._pending = []   # (file_id, Future) のリスト
+        self._futures = {}   # file_id -> Future (共有設定が終わるまで保持)
+        self._thread = None
+
+    def grant(self, file_id: str) -> Future:
+        future = Future()
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="drive-permission-batcher", daemon=True)
+                self._thread.start()
+            self._pending.append((file_id, future))
+            self._futures[file_id] = future
+            self._cond.notify_all()
+        return future
+
+    def wait(self, file_id: str, timeout: float | None = None) -> bool:
+        # 共有設定待ちのファイルなら完了まで待つ。待つ必要がなければ True を返す
+        with self._cond:
+            future = self._futures.get(file_id)
+        if future is None:
+            return True
+        try:
+            return future.result(timeout)
+        except FutureTimeoutError:  # Python 3.10 では組み込みの TimeoutError とは別のクラス
+            return False
+
+    def flush(self, timeout: float | None = None):
+        # シャットダウン時など、ためている共有設定を送り終えるまで待つ
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._futures:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    logger.warning('%s Drive permission grants still pending at shutdown.', len(self._futures))
+                    return
+                self._cond.wait(remaining if remaining is not None else 0.1)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                deadline = time.monotonic() + self._window
+                while len(self._pending) < self._max_batch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = self._pending[:self._max_batch]
+                del self._pending[:self._max_batch]
+
+            results = self._execute(batch)
+
+            with self._cond:
+                for file_id, future in batch:
+                    if self._futures.get(file_id) is future:
+                        del self._futures[file_id]
+                    future.set_result(results.get(file_id, False))
+                self._cond.notify_all()
+
+    def _execute(self, batch: list) -> dict:
+        results = {}
+
+        def callback(request_id, response, exception):
+            file_id = batch[int(request_id)][0]
+            if exception is not None:
+                # 共有設定に失敗してもアップロード自体は成功しているので、ログだけ出す
+                logger.error('Failed to set permissions for file ID %s: %s', file_id, exception)
+                results[file_id] = False
+            else:
+                results[file_id] = True
+
+        try:
+            service = get_drive_service()
+            batch_request = service.new_batch_http_request(callback=callback)
+            for i, (file_id, _) in enumerate(batch):
+                batch_request.add(
+                    service.permissions().create(fileId=file_id, body=ANYONE_READER_PERMISSION, fields='id'),
+                    request_id=str(i),
+                )
+            # batch 内の各リクエストもクォータを消費するので、件数分のトークンを使う
+            google_api_scheduler.call(batch_request.execute, api='google_drive', cost=len(batch))
+            logger.debug('Set permissions for %s/%s files in one batch request.', sum(results.values()), len(batch))
+        except Exception as e:
+            logger.error('Drive permission batch request failed for %s files: %s', len(batch), e)
+        return results
+
+
+_permission_batcher = PermissionBatcher(DRIVE_PERMISSION_BATCH_WINDOW_MS / 1000.0)
+
+
+# 画像を Docs に埋め込む前など、共有設定が反映されている必要がある場合に呼ぶ
+def wait_for_sharing(file_id: str, timeout: float | None = None) -> bool:
+    if DRIVE_SHARING_MODE != 'background' or not file_id:
+        return True
+    return _permission_batcher.wait(file_id, timeout)
+
+
+def flush_pending_permissions(timeout: float | None = None):
+    if DRIVE_SHARING_MODE == 'background':
+        _permission_batcher.flush(timeout)
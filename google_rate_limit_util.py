@@ -0,0 +1,208 @@
+import os
+import time
+import random
+import asyncio
+import logging
+import threading
+import email.utils
+from collections import OrderedDict
+
+from googleapiclient.errors import HttpError
+
+from metrics_util import API_RETRIES_TOTAL, RATE_LIMIT_WAIT
+
+logger = logging.getLogger(__name__)
+
+# プロジェクト (サービスアカウント) 全体で API ごとに 1 秒あたりに送るリクエスト数と、瞬間的に許す数。0 以下なら制限しない
+GOOGLE_DOCS_RATE_PER_SEC = float(os.environ.get('GOOGLE_DOCS_RATE_PER_SEC', 5))
+GOOGLE_DOCS_BURST = float(os.environ.get('GOOGLE_DOCS_BURST', 10))
+GOOGLE_DRIVE_RATE_PER_SEC = float(os.environ.get('GOOGLE_DRIVE_RATE_PER_SEC', 10))
+GOOGLE_DRIVE_BURST = float(os.environ.get('GOOGLE_DRIVE_BURST', 100))
+# ドキュメントごとの書き込みの上限 (同じドキュメントへの連続した batchUpdate を均す)
+GOOGLE_DOC_RATE_PER_SEC = float(os.environ.get('GOOGLE_DOC_RATE_PER_SEC', 1))
+GOOGLE_DOC_BURST = float(os.environ.get('GOOGLE_DOC_BURST', 5))
+# 同時に実行する Google API 呼び出しの上限 (同期・非同期それぞれ)
+GOOGLE_API_MAX_CONCURRENCY = int(os.environ.get('GOOGLE_API_MAX_CONCURRENCY', 8))
+# 429 / 5xx を受けたときの再試行回数と待ち時間 (秒)
+GOOGLE_API_MAX_RETRIES = int(os.environ.get('GOOGLE_API_MAX_RETRIES', 5))
+GOOGLE_API_BACKOFF_BASE = float(os.environ.get('GOOGLE_API_BACKOFF_BASE', 0.5))
+GOOGLE_API_BACKOFF_MAX = float(os.environ.get('GOOGLE_API_BACKOFF_MAX', 32))
+
+RETRYABLE_STATUSES = frozenset({429, 500, 502, 503, 504})
+# ドキュメントへの追記のように冪等でないリクエストは、処理されていないことが確かな 429 / 503 だけ再試行する
+# (500 / 502 / 504 は反映済みの場合があり、送り直すと同じ内容が 2 回追記される)
+NON_IDEMPOTENT_RETRYABLE_STATUSES = frozenset({429, 503})
+# 429 を受けたときに下げるレートの下限 (設定値に対する割合)
+_MIN_RATE_FACTOR = 0.1
+# ドキュメントごとのバケットを保持する上限 (古いものから捨てる)
+_MAX_DOC_BUCKETS = 1000
+
+
+class TokenBucket:
+    """トークンバケット。429 を受けるとレートを半分に下げ、成功が続くと設定値まで少しずつ戻す。"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.max_rate = rate
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, cost: float = 1.0) -> float:
+        """トークンを予約し、使えるようになるまでの待ち秒数を返す。"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= cost
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def penalize(self):
+        with self._lock:
+            self.rate = max(self.max_rate * _MIN_RATE_FACTOR, self.rate / 2)
+
+    def reward(self):
+        with self._lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.max_rate * 0.05)
+
+
+def _retry_after(resp) -> float | None:
+    # Retry-After は秒数か HTTP 日付のどちらか
+    value = resp.get('retry-after') if resp is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class GoogleApiScheduler:
+    """Google API の呼び出しをトークンバケットと同時実行数で制御し、429 / 5xx は待ってから再試行する。
+
+    API ごとのプロジェクト全体のバケットに加えて、key (ドキュメント ID など) ごとのバケットでも待つ。
+    """
+
+    def __init__(self, project_limits=None, doc_rate=GOOGLE_DOC_RATE_PER_SEC, doc_burst=GOOGLE_DOC_BURST,
+                 max_concurrency=GOOGLE_API_MAX_CONCURRENCY, max_retries=GOOGLE_API_MAX_RETRIES,
+                 backoff_base=GOOGLE_API_BACKOFF_BASE, backoff_max=GOOGLE_API_BACKOFF_MAX):
+        if project_limits is None:
+            project_limits = {
+                'google_docs': (GOOGLE_DOCS_RATE_PER_SEC, GOOGLE_DOCS_BURST),
+                'google_drive': (GOOGLE_DRIVE_RATE_PER_SEC, GOOGLE_DRIVE_BURST),
+            }
+        # api -> プロジェクト全体のバケット
+        self._projects = {api: TokenBucket(rate, burst) for api, (rate, burst) in project_limits.items() if rate > 0}
+        self._doc_rate = doc_rate
+        self._doc_burst = doc_burst
+        self._docs = OrderedDict()  # key -> TokenBucket
+        self._lock = threading.Lock()
+        self._max_concurrency = max(1, max_concurrency)
+        self._semaphore = threading.BoundedSemaphore(self._max_concurrency)
+        self._async_semaphore = None
+        self.max_retries = max_retries
+        self._backoff_base = backoff_base
+        self._backoff_max = backoff_max
+
+    def _buckets(self, api: str, key):
+        # (スコープ名, バケット) のリスト
+        project = self._projects.get(api)
+        buckets = [('project', project)] if project else []
+        if key and self._doc_rate > 0:
+            with self._lock:
+                bucket = self._docs.get(key)
+                if bucket is None:
+                    bucket = self._docs[key] = TokenBucket(self._doc_rate, self._doc_burst)
+                    while len(self._docs) > _MAX_DOC_BUCKETS:
+                        self._docs.popitem(last=False)
+                else:
+                    self._docs.move_to_end(key)
+            buckets.append(('document', bucket))
+        return buckets
+
+    def _reserve(self, buckets, cost: float) -> float:
+        wait = 0.0
+        for scope, bucket in buckets:
+            bucket_wait = bucket.reserve(cost)
+            if bucket_wait > 0:
+                RATE_LIMIT_WAIT.observe(bucket_wait, scope=scope)
+            wait = max(wait, bucket_wait)
+        return wait
+
+    def _retry_delay(self, error: HttpError, attempt: int, buckets, api: str, retry: bool, retry_statuses) -> float | None:
+        # 再試行するなら待ち秒数を、しないなら None を返す
+        status = error.resp.status
+        if status == 429:
+            for _, bucket in buckets:
+                bucket.penalize()
+        if not retry or status not in retry_statuses or attempt >= self.max_retries:
+            return None
+        # full jitter の指数バックオフ。Retry-After があればそれより短くはしない
+        delay = random.uniform(0, min(self._backoff_max, self._backoff_base * (2 ** attempt)))
+        retry_after = _retry_after(error.resp)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        API_RETRIES_TOTAL.inc(api=api, status=status)
+        logger.warning('%s returned %s. Retrying in %.2fs (attempt %d/%d).', api, status, delay, attempt + 1, self.max_retries)
+        return delay
+
+    def call(self, func, key: str | None = None, api: str = 'google', retry: bool = True, cost: float = 1.0,
+             retry_statuses=RETRYABLE_STATUSES):
+        """func() を実行する。retry=False の場合は待ち合わせだけ行い、失敗はそのまま送出する。
+
+        冪等でない呼び出しは retry_statuses に NON_IDEMPOTENT_RETRYABLE_STATUSES を渡す。
+        """
+        buckets = self._buckets(api, key)
+        attempt = 0
+        while True:
+            wait = self._reserve(buckets, cost)
+            if wait > 0:
+                time.sleep(wait)
+            with self._semaphore:
+                try:
+                    result = func()
+                except HttpError as e:
+                    delay = self._retry_delay(e, attempt, buckets, api, retry, retry_statuses)
+                    if delay is None:
+                        raise
+                else:
+                    for _, bucket in buckets:
+                        bucket.reward()
+                    return result
+            attempt += 1
+            time.sleep(delay)
+
+    async def call_async(self, coro_func, key: str | None = None, api: str = 'google', retry: bool = True, cost: float = 1.0,
+                         retry_statuses=RETRYABLE_STATUSES):
+        """call の awaitable 版。coro_func は再試行のたびに呼び出してコルーチンを作る。"""
+        if self._async_semaphore is None:
+            self._async_semaphore = asyncio.Semaphore(self._max_concurrency)
+        buckets = self._buckets(api, key)
+        attempt = 0
+        while True:
+            wait = self._reserve(buckets, cost)
+            if wait > 0:
+                await asyncio.sleep(wait)
+            async with self._async_semaphore:
+                try:
+                    result = await coro_func()
+                except HttpError as e:
+                    delay = self._retry_delay(e, attempt, buckets, api, retry, retry_statuses)
+                    if delay is None:
+                        raise
+                else:
+                    for _, bucket in buckets:
+                        bucket.reward()
+                    return result
+            attempt += 1
+            await asyncio.sleep(delay)
+
+
+# プロセス全体で共有するスケジューラー
+google_api_scheduler = GoogleApiScheduler()
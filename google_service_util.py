@@ -0,0 +1,178 @@
+import os
+import json
+import time
+import logging
+import threading
+from urllib.parse import urlparse
+
+import httplib2
+import google_auth_httplib2
+
+from metrics_util import observe_api_call, record_api_call, record_api_bytes
+
+logger = logging.getLogger(__name__)
+
+# 環境変数からJSON文字列として資格情報を取得
+CREDENTIALS_JSON_STRING = os.environ.get('CREDENTIALS_JSON')
+
+# 環境変数チェック
+if not CREDENTIALS_JSON_STRING:
+    raise ValueError("CREDENTIALS_JSON environment variable is not set. Please set it in Render.")
+
+# JSON文字列をPython辞書にパースする (プロセス内で一度だけ)
+try:
+    CREDENTIALS_INFO = json.loads(CREDENTIALS_JSON_STRING)
+except json.JSONDecodeError:
+    raise ValueError("Failed to decode CREDENTIALS_JSON. Ensure it is valid JSON.")
+
+# Discovery ドキュメントのローカルコピーを置くディレクトリ (未設定ならライブラリ同梱の静的コピーを使う)
+GOOGLE_DISCOVERY_DIR = os.environ.get('GOOGLE_DISCOVERY_DIR')
+# Google API への HTTP リクエストのタイムアウト秒数
+GOOGLE_HTTP_TIMEOUT = float(os.environ.get('GOOGLE_HTTP_TIMEOUT', 60))
+
+_lock = threading.Lock()
+# scopes -> Credentials (プロセス全体で共有し、トークンは期限切れまで使い回す)
+_credentials = {}
+# (serviceName, version) -> discovery ドキュメントの JSON 文字列
+_discovery_docs = {}
+# httplib2 はスレッドセーフではないため、サービスオブジェクトはスレッドごとに保持する
+_local = threading.local()
+
+
+def get_credentials(scopes):
+    key = tuple(sorted(scopes))
+    with _lock:
+        creds = _credentials.get(key)
+        if creds is None:
+            # google.oauth2 (暗号ライブラリを含む) は最初に資格情報を作るときに読み込む
+            from google.oauth2 import service_account
+
+            creds = service_account.Credentials.from_service_account_info(
+                CREDENTIALS_INFO, scopes=list(key)
+            )
+            _credentials[key] = creds
+        # 期限切れ (または未取得) の場合だけトークンを取得し直す
+        if not creds.valid:
+            with observe_api_call('google_oauth', 'token.refresh'):
+                creds.refresh(google_auth_httplib2.Request(httplib2.Http(timeout=GOOGLE_HTTP_TIMEOUT)))
+            logger.debug("Refreshed Google access token for scopes %s (expires %s).", key, creds.expiry)
+        return creds
+
+
+def api_operation(method: str, uri: str) -> str:
+    # メトリクスのラベル用に、URL から API の操作名を求める
+    path = urlparse(uri).path
+    if path.endswith(':batchUpdate'):
+        return 'documents.batchUpdate'
+    if path.startswith('/upload/'):
+        return 'files.create'
+    if path.endswith('/permissions'):
+        return 'permissions.create'
+    if path.startswith('/batch'):
+        return 'batch'
+    if '/documents/' in path and method == 'GET':
+        return 'documents.get'
+    return method
+
+
+class _InstrumentedHttp(google_auth_httplib2.AuthorizedHttp):
+    """API 呼び出しの件数・時間・転送量をメトリクスに記録する AuthorizedHttp。"""
+
+    def __init__(self, credentials, http, api: str):
+        super().__init__(credentials, http=http)
+        self._api = api
+
+    def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+        operation = api_operation(method, uri)
+        start = time.perf_counter()
+        try:
+            resp, content = super().request(uri, method, body=body, headers=headers, **kwargs)
+        except Exception:
+            record_api_call(self._api, operation, 'error', time.perf_counter() - start)
+            raise
+        record_api_call(self._api, operation, resp.status, time.perf_counter() - start)
+        if isinstance(body, (bytes, str)):
+            record_api_bytes(self._api, 'sent', len(body))
+        record_api_bytes(self._api, 'received', len(content or b''))
+        return resp, content
+
+
+def _override_root_url(doc: str, service_name: str) -> str:
+    # GOOGLE_<SERVICE>_API_BASE_URL が設定されていれば接続先を差し替える (ベンチマーク用の偽サーバーなど)
+    # client_options の api_endpoint ではアップロードや batch の URL が差し替わらないため、rootUrl を書き換える
+    base_url = os.environ.get(f'GOOGLE_{service_name.upper()}_API_BASE_URL')
+    if not base_url:
+        return doc
+    desc = json.loads(doc)
+    desc['rootUrl'] = base_url.rstrip('/') + '/'
+    desc['baseUrl'] = desc['rootUrl'] + desc.get('servicePath', '')
+    return json.dumps(desc)
+
+
+def _load_discovery_doc(service_name, version):
+    key = (service_name, version)
+    with _lock:
+        if key in _discovery_docs:
+            return _discovery_docs[key]
+
+    doc = None
+    if GOOGLE_DISCOVERY_DIR:
+        path = os.path.join(GOOGLE_DISCOVERY_DIR, f"{service_name}.{version}.json")
+        try:
+            with open(path, encoding='utf-8') as f:
+                doc = f.read()
+        except OSError as e:
+            logger.warning("Could not read discovery document %s: %s", path, e)
+    if doc is None:
+        from googleapiclient.discovery_cache import get_static_doc
+
+        doc = get_static_doc(service_name, version)
+    if doc is not None:
+        doc = _override_root_url(doc, service_name)
+
+    with _lock:
+        _discovery_docs[key] = doc
+    return doc
+
+
+def get_service(service_name, version, scopes):
+    services = getattr(_local, 'services', None)
+    if services is None:
+        services = _local.services = {}
+
+    # 呼び出しごとにトークンの有効期限を確認する (有効ならネットワークアクセスはしない)
+    creds = get_credentials(scopes)
+
+    key = (service_name, version, tuple(sorted(scopes)))
+    service = services.get(key)
+    if service is None:
+        # googleapiclient.discovery は読み込みに時間がかかるので、最初にサービスを作るときに読み込む
+        from googleapiclient.discovery import build, build_from_document
+
+        base_http = httplib2.Http(timeout=GOOGLE_HTTP_TIMEOUT)
+        # 再開可能アップロードの途中の応答 (308 Resume Incomplete) をリダイレクトとして扱わない
+        # (googleapiclient の build_http と同じ設定。これがないと 2 チャンク目以降で失敗する)
+        base_http.redirect_codes = base_http.redirect_codes - {308}
+        http = _InstrumentedHttp(creds, base_http, api=f"google_{service_name}")
+        doc = _load_discovery_doc(service_name, version)
+        if doc is not None:
+            service = build_from_document(doc, http=http)
+        else:
+            # ローカルコピーがない API の場合のみ discovery を取得する
+            service = build(service_name, version, http=http, cache_discovery=False)
+        services[key] = service
+        logger.debug("Built %s %s service for thread %s.", service_name, version, threading.current_thread().name)
+    return service
+
+
+def warm_up(services):
+    """起動直後にバックグラウンドで呼び、最初のリクエストでかかる準備を済ませておく。
+
+    services は (service_name, version, scopes) のリスト。モジュールの読み込み、
+    アクセストークンの取得、discovery ドキュメントの読み込みを行う (サービスオブジェクトはスレッドごとなので作らない)。
+    """
+    import googleapiclient.discovery  # noqa: F401
+
+    for service_name, version, scopes in services:
+        get_credentials(scopes)
+        _load_discovery_doc(service_name, version)
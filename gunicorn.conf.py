@@ -0,0 +1,76 @@
+"""本番用の gunicorn の設定 (uvicorn ワーカー)。
+
+    gunicorn -c gunicorn.conf.py main:app    # または python main.py
+
+マスタープロセスでアプリを読み込んで (preload_app) から fork し、読み込み済みのモジュールや
+discovery ドキュメントをワーカー間で共有する。SIGTERM を受けると、各ワーカーは処理中のリクエストと
+キューに残っているイベントを処理し終えてから終了する (最大 graceful_timeout 秒)。
+"""
+import os
+
+# ワーカー数。WEB_CONCURRENCY (Render / Heroku が設定する) があればそれを、なければ使える CPU 数を使う
+if hasattr(os, 'sched_getaffinity'):
+    _cpu_count = len(os.sched_getaffinity(0))
+else:
+    _cpu_count = os.cpu_count() or 1
+workers = int(os.environ.get('WEB_CONCURRENCY', 0)) or _cpu_count
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 8000)}"
+
+try:
+    import uvicorn_worker  # noqa: F401
+    worker_class = 'uvicorn_worker.UvicornWorker'
+except ImportError:
+    # uvicorn に同梱されている旧いワーカー (uvicorn-worker パッケージがない場合)
+    worker_class = 'uvicorn.workers.UvicornWorker'
+
+# イベントループが応答しなくなったワーカーを再起動するまでの秒数
+timeout = int(os.environ.get('SERVER_TIMEOUT', 60))
+# SIGTERM を受けてから強制終了するまでの秒数 (多くの PaaS は SIGTERM から約 30 秒で SIGKILL を送る)。
+# アプリはシャットダウン時の待ちをすべて SHUTDOWN_TIMEOUT (既定はこれより 5 秒短い) の中で終える
+graceful_timeout = int(os.environ.get('SERVER_GRACEFUL_TIMEOUT', 30))
+# keep-alive 接続を保つ秒数 (前段のロードバランサーのアイドルタイムアウトより短くする)
+keepalive = int(os.environ.get('SERVER_KEEPALIVE', 5))
+# この件数のリクエストを処理したワーカーを入れ替える (0 なら入れ替えない)。メモリの増加が止まらない場合に使う
+max_requests = int(os.environ.get('SERVER_MAX_REQUESTS', 0))
+max_requests_jitter = int(os.environ.get('SERVER_MAX_REQUESTS_JITTER', 0))
+# マスターでアプリを読み込んでから fork する。無効にすると各ワーカーが個別に読み込む
+preload_app = os.environ.get('SERVER_PRELOAD', 'true').lower() in ('1', 'true', 'yes')
+
+# ハートビート用の一時ファイルはメモリ上に置く (コンテナのディスクが遅いとワーカーが止まったと判定される)
+if os.path.isdir('/dev/shm'):
+    worker_tmp_dir = '/dev/shm'
+
+
+def _app_module():
+    # python main.py で起動した場合も gunicorn が main モジュールとして読み込む (preload_app が無効なら未読み込み)
+    import sys
+
+    return sys.modules.get('main')
+
+
+def when_ready(server):
+    # ワーカーを fork する前に呼ばれる。fork しても安全な準備だけをマスターで済ませておく
+    preload = getattr(_app_module(), 'preload_shared_state', None)
+    if server.cfg.preload_app and preload is not None:
+        preload()
+
+
+def post_fork(server, worker):
+    # マスターから引き継いだ状態のうち、そのままでは使えないものを作り直す
+    if not server.cfg.preload_app:
+        return
+    import logging_util
+    from database import engine
+
+    # ログの出力スレッドは子プロセスに引き継がれない
+    logging_util.restart_after_fork()
+    # スキーマの確認で開いたコネクションを親と共有しないよう、プールを捨てる (親の接続は閉じない)
+    engine.dispose(close=False)
+
+
+def worker_exit(server, worker):
+    # キューに残っているログを書き出してから終了する
+    import logging_util
+
+    logging_util.shutdown_logging()
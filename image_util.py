@@ -0,0 +1,168 @@
+import os
+import struct
+import logging
+import threading
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+# 縮小・再エンコードの本体。ワーカープロセスはこのモジュールだけを読み込む
+from image_worker import process_image
+
+logger = logging.getLogger(__name__)
+
+# 画像を縮小・再エンコードしてから Drive にアップロードするか (Pillow がない場合は何もしない)
+IMAGE_PROCESSING_ENABLED = os.environ.get('IMAGE_PROCESSING_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+# 長辺の最大ピクセル数。これより大きい画像は縮小する
+IMAGE_MAX_DIMENSION = int(os.environ.get('IMAGE_MAX_DIMENSION', 1600))
+# 再エンコード後の形式 (jpeg / webp) と品質 (1-100)
+IMAGE_OUTPUT_FORMAT = os.environ.get('IMAGE_OUTPUT_FORMAT', 'jpeg').lower()
+IMAGE_QUALITY = int(os.environ.get('IMAGE_QUALITY', 82))
+# 縮小・再エンコードを行うプロセス数。0 なら呼び出したスレッドでそのまま処理する
+IMAGE_PROCESS_WORKERS = int(os.environ.get('IMAGE_PROCESS_WORKERS', 2))
+# ドキュメントに埋め込むときの最大サイズ (PT)。縦横比を保ったままこの枠に収める
+IMAGE_DOC_MAX_WIDTH_PT = float(os.environ.get('IMAGE_DOC_MAX_WIDTH_PT', 400))
+IMAGE_DOC_MAX_HEIGHT_PT = float(os.environ.get('IMAGE_DOC_MAX_HEIGHT_PT', 400))
+
+# 画面上の 1 ピクセル (96 DPI) を PT に換算する係数
+_PT_PER_PX = 0.75
+# ヘッダーを解析するために読む先頭のバイト数
+SNIFF_SIZE = 64 * 1024
+# image_uri -> (幅, 高さ) を保持する上限
+_MAX_KNOWN_SIZES = 1000
+
+try:
+    import PIL  # noqa: F401
+    PILLOW_AVAILABLE = True
+except ImportError:
+    PILLOW_AVAILABLE = False
+
+
+# --- 形式と大きさの判定 (Pillow なしで先頭のバイト列から読む) ---
+
+def _jpeg_size(data: bytes):
+    # SOFn マーカーまでセグメントを読み飛ばす
+    i = 2
+    while i + 9 < len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:
+            i += 1
+            continue
+        if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7:
+            i += 2
+            continue
+        (length,) = struct.unpack('>H', data[i + 2:i + 4])
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height, width = struct.unpack('>HH', data[i + 5:i + 9])
+            return width, height
+        i += 2 + length
+    return None
+
+
+def _webp_size(data: bytes):
+    chunk = data[12:16]
+    if chunk == b'VP8 ' and len(data) >= 30:
+        width, height = struct.unpack('<HH', data[26:30])
+        return width & 0x3FFF, height & 0x3FFF
+    if chunk == b'VP8L' and len(data) >= 25:
+        bits = int.from_bytes(data[21:25], 'little')
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    if chunk == b'VP8X' and len(data) >= 30:
+        return int.from_bytes(data[24:27], 'little') + 1, int.from_bytes(data[27:30], 'little') + 1
+    return None
+
+
+def sniff_image(head: bytes):
+    """先頭のバイト列から (MIME タイプ, (幅, 高さ)) を判定する。分からない部分は None。"""
+    if head.startswith(b'\xff\xd8\xff'):
+        return 'image/jpeg', _jpeg_size(head)
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'image/png', struct.unpack('>II', head[16:24]) if len(head) >= 24 else None
+    if head[:6] in (b'GIF87a', b'GIF89a'):
+        return 'image/gif', struct.unpack('<HH', head[6:10]) if len(head) >= 10 else None
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image/webp', _webp_size(head)
+    if head[4:12] in (b'ftypheic', b'ftypheix', b'ftypmif1'):
+        return 'image/heic', None
+    return None, None
+
+
+class ImageProcessor:
+    """画像の縮小・再エンコードを別プロセスで行い、リクエストを処理するスレッドを CPU 処理で塞がないようにする。"""
+
+    def __init__(self, workers: int = IMAGE_PROCESS_WORKERS, max_dimension: int = IMAGE_MAX_DIMENSION,
+                 output_format: str = IMAGE_OUTPUT_FORMAT, quality: int = IMAGE_QUALITY):
+        self.enabled = IMAGE_PROCESSING_ENABLED and PILLOW_AVAILABLE
+        self._workers = workers
+        self._max_dimension = max_dimension
+        self._output_format = output_format
+        self._quality = max(1, min(100, quality))
+        self._executor = None
+        self._lock = threading.Lock()
+        if IMAGE_PROCESSING_ENABLED and not PILLOW_AVAILABLE:
+            logger.warning('Pillow is not installed. Images are uploaded without resizing.')
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                # スレッドを持つプロセスを fork しないよう、spawn でワーカーを起動する。
+                # ワーカーは pickle された関数のモジュール (image_worker) を読み込むだけで、アプリの起動処理は行わない
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self._workers, mp_context=multiprocessing.get_context('spawn')
+                )
+                logger.info('Started %d image processing workers.', self._workers)
+            return self._executor
+
+    def process(self, data: bytes):
+        """縮小・再エンコードした (バイト列, MIME タイプ, (幅, 高さ)) を返す。元の画像を使う場合は None。"""
+        if not self.enabled:
+            return None
+        args = (data, self._max_dimension, self._output_format, self._quality)
+        try:
+            if self._workers <= 0:
+                return process_image(*args)
+            return self._get_executor().submit(process_image, *args).result()
+        except Exception as e:
+            # 壊れた画像や Pillow が読めない形式 (HEIC など) は元の画像をそのまま使う
+            logger.warning('Image processing failed; uploading the original image: %s', e)
+            return None
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
+# --- ドキュメントに埋め込むときの大きさ ---
+
+_known_sizes = OrderedDict()
+_known_sizes_lock = threading.Lock()
+
+
+def remember_image_size(image_uri: str, size):
+    """アップロードした画像の大きさを記録し、ドキュメントに埋め込むときの objectSize に使う。"""
+    if not image_uri or not size:
+        return
+    with _known_sizes_lock:
+        _known_sizes[image_uri] = tuple(size)
+        _known_sizes.move_to_end(image_uri)
+        while len(_known_sizes) > _MAX_KNOWN_SIZES:
+            _known_sizes.popitem(last=False)
+
+
+def image_object_size(image_uri: str) -> dict:
+    """insertInlineImage の objectSize を返す。大きさが分からなければ幅だけ指定する (縦横比は Docs が保つ)。"""
+    with _known_sizes_lock:
+        size = _known_sizes.get(image_uri)
+    if not size or not all(size):
+        return {'width': {'magnitude': IMAGE_DOC_MAX_WIDTH_PT, 'unit': 'PT'}}
+    width_pt, height_pt = size[0] * _PT_PER_PX, size[1] * _PT_PER_PX
+    # 枠に収まるように縮小する (元の大きさより拡大はしない)
+    scale = min(1.0, IMAGE_DOC_MAX_WIDTH_PT / width_pt, IMAGE_DOC_MAX_HEIGHT_PT / height_pt)
+    return {
+        'height': {'magnitude': round(height_pt * scale, 1), 'unit': 'PT'},
+        'width': {'magnitude': round(width_pt * scale, 1), 'unit': 'PT'},
+    }
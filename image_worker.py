@@ -0,0 +1,44 @@
+"""画像の縮小・再エンコード。ImageProcessor が spawn で起動するワーカープロセスで実行する。
+
+ワーカーはこのモジュールだけを読み込むので、標準ライブラリと Pillow 以外は import しない。
+"""
+import io
+
+_OUTPUT_FORMATS = {'jpeg': ('JPEG', 'image/jpeg'), 'webp': ('WEBP', 'image/webp')}
+
+
+def process_image(data: bytes, max_dimension: int, output_format: str, quality: int):
+    # 戻り値は (バイト列, MIME タイプ, (幅, 高さ))。処理しない方がよい場合は None
+    from PIL import Image, ImageOps
+
+    with Image.open(io.BytesIO(data)) as image:
+        if getattr(image, 'is_animated', False):
+            # アニメーション GIF / WebP は 1 フレームにしてしまうのでそのまま使う
+            return None
+        pil_format, mime_type = _OUTPUT_FORMATS.get(output_format, _OUTPUT_FORMATS['jpeg'])
+        resized = max(image.size) > max_dimension
+        # JPEG はデコード時に 1/2, 1/4, 1/8 に縮小できるので、全画素を展開せずに済む
+        image.draft('RGB', (max_dimension, max_dimension))
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+        if pil_format == 'JPEG' and image.mode != 'RGB':
+            if image.mode in ('RGBA', 'LA', 'P'):
+                # 透過部分は白で塗る
+                image = image.convert('RGBA')
+                background = Image.new('RGB', image.size, (255, 255, 255))
+                background.paste(image, mask=image.getchannel('A'))
+                image = background
+            else:
+                image = image.convert('RGB')
+        elif pil_format == 'WEBP' and image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'A' in image.mode or 'transparency' in image.info else 'RGB')
+        out = io.BytesIO()
+        options = {'quality': quality, 'optimize': True}
+        if pil_format == 'JPEG':
+            options['progressive'] = True
+        image.save(out, pil_format, **options)
+        encoded = out.getvalue()
+        if not resized and len(encoded) >= len(data):
+            # 縮小しておらず小さくもならないなら、元の画像の方がよい
+            return None
+        return encoded, mime_type, image.size
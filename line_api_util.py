@@ -0,0 +1,172 @@
+import os
+import time
+import logging
+import threading
+from typing import TYPE_CHECKING
+
+import urllib3
+
+from metrics_util import record_api_call, record_api_bytes
+
+if TYPE_CHECKING:
+    from linebot.v3.messaging import AsyncMessagingApi, MessagingApi, MessagingApiBlob
+
+logger = logging.getLogger(__name__)
+
+# メッセージコンテンツ (画像・動画など) を取得する LINE のデータ API
+LINE_DATA_API_BASE_URL = os.environ.get('LINE_DATA_API_BASE_URL', 'https://api-data.line.me').rstrip('/')
+# コンテンツを読み込む単位 (バイト)。ダウンロード中に保持するメモリはこの程度に収まる
+MEDIA_STREAM_CHUNK_SIZE = int(os.environ.get('MEDIA_STREAM_CHUNK_SIZE', 1024 * 1024))
+MEDIA_STREAM_CONNECT_TIMEOUT = float(os.environ.get('MEDIA_STREAM_CONNECT_TIMEOUT', 10))
+MEDIA_STREAM_READ_TIMEOUT = float(os.environ.get('MEDIA_STREAM_READ_TIMEOUT', 60))
+
+# Messaging API (返信など) の接続先。ローカルの検証環境などで差し替えられるようにしておく
+LINE_API_BASE_URL = os.environ.get('LINE_API_BASE_URL')
+# ホストごとに保持するコネクション数。同時に LINE API を呼ぶワーカー数以上にしておく
+LINE_POOL_MAXSIZE = int(os.environ.get('LINE_POOL_MAXSIZE', 10))
+
+
+def _release_response(response, finished: bool):
+    # 読み終えた接続だけをそのままプールに戻す。読みかけの接続に続きのデータが残っていると次のリクエストが壊れるので、
+    # エラーや途中でやめた場合はソケットを閉じてから戻す (次に使うときに接続し直す)
+    if finished:
+        response.drain_conn()
+    else:
+        response.close()
+    response.release_conn()
+
+
+class LineContentStream:
+    """LINE のメッセージコンテンツを、全体をメモリに載せずにチャンク単位で読み出す。"""
+
+    def __init__(self, message_id: str, response):
+        self.message_id = message_id
+        self._response = response
+        # Content-Type ヘッダーから実際の MIME タイプを取得する (パラメータ部分は除く)
+        content_type = response.headers.get('Content-Type') or ''
+        self.mime_type = content_type.split(';')[0].strip() or None
+        content_length = response.headers.get('Content-Length')
+        self.content_length = int(content_length) if content_length and content_length.isdigit() else None
+        self.bytes_read = 0
+        self._finished = False  # 本文を最後まで読んだか
+
+    def iter_chunks(self, chunk_size: int = MEDIA_STREAM_CHUNK_SIZE):
+        for chunk in self._response.stream(chunk_size):
+            if chunk:
+                self.bytes_read += len(chunk)
+                record_api_bytes('line', 'received', len(chunk))
+                yield chunk
+        self._finished = True
+
+    def close(self):
+        _release_response(self._response, self._finished)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class LineClientManager:
+    """LINE API クライアントをプロセス内で共有し、コネクションプールを使い回す。
+
+    同期クライアント (ApiClient) は MessagingApi / MessagingApiBlob / コンテンツのストリーム取得で共有する。
+    非同期クライアント (AsyncApiClient) は aiohttp のセッションがイベントループに紐づくため、
+    最初に使われたときにイベントループ上で作成する。
+    linebot.v3.messaging は読み込みに時間がかかる (起動時間の大半を占める) ので、クライアントを作るときに読み込む。
+    """
+
+    def __init__(self, access_token: str, pool_maxsize: int = LINE_POOL_MAXSIZE, host: str | None = LINE_API_BASE_URL):
+        self._access_token = access_token
+        self._pool_maxsize = pool_maxsize
+        self._host = host
+        self._lock = threading.Lock()
+        self._api_client = None
+        self._messaging_api = None
+        self._blob_api = None
+        self._async_api_client = None
+        self._async_messaging_api = None
+
+    def _configuration(self):
+        from linebot.v3.messaging import Configuration
+
+        configuration = Configuration(access_token=self._access_token, host=self._host)
+        configuration.connection_pool_maxsize = self._pool_maxsize
+        return configuration
+
+    def _ensure_sync(self):
+        with self._lock:
+            if self._api_client is None:
+                from linebot.v3.messaging import ApiClient, MessagingApi, MessagingApiBlob
+
+                self._api_client = ApiClient(self._configuration())
+                self._messaging_api = MessagingApi(self._api_client)
+                self._blob_api = MessagingApiBlob(self._api_client)
+                logger.info("Created shared LINE ApiClient (pool maxsize=%d).", self._pool_maxsize)
+
+    @property
+    def messaging_api(self) -> 'MessagingApi':
+        self._ensure_sync()
+        return self._messaging_api
+
+    @property
+    def blob_api(self) -> 'MessagingApiBlob':
+        self._ensure_sync()
+        return self._blob_api
+
+    def _ensure_async(self):
+        if self._async_api_client is None:
+            from linebot.v3.messaging import AsyncApiClient, AsyncMessagingApi
+
+            self._async_api_client = AsyncApiClient(self._configuration())
+            self._async_messaging_api = AsyncMessagingApi(self._async_api_client)
+            logger.info("Created shared LINE AsyncApiClient (pool maxsize=%d).", self._pool_maxsize)
+
+    @property
+    def async_messaging_api(self) -> 'AsyncMessagingApi':
+        # イベントループ上からのみ呼ぶこと
+        self._ensure_async()
+        return self._async_messaging_api
+
+    def open_message_content(self, message_id: str) -> LineContentStream:
+        # ApiClient と同じコネクションプールを使って、コンテンツをストリームで取得する
+        self._ensure_sync()
+        url = f"{LINE_DATA_API_BASE_URL}/v2/bot/message/{message_id}/content"
+        start = time.perf_counter()
+        try:
+            response = self._api_client.rest_client.pool_manager.request(
+                'GET',
+                url,
+                headers={'Authorization': f'Bearer {self._access_token}'},
+                preload_content=False,
+                timeout=urllib3.Timeout(connect=MEDIA_STREAM_CONNECT_TIMEOUT, read=MEDIA_STREAM_READ_TIMEOUT),
+            )
+        except Exception:
+            record_api_call('line', 'get_message_content', 'error', time.perf_counter() - start)
+            raise
+        # 時間はレスポンスヘッダーの受信まで (本文の読み込みは呼び出し側のステージで計測する)
+        record_api_call('line', 'get_message_content', response.status, time.perf_counter() - start)
+        if response.status != 200:
+            body = response.read(512)
+            _release_response(response, finished=False)
+            raise RuntimeError(
+                f"Failed to get message content for ID {message_id}: HTTP {response.status} {body.decode('utf-8', errors='ignore')}"
+            )
+        return LineContentStream(message_id, response)
+
+    def close(self):
+        with self._lock:
+            api_client, self._api_client = self._api_client, None
+            self._messaging_api = self._blob_api = None
+        if api_client is not None:
+            api_client.close()
+            api_client.rest_client.pool_manager.clear()
+            logger.info("Closed shared LINE ApiClient.")
+
+    async def aclose(self):
+        api_client, self._async_api_client = self._async_api_client, None
+        self._async_messaging_api = None
+        if api_client is not None:
+            await api_client.close()
+            logger.info("Closed shared LINE AsyncApiClient.")
@@ -0,0 +1,110 @@
+import os
+import sys
+import json
+import queue
+import atexit
+import random
+import logging
+import logging.handlers
+
+# ログレベル (DEBUG / INFO / WARNING / ERROR)。本番は INFO 以上を想定
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+# 出力形式。"json" なら 1 行 1 レコードの JSON、それ以外はテキスト
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text').lower()
+# DEBUG レコードのうち実際に出力する割合 (0.0 - 1.0)。高頻度のデバッグログを間引く
+LOG_DEBUG_SAMPLE_RATE = float(os.environ.get('LOG_DEBUG_SAMPLE_RATE', 1.0))
+
+TEXT_FORMAT = '%(asctime)s %(levelname)s [%(process)d:%(threadName)s] %(name)s: %(message)s'
+
+# JSON に含めない LogRecord の標準属性。これ以外 (extra=... で渡したもの) はそのまま出力する
+_RESERVED_ATTRS = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+_listener = None
+_queue_handler = None
+
+
+class JsonFormatter(logging.Formatter):
+    """ログレコードを 1 行の JSON に整形する。"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'pid': record.process,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RESERVED_ATTRS and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class DebugSampler(logging.Filter):
+    """DEBUG レコードを指定した割合だけ通す。INFO 以上はすべて通す。"""
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.DEBUG or self.rate >= 1.0:
+            return True
+        return random.random() < self.rate
+
+
+def setup_logging(level: str = LOG_LEVEL, fmt: str = LOG_FORMAT, debug_sample_rate: float = LOG_DEBUG_SAMPLE_RATE):
+    """ルートロガーを非同期 (QueueHandler / QueueListener) の出力に設定する。
+
+    呼び出し元のスレッドはキューにレコードを積むだけで、stderr への書き込みは専用スレッドで行う。
+    何度呼んでも設定は 1 回だけ行う。
+    """
+    global _listener, _queue_handler
+    if _listener is not None:
+        return
+
+    stream_handler = logging.StreamHandler(sys.stderr)
+    stream_handler.setFormatter(JsonFormatter() if fmt == 'json' else logging.Formatter(TEXT_FORMAT))
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    # サンプリングはキューに積む前に行い、捨てるレコードの整形・受け渡しを省く
+    if debug_sample_rate < 1.0:
+        queue_handler.addFilter(DebugSampler(debug_sample_rate))
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+    _queue_handler = queue_handler
+
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown_logging)
+
+
+def restart_after_fork():
+    """fork した子プロセスで呼び、出力スレッドを作り直す。
+
+    fork しても親のスレッドは子プロセスに引き継がれないため、そのままではキューに積んだレコードが出力されない。
+    親のキューに残っているレコードは親が出力するので、子プロセスでは新しいキューに切り替える。
+    """
+    global _listener
+    if _listener is None:
+        return
+    log_queue = queue.SimpleQueue()
+    _queue_handler.queue = log_queue
+    _listener = logging.handlers.QueueListener(log_queue, *_listener.handlers, respect_handler_level=True)
+    _listener.start()
+
+
+def shutdown_logging():
+    """キューに残っているレコードを書き出してから出力スレッドを止める。"""
+    global _listener
+    listener, _listener = _listener, None
+    if listener is not None:
+        listener.stop()
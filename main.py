@@ -1,159 +1,387 @@
 import os
 import sys
+import time
+
+# 起動時間の計測の基準 (インポートにかかった時間もフェーズとして記録する)
+_STARTUP_STARTED = time.perf_counter()
+
 from dotenv import load_dotenv
 
 load_dotenv()
-print("DEBUG: .env file loaded (if exists).", file=sys.stderr)
+
+# python main.py で起動した場合は、gunicorn (--dev なら 1 プロセスの uvicorn) がこのファイルを main モジュールとして
+# 読み込むように起動し直す。main.py が __main__ のままだと、spawn で起動する画像処理のワーカーが main.py を
+# 読み込み直し、環境変数のチェックやテーブルの作成などの起動処理をワーカーごとに繰り返してしまう
+if __name__ == '__main__':
+    import logging
+
+    # 起動し直す前のメッセージ用 (本来のログ設定は起動し直した先で setup_logging が行う)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s [%(process)d] %(name)s: %(message)s')
+    _app_dir = os.path.dirname(os.path.abspath(__file__))
+    _use_gunicorn = '--dev' not in sys.argv[1:]
+    if _use_gunicorn:
+        try:
+            import gunicorn.app.base  # noqa: F401
+        except ImportError as e:
+            # gunicorn は Windows では動かない (fcntl がない) ので、1 プロセスの uvicorn で起動する
+            logging.getLogger('main').warning('gunicorn is not available (%s). Starting a single uvicorn process.', e)
+            _use_gunicorn = False
+    if _use_gunicorn:
+        # ワーカー数やタイムアウトは gunicorn.conf.py (環境変数) で設定する
+        _server_args = ['-m', 'gunicorn', '-c', os.path.join(_app_dir, 'gunicorn.conf.py'), '--chdir', _app_dir, 'main:app']
+    else:
+        _server_args = ['-m', 'uvicorn', 'main:app', '--app-dir', _app_dir,
+                        '--host', '0.0.0.0', '--port', os.environ.get('PORT', '8000')]
+    os.execv(sys.executable, [sys.executable, *_server_args])
+
+# ログ出力の設定は他のモジュールより先に行う (LOG_LEVEL などは .env からも読めるようにする)
+import logging
+from logging_util import setup_logging
+
+setup_logging()
+logger = logging.getLogger(__name__)
 # --- ここまで環境変数の読み込み ---
 
 # その他のインポート (環境変数が必要なモジュールはload_dotenvの後に)
 import re
+import asyncio
+import itertools
 # ★ 削除: datetimeモジュールをインポート - タイムスタンプ削除のため不要になりました
 # import datetime # handle_imageとhandle_videoでファイル名生成にまだ使っているので削除しませんでした。念のためコメント解除。
 import datetime # ファイル名生成に必要なので残します
 
+import threading
+from concurrent.futures import Future
+from contextlib import asynccontextmanager, contextmanager
+
 # FastAPI, Request, HTTPException のインポートを追加
 from fastapi import FastAPI, Request, HTTPException, status
+from fastapi.concurrency import run_in_threadpool
 # LINE Bot SDK のインポート
-from linebot.v3.webhook import WebhookHandler
-from linebot.v3.messaging import MessagingApi, Configuration, ApiClient
-from linebot.v3.messaging import MessagingApiBlob # メッセージコンテンツ取得用
-from linebot.v3.webhooks import MessageEvent, TextMessageContent, ImageMessageContent, VideoMessageContent
-from linebot.v3.messaging.models import ReplyMessageRequest, TextMessage
-
-# ★ 追加: LINE例外クラスをインポート
-import linebot.v3.exceptions
-# ★ 追加: トレースバック表示用
-import traceback
+# Webhook は SDK の pydantic モデルを使わず、署名の検証とイベントの読み込みを軽量な実装で行う
+from webhook_util import WebhookVerifier, WebhookEvent, BodyTooLargeError, read_body
+# linebot.v3.messaging は読み込みに時間がかかるので、返信を送るとき (またはウォームアップ) に読み込む
+
 # ★ 修正: HttpError をインポート
 from googleapiclient.errors import HttpError
 
 # Google Docs/Drive連携用のモジュール (環境変数が必要なのでload_dotenvの後にインポート)
 try:
-    from google_docs_util import send_google_doc
+    from google_docs_util import send_google_doc, send_google_doc_async, append_to_document, DOCS_BATCH_WINDOW_MS, SCOPES as DOCS_SCOPES
 except ValueError as e:
-    print(f"Error loading google_docs_util: {e}", file=sys.stderr)
+    logger.error('Error loading google_docs_util: %s', e)
     sys.exit(1)
 except Exception as e:
-    print(f"An unexpected error occurred while importing google_docs_util: {e}", file=sys.stderr)
+    logger.error('An unexpected error occurred while importing google_docs_util: %s', e)
     sys.exit(1)
 
 try:
-    from google_drive_util import upload_file_to_drive
+    from google_drive_util import upload_stream_to_drive, upload_file_to_drive_async, wait_for_sharing, flush_pending_permissions
+    from google_drive_util import SCOPES as DRIVE_SCOPES
+    from google_async_util import async_google_client
+    from google_service_util import warm_up as warm_up_google
 except ValueError as e:
-    print(f"Error loading google_drive_util: {e}", file=sys.stderr)
+    logger.error('Error loading google_drive_util: %s', e)
     sys.exit(1)
 except Exception as e:
-    print(f"An unexpected error occurred while importing google_drive_util: {e}", file=sys.stderr)
+    logger.error('An unexpected error occurred while importing google_drive_util: %s', e)
     sys.exit(1)
 
 
+from sqlalchemy.exc import IntegrityError
+
+# メディアの一時保存とハッシュ計算
+from media_util import spool_and_hash, iter_file
+# 画像の形式判定と縮小・再エンコード (別プロセス)
+from image_util import ImageProcessor, sniff_image, remember_image_size, SNIFF_SIZE
+
+# LINE API クライアント (コネクションプール) をプロセス内で共有する
+from line_api_util import LineClientManager
+
+# Webhook イベントをバックグラウンドで処理するワークキューと、ユーザーごとに順序を保って並行に処理するエグゼキューター
+from work_queue import EventWorkQueue, KeyedExecutor
+# 処理段階ごとの時間と外部 API 呼び出しのメトリクス
+from metrics_util import REGISTRY, STARTUP_PHASE_DURATION, worker_id, WEBHOOK_DUPLICATES_TOTAL, instrument_event, observe_stage, observe_api_call
+# ドキュメントへの追記を DB に記録してからバックグラウンドで反映するアウトボックス
+from doc_outbox import DocOutboxDrainer, enqueue_doc_write
+# user_id -> doc_id のインメモリキャッシュ
+from user_doc_cache import UserDocCache, PgInvalidationListener, publish_invalidation
+# 追記した内容の控えと全文検索
+from note_index import record_note, search_notes
+# 再送された Webhook イベントの重複排除
+from event_dedup import WebhookEventDeduplicator
+# 途中まで送った Drive のアップロードを続きから送るためのセッションの保存先
+from upload_session_store import UploadSessionStore
+
+
 # データベースモジュールのインポートとテーブル作成
 try:
-    from database import SessionLocal, UserDocMapping, create_tables
+    from database import (
+        SessionLocal, MediaBlob, ensure_schema, engine, upsert_doc_mappings, DOC_ID_REGEX,
+        fetch_doc_id, fetch_doc_ids_async, dispose_async_engine, DB_ASYNC_ENABLED,
+    )
 except Exception as e:
-    print(f"Error importing database module: {e}", file=sys.stderr)
+    logger.error('Error importing database module: %s', e)
     sys.exit(1)
 
 
+# 起動フェーズごとの所要時間 (秒)。ログと /metrics、/stats に出す
+startup_phases = {}
+
+
+def _record_startup_phase(name: str, elapsed: float):
+    startup_phases[name] = round(elapsed, 3)
+    STARTUP_PHASE_DURATION.observe(elapsed, phase=name)
+    logger.info('Startup phase %s took %.3fs.', name, elapsed)
+
+
+@contextmanager
+def _startup_phase(name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _record_startup_phase(name, time.perf_counter() - start)
+
+
+_record_startup_phase('imports', time.perf_counter() - _STARTUP_STARTED)
+
+
 # 環境変数から設定値を読み込む
 LINE_CHANNEL_SECRET = os.environ.get('LINE_CHANNEL_SECRET')
 LINE_CHANNEL_ACCESS_TOKEN = os.environ.get('LINE_CHANNEL_ACCESS_TOKEN')
 
 # 環境変数の存在チェック
 if not LINE_CHANNEL_SECRET:
-    print("Error: LINE_CHANNEL_SECRET environment variable is not set.", file=sys.stderr)
+    logger.error('LINE_CHANNEL_SECRET environment variable is not set.')
     sys.exit(1)
 if not LINE_CHANNEL_ACCESS_TOKEN:
-    print("Error: LINE_CHANNEL_ACCESS_TOKEN environment variable is not set.", file=sys.stderr)
+    logger.error('LINE_CHANNEL_ACCESS_TOKEN environment variable is not set.')
     sys.exit(1)
 
-print("DEBUG: LINE_CHANNEL_SECRET and LINE_CHANNEL_ACCESS_TOKEN are set.", file=sys.stderr)
-# ★ 追加: ロードしたChannel Secretの長さをログ出力 (値そのものは出力しない)
-print(f"DEBUG: Loaded LINE_CHANNEL_SECRET length: {len(LINE_CHANNEL_SECRET)}", file=sys.stderr)
-print(f"DEBUG: Loaded LINE_CHANNEL_SECRET type: {type(LINE_CHANNEL_SECRET).__name__}", file=sys.stderr)
+
+# Webhook キューモード: 署名検証後すぐに 200 を返し、イベントはワーカースレッドで処理する
+WEBHOOK_QUEUE_ENABLED = os.environ.get('WEBHOOK_QUEUE_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+WEBHOOK_QUEUE_MAXSIZE = int(os.environ.get('WEBHOOK_QUEUE_MAXSIZE', 1000))
+WEBHOOK_QUEUE_WORKERS = int(os.environ.get('WEBHOOK_QUEUE_WORKERS', 4))
+# キューが満杯のときに空きを待つ秒数。これを超えたら 503 を返してバックプレッシャーをかける
+WEBHOOK_QUEUE_PUT_TIMEOUT = float(os.environ.get('WEBHOOK_QUEUE_PUT_TIMEOUT', 2.0))
+# シャットダウン時に残りのイベントを処理し終えるまで待つ最大秒数 (SHUTDOWN_TIMEOUT の中で待つ)
+WEBHOOK_QUEUE_DRAIN_TIMEOUT = float(os.environ.get('WEBHOOK_QUEUE_DRAIN_TIMEOUT', 25.0))
+# シャットダウン時の待ち (キュー・処理中のイベント・アウトボックス・共有設定の送信) 全体の上限 (秒)。
+# gunicorn は SERVER_GRACEFUL_TIMEOUT 秒で強制終了するので、その後の後片付けの分だけ短くする
+SERVER_GRACEFUL_TIMEOUT = int(os.environ.get('SERVER_GRACEFUL_TIMEOUT', 30))
+SHUTDOWN_TIMEOUT = float(os.environ.get('SHUTDOWN_TIMEOUT', max(1, SERVER_GRACEFUL_TIMEOUT - 5)))
+if SHUTDOWN_TIMEOUT >= SERVER_GRACEFUL_TIMEOUT:
+    logger.warning('SHUTDOWN_TIMEOUT (%.0fs) must be shorter than SERVER_GRACEFUL_TIMEOUT (%ds). Using %ds.',
+                   SHUTDOWN_TIMEOUT, SERVER_GRACEFUL_TIMEOUT, max(1, SERVER_GRACEFUL_TIMEOUT - 5))
+    SHUTDOWN_TIMEOUT = float(max(1, SERVER_GRACEFUL_TIMEOUT - 5))
+# キューを使わない場合に、1 回の Webhook に含まれるイベントを並行に処理するスレッド数 (同じユーザーのイベントは順番どおり)
+WEBHOOK_DISPATCH_WORKERS = int(os.environ.get('WEBHOOK_DISPATCH_WORKERS', 8))
+
+# user_id -> doc_id キャッシュの件数上限と有効期限 (秒)。件数上限を 0 にするとキャッシュしない
+USER_DOC_CACHE_MAXSIZE = int(os.environ.get('USER_DOC_CACHE_MAXSIZE', 10000))
+USER_DOC_CACHE_TTL = float(os.environ.get('USER_DOC_CACHE_TTL', 300))
+# 複数ワーカーで動かす場合のキャッシュ無効化方式。"postgres" なら LISTEN/NOTIFY で他プロセスに通知する
+USER_DOC_CACHE_INVALIDATION = os.environ.get('USER_DOC_CACHE_INVALIDATION', '').lower()
+
+# LINE が再送した Webhook イベント (同じ webhookEventId) を処理しないよう、処理したイベントを記録しておく件数と秒数
+WEBHOOK_DEDUP_ENABLED = os.environ.get('WEBHOOK_DEDUP_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+WEBHOOK_DEDUP_MAXSIZE = int(os.environ.get('WEBHOOK_DEDUP_MAXSIZE', 100000))
+WEBHOOK_DEDUP_TTL = float(os.environ.get('WEBHOOK_DEDUP_TTL', 86400))
+# 記録先。"database" なら DB にも記録し、別のワーカーが受け取った再送も弾く (既定はプロセス内のみ)
+WEBHOOK_DEDUP_STORE = os.environ.get('WEBHOOK_DEDUP_STORE', 'memory').lower()
+# "database" の場合に、処理中のまま止まったワーカーのイベントを再送で引き継げるようになるまでの秒数 (1 イベントの処理時間より長くする)
+WEBHOOK_DEDUP_LEASE = float(os.environ.get('WEBHOOK_DEDUP_LEASE', 600))
+
+# 同じ内容のメディア (SHA-256 が一致) はアップロードし直さずに既存の Drive ファイルを使う
+MEDIA_DEDUP_ENABLED = os.environ.get('MEDIA_DEDUP_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+
+# ドキュメントへの追記をアウトボックス (DB) 経由で行うか。Google 側の障害時も追記を失わず、復旧後に順番どおり反映する
+DOC_OUTBOX_ENABLED = os.environ.get('DOC_OUTBOX_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+
+# ドキュメントに追記した内容を DB にも控え、!search で検索できるようにするか
+NOTE_INDEX_ENABLED = os.environ.get('NOTE_INDEX_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+# !search で返す最大件数
+NOTE_SEARCH_LIMIT = int(os.environ.get('NOTE_SEARCH_LIMIT', 5))
+
+# Drive への大きなアップロードのセッションを DB に保存し、同じメッセージを処理し直すとき (再送・再試行) に続きから送るか
+DRIVE_RESUMABLE_SESSIONS_ENABLED = os.environ.get('DRIVE_RESUMABLE_SESSIONS_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+
+# Google Docs/Drive の呼び出しを非同期クライアント (イベントループ上の共有コネクションプール) で行うか。
+# ドキュメントへの追記は、アウトボックス (DOC_OUTBOX_ENABLED) が有効ならアウトボックスから、
+# まとめて書き込む設定 (DOCS_BATCH_WINDOW_MS > 0) ならまとめた上で、どちらも同期クライアントで行う
+GOOGLE_ASYNC_CLIENT_ENABLED = os.environ.get('GOOGLE_ASYNC_CLIENT_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+# LINE への返信を非同期クライアント (AsyncApiClient) で行うか
+LINE_ASYNC_CLIENT_ENABLED = os.environ.get('LINE_ASYNC_CLIENT_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+
+# 起動後 (ポートを開いた後) に LINE / Google クライアントの準備をバックグラウンドで行うか。
+# 無効にすると LINE クライアントは起動時に、Google クライアントは最初に使うときに作成する
+STARTUP_WARMUP_ENABLED = os.environ.get('STARTUP_WARMUP_ENABLED', 'true').lower() in ('1', 'true', 'yes')
 
 
 # データベーステーブルの作成
 # 修正箇所: if __name__ == '__main__': ブロックの外に移動
+# スキーマが前回の作成時から変わっていなければ (同じデプロイの 2 つ目以降のワーカーなど) 作成はスキップする
 try:
-    print("Checking and creating database tables if necessary...", file=sys.stderr)
-    create_tables()
-    print("Database table check/creation complete.", file=sys.stderr)
+    logger.info('Checking and creating database tables if necessary...')
+    with _startup_phase('schema'):
+        ensure_schema()
+    logger.info('Database table check/creation complete.')
 except Exception as e:
-    print(f"Failed to create database tables on startup: {e}", file=sys.stderr)
+    logger.error('Failed to create database tables on startup: %s', e)
     # 起動時にDBエラーが発生した場合は、そこで終了させる方が安全
     sys.exit(1) # システムを終了
 
 
+user_doc_cache = UserDocCache(maxsize=USER_DOC_CACHE_MAXSIZE, ttl=USER_DOC_CACHE_TTL)
+# PostgreSQL 以外では NOTIFY が使えないので、各プロセスのキャッシュは TTL で更新される
+USE_PG_INVALIDATION = USER_DOC_CACHE_INVALIDATION == 'postgres' and engine.dialect.name == 'postgresql'
+cache_invalidation_listener = PgInvalidationListener(engine, user_doc_cache) if USE_PG_INVALIDATION else None
+image_processor = ImageProcessor()
+webhook_dedup = WebhookEventDeduplicator(
+    maxsize=WEBHOOK_DEDUP_MAXSIZE,
+    ttl=WEBHOOK_DEDUP_TTL,
+    engine=engine if WEBHOOK_DEDUP_STORE == 'database' else None,
+    lease=WEBHOOK_DEDUP_LEASE,
+) if WEBHOOK_DEDUP_ENABLED else None
+upload_sessions = UploadSessionStore(engine) if DRIVE_RESUMABLE_SESSIONS_ENABLED else None
+doc_outbox_drainer = DocOutboxDrainer(SessionLocal, engine, append_to_document) if DOC_OUTBOX_ENABLED else None
+
+# ハンドラ (ワーカースレッド) から非同期クライアントを使うためのイベントループ
+_main_loop = None
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global _main_loop
+    _main_loop = asyncio.get_running_loop()
+    # 起動時に LINE クライアントを作成しておき、以降のリクエストではコネクションを使い回す
+    if STARTUP_WARMUP_ENABLED:
+        # yield の後でポートが開くので、重い準備はバックグラウンドで行い最初のリクエストを待たせない
+        threading.Thread(target=_warm_up, name="startup-warmup", daemon=True).start()
+    else:
+        with _startup_phase('line_client'):
+            line_clients.messaging_api
+    if WEBHOOK_QUEUE_ENABLED:
+        work_queue.start()
+    if cache_invalidation_listener:
+        cache_invalidation_listener.start()
+    if doc_outbox_drainer:
+        doc_outbox_drainer.start()
+    _record_startup_phase('ready', time.perf_counter() - _STARTUP_STARTED)
+    yield
+    # 以下の待ちはすべて 1 つの期限 (SHUTDOWN_TIMEOUT) の中で行い、gunicorn に強制終了される前に終える
+    shutdown_deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+
+    def remaining() -> float:
+        return max(0.0, shutdown_deadline - time.monotonic())
+
+    if cache_invalidation_listener:
+        await run_in_threadpool(cache_invalidation_listener.stop)
+    if WEBHOOK_QUEUE_ENABLED:
+        # 受け付け済みのイベントを取りこぼさないよう、処理し終えてから停止する
+        await run_in_threadpool(work_queue.stop, True, min(WEBHOOK_QUEUE_DRAIN_TIMEOUT, remaining()))
+    if not await run_in_threadpool(event_executor.shutdown, True, remaining()):
+        logger.warning('Timed out waiting for in-flight webhook events at shutdown.')
+    if doc_outbox_drainer:
+        # 反映中の追記だけ終わらせる (未反映の行は DB に残り、次回の起動時に反映される)
+        await run_in_threadpool(doc_outbox_drainer.stop, remaining())
+    # バックグラウンドでためている Drive の共有設定を送り切ってから終了する
+    await run_in_threadpool(flush_pending_permissions, remaining())
+    await async_google_client.aclose()
+    await line_clients.aclose()
+    line_clients.close()
+    await dispose_async_engine()
+    await run_in_threadpool(image_processor.shutdown)
+    _main_loop = None
+
+
 # FastAPI アプリケーションの初期化
-app = FastAPI()
-# LINE WebhookHandler の初期化
-handler = WebhookHandler(LINE_CHANNEL_SECRET) # ★ ここでLINE_CHANNEL_SECRETを使用
-# LINE Messaging API Configuration の初期化
-configuration = Configuration(access_token=LINE_CHANNEL_ACCESS_TOKEN)
+app = FastAPI(lifespan=lifespan)
+# Webhook の署名検証とイベントの読み込み
+webhook_verifier = WebhookVerifier(LINE_CHANNEL_SECRET)
+# LINE Messaging API クライアントの初期化 (実際の接続はライフスパン開始時に作成)
+line_clients = LineClientManager(LINE_CHANNEL_ACCESS_TOKEN)
 
 # ドキュメントIDを設定するコマンドのプレフィックス
 SET_DOC_COMMAND_PREFIX = "!setdoc "
-# GoogleドキュメントIDの正規表現 (簡易的なチェック)
-DOC_ID_REGEX = r"^[a-zA-Z0-9_-]{20,}$" # 少なくとも20文字以上など、もう少し厳密に
+# 追記した内容を検索するコマンドのプレフィックス
+SEARCH_COMMAND_PREFIX = "!search "
+# 検索結果に表示する 1 件あたりの最大文字数
+SEARCH_SNIPPET_LENGTH = 100
 
 
 # Webhook エンドポイント
+def _invalid_signature_response(body: bytes):
+    logger.warning('Invalid LINE signature received (%d bytes).', len(body))
+
+    # --- ★ Webhook検証ツール対応の追加 ★ ---
+    # Webhook検証ツールからのリクエストは、通常、空のボディを持つ ({})
+    # body が空、または非常に短い場合（例: 20バイト未満）を検証ツールと判断する
+    # '{}\n' のようなボディでも対応できるように、少し余裕を持たせる
+    if not body or len(body) < 20:
+        logger.debug('Invalid signature detected with empty or short body (%s bytes). Assuming Webhook verification request. Returning 200 OK.', len(body))
+        return "OK" # 検証ツールからの場合は200 OKを返す
+    # --- ★ 追加終了 ★ ---
+
+    # 検証ツールからのリクエストでなければ、400を返す
+    logger.debug('Invalid signature detected with non-short body. Treating as potential malicious request.')
+    raise HTTPException(status_code=400, detail="Invalid LINE signature.")
+
+
 # main.py の @app.post("/callback") 関数を以下のように修正
 
 @app.post("/callback")
 async def callback(request: Request):
     signature = request.headers.get("X-Line-Signature", "")
-    body = await request.body() # body は bytes 型
+    try:
+        # 上限を超えるボディは読み切る前に断る
+        body = await read_body(request)
+    except BodyTooLargeError as e:
+        logger.warning('Rejecting oversized webhook request: %s', e)
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail="Request body too large.")
 
-    print(f"DEBUG: Received webhook request.", file=sys.stderr)
-    print(f"DEBUG: X-Line-Signature header: {signature}", file=sys.stderr)
-    # ★ 追加: リクエストボディの長さをログ出力
-    print(f"DEBUG: Request body length: {len(body)} bytes.", file=sys.stderr)
-    print(f"DEBUG: Request body (bytes, first 200 chars): {body[:200]}...", file=sys.stderr)
-    print(f"DEBUG: Handler is using LINE_CHANNEL_SECRET with length: {len(LINE_CHANNEL_SECRET) if LINE_CHANNEL_SECRET else 0}", file=sys.stderr)
+    # 署名やボディの内容はログに出さない (長さのみ)
+    logger.debug('Received webhook request (%d bytes).', len(body))
 
     try:
-        # 修正箇所: bodyが空の場合のdecodeエラー回避 (handler.handleが空文字列を許容する前提)
-        body_str = body.decode('utf-8') if body else ""
-        print(f"DEBUG: Decoded body (first 200 chars): {body_str[:200]}...", file=sys.stderr)
-        handler.handle(body_str, signature) # 修正済みのbody_strを渡す
-        print("DEBUG: Webhook handler processed successfully (no signature error).", file=sys.stderr) # 署名検証成功時のログ
+        # 署名は受け取ったバイト列のまま検証し、JSON は 1 回だけ読み込む (ハンドラの処理とは別に時間を計測する)
+        with observe_stage('signature_verify', 'webhook'):
+            if not webhook_verifier.verify(body, signature):
+                return _invalid_signature_response(body)
+            try:
+                events = webhook_verifier.parse(body)
+            except ValueError:
+                logger.warning('Malformed webhook body (%d bytes).', len(body))
+                raise HTTPException(status_code=400, detail="Malformed webhook body.")
+
+        if WEBHOOK_QUEUE_ENABLED:
+            # イベント処理はワーカーに任せてすぐに応答する
+            for event in events:
+                accepted = work_queue.submit(event, timeout=0) or await run_in_threadpool(
+                    work_queue.submit, event, WEBHOOK_QUEUE_PUT_TIMEOUT
+                )
+                if not accepted:
+                    logger.warning('Webhook queue is full (depth: %s). Rejecting delivery with 503.', work_queue.depth())
+                    raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Webhook queue is full.")
+            logger.debug('Enqueued %s events. Queue depth: %s', len(events), work_queue.depth())
+            return "OK"
+
+        # ハンドラは同期処理 (Google/LINE API 呼び出し) を含むため、イベントループを止めないようスレッドで実行する
+        # 別々のユーザーのイベントは並行に、同じユーザーのイベントは届いた順に処理する
+        await _prefetch_user_doc_ids(events)
+        await _dispatch_events(events)
+        logger.debug('Webhook handler processed successfully (no signature error).')  # 署名検証成功時のログ
         return "OK" # 正常処理の場合は200 OKを返す
 
-    except linebot.v3.exceptions.InvalidSignatureError as e:
-        print(f"ERROR: !!! Invalid LINE signature received !!!", file=sys.stderr)
-        print(f"ERROR: {type(e).__name__}: {e}", file=sys.stderr)
-        print(f"DEBUG: Received signature: {signature}", file=sys.stderr)
-        print(f"DEBUG: Configured secret length used by handler: {len(LINE_CHANNEL_SECRET) if LINE_CHANNEL_SECRET else 0}", file=sys.stderr)
-
-        # --- ★ Webhook検証ツール対応の追加 ★ ---
-        # Webhook検証ツールからのリクエストは、通常、空のボディを持つ ({})
-        # body_str が空、または非常に短い場合（例: 20バイト未満）を検証ツールと判断する
-        # '{}\n' のようなボディでも対応できるように、少し余裕を持たせる
-        if not body_str or len(body_str) < 20:
-            print(f"DEBUG: Invalid signature detected with empty or short body ({len(body_str)} chars). Assuming Webhook verification request. Returning 200 OK.", file=sys.stderr)
-            return "OK" # 検証ツールからの場合は200 OKを返す
-        # --- ★ 追加終了 ★ ---
-
-        # 検証ツールからのリクエストでなければ、本来のInvalidSignatureErrorとして400を返す
-        print("DEBUG: Invalid signature detected with non-short body. Treating as potential malicious request.", file=sys.stderr)
-        raise HTTPException(status_code=400, detail="Invalid LINE signature.")
-
     except HTTPException as e:
          # FastAPI's HTTPExceptionはそのまま再raise
-         print(f"DEBUG: Caught FastAPI HTTPException in callback: {e.detail} (Status: {e.status_code})", file=sys.stderr)
+         logger.debug('Caught FastAPI HTTPException in callback: %s (Status: %s)', e.detail, e.status_code)
          raise e
 
-    except linebot.v3.exceptions.LineBotApiError as e:
-         print(f"ERROR: LINE API Error during webhook processing. Status: {e.status_code}, Message: {e.message}", file=sys.stderr)
-         traceback.print_exc(file=sys.stderr)
-         raise HTTPException(status_code=500, detail=f"LINE API Error during processing: {e.status_code} - {e.message}")
-
     except Exception as e:
-        print(f"CRITICAL: Unexpected error during webhook processing: {type(e).__name__}: {e}", file=sys.stderr)
-        traceback.print_exc(file=sys.stderr)
+        logger.exception('Unexpected error during webhook processing: %s: %s', type(e).__name__, e)
         raise HTTPException(status_code=500, detail=f"Internal server error: {type(e).__name__}")
 
 from fastapi import Response
@@ -162,89 +390,312 @@ from fastapi import Response
 async def root(response: Response):
     return {"message": "OK"}
 
-# メッセージハンドラ内でデータベースセッションを使用するためのヘルパー関数
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+# /metrics と /stats の値は、リクエストを受けたワーカープロセスのもの (worker に PID を出す)
+@app.get("/metrics")
+async def metrics():
+    return Response(content=REGISTRY.exposition(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/stats")
+async def stats():
+    return {
+        "worker": worker_id(),
+        "webhook_queue": work_queue.stats(),
+        "user_doc_cache": user_doc_cache.stats(),
+        "webhook_dedup": webhook_dedup.stats() if webhook_dedup else None,
+        "startup": startup_phases,
+    }
 
 # ユーザーIDに紐づくGoogleドキュメントIDを取得
-def get_user_doc_id(user_id: str, db) -> str | None:
+# 読み込みだけなので ORM のセッションは使わず、Core のクエリで 1 列だけ取得する
+def get_user_doc_id(user_id: str) -> str | None:
+    # キャッシュにあればデータベースには問い合わせない
+    doc_id = user_doc_cache.get(user_id)
+    if doc_id is not None:
+        return doc_id
     try:
-        mapping = db.query(UserDocMapping).filter(UserDocMapping.user_id == user_id).first()
-        return mapping.doc_id if mapping else None
+        with observe_stage('db_lookup'):
+            doc_id = fetch_doc_id(user_id)
+        if doc_id:
+            user_doc_cache.set(user_id, doc_id)
+        return doc_id
     except Exception as e:
-        print(f"Database error getting doc_id for user {user_id}: {e}", file=sys.stderr)
+        logger.error('Database error getting doc_id for user %s: %s', user_id, e)
         raise
 
 # ユーザーIDにGoogleドキュメントIDを設定
 def set_user_doc_id(user_id: str, doc_id: str, db):
     try:
-        mapping = db.query(UserDocMapping).filter(UserDocMapping.user_id == user_id).first()
-        if mapping:
-            mapping.doc_id = doc_id
-        else:
-            mapping = UserDocMapping(user_id=user_id, doc_id=doc_id)
-            db.add(mapping)
+        # SELECT してから UPDATE / INSERT すると同時の !setdoc が競合するので、1 文で登録・更新する
+        upsert_doc_mappings(db, [(user_id, doc_id)])
+        if USE_PG_INVALIDATION:
+            publish_invalidation(db, user_id)
         db.commit()
-        print(f"Successfully set doc_id '{doc_id}' for user {user_id}.", file=sys.stderr)
+        # ライトスルー: このプロセスのキャッシュも更新する
+        user_doc_cache.set(user_id, doc_id)
+        logger.info("Successfully set doc_id '%s' for user %s.", doc_id, user_id)
     except Exception as e:
-        print(f"Database error setting doc_id for user {user_id} to '{doc_id}': {e}", file=sys.stderr)
+        logger.error("Database error setting doc_id for user %s to '%s': %s", user_id, doc_id, e)
         db.rollback()
         raise
 
 
-@handler.add(MessageEvent, message=TextMessageContent)
-def handle_text(event: MessageEvent):
+# アップロード済みメディアを SHA-256 で検索
+def find_media_blob(sha256: str, db) -> MediaBlob | None:
+    try:
+        return db.query(MediaBlob).filter(MediaBlob.sha256 == sha256).first()
+    except Exception as e:
+        logger.error('Database error looking up media blob %s...: %s', sha256[:12], e)
+        raise
+
+# アップロードしたメディアの SHA-256 と Drive のファイルを記録
+def save_media_blob(db, **fields):
+    try:
+        db.add(MediaBlob(**fields))
+        db.commit()
+    except IntegrityError:
+        # 同じメディアを別のリクエストが同時にアップロードして先に記録した場合
+        db.rollback()
+    except Exception as e:
+        # 記録に失敗しても、アップロード自体は成功しているので処理は続行する
+        logger.error('Database error saving media blob %s...: %s', fields.get('sha256', '')[:12], e)
+        db.rollback()
+
+
+# 共有設定の結果が分かった時点で呼ばれる (background モードでは batch を送ったスレッドから)。
+# 共有できたファイルだけを記録し、共有できなかったファイルは重複判定で使い回さない
+def _record_shared_media_blob(shared: bool, **fields):
+    if not shared:
+        logger.warning('Sharing failed for Drive file %s. Not reusing it for duplicate media.', fields.get('file_id'))
+        return
+    db = SessionLocal()
+    try:
+        save_media_blob(db, **fields)
+    finally:
+        db.close()
+
+
+# LINE のメディアを取得して Drive に保存し、(file_id, direct_link, webview_link, ファイル名, MIME タイプ) を返す
+# kind は "image" / "video" (ファイル名の接頭辞に使う)
+def _store_media(message_id: str, kind: str, mime_type: str, db):
+    logger.debug('Attempting to get %s content for ID: %s', kind, message_id)
+    is_image = kind == 'image'
+    process_image = is_image and image_processor.enabled
+    image_size = None
+    # コンテンツは全体をメモリに載せず、チャンク単位で読みながら処理する
+    with line_clients.open_message_content(message_id) as content:
+        # Content-Type ヘッダーから実際の MIME タイプを取得 (取得できなければ推測値を使う)
+        mime_type = content.mime_type or mime_type
+        logger.debug('Streaming %s content for ID: %s (Content-Length: %s, MIME type: %s)', kind, message_id, content.content_length, mime_type)
+
+        if not MEDIA_DEDUP_ENABLED and not process_image:
+            chunks = content.iter_chunks()
+            if is_image:
+                # 先頭のチャンクから実際の形式と大きさを判定する
+                first = next(chunks, b'')
+                sniffed_mime, image_size = sniff_image(first)
+                mime_type = sniffed_mime or mime_type
+                chunks = itertools.chain([first], chunks)
+            fname = _media_file_name(kind, message_id, mime_type)
+            logger.debug('Attempting to upload %s to Drive: %s', kind, fname)
+            # ダウンロードとアップロードが並行して進むので、まとめて 1 つのステージとして計測する
+            with observe_stage('line_download_drive_upload'):
+                file_id, direct_link, webview_link = _upload_stream_to_drive(
+                    chunks, fname, mime_type, size=content.content_length, resume_key=f"{kind}:{message_id}"
+                )
+            logger.info('Successfully streamed %s bytes of %s content for ID: %s to Drive.', content.bytes_read, kind, message_id)
+            remember_image_size(direct_link or webview_link, image_size)
+            return file_id, direct_link, webview_link, fname, mime_type
+
+        # 重複判定のため、一時ファイルに書き出しながら SHA-256 を計算する (重複判定のキーは元の画像の内容)
+        with observe_stage('line_download'):
+            spool, digest, size = spool_and_hash(content.iter_chunks())
+
+    with spool:
+        if is_image:
+            sniffed_mime, image_size = sniff_image(spool.read(SNIFF_SIZE))
+            spool.seek(0)
+            mime_type = sniffed_mime or mime_type
+
+        blob = find_media_blob(digest, db) if MEDIA_DEDUP_ENABLED else None
+        if blob:
+            # 同じ内容のメディアはアップロード済みなので、アップロードと共有設定を省いて既存のファイルを使う
+            logger.info('Duplicate %s content for ID: %s (sha256: %s...). Reusing Drive file %s.', kind, message_id, digest[:12], blob.file_id)
+            remember_image_size(blob.direct_link or blob.webview_link, image_size)
+            return blob.file_id, blob.direct_link, blob.webview_link, blob.file_name, blob.mime_type
+
+        processed = None
+        if process_image:
+            # 縮小・再エンコードは別プロセスで行う (このスレッドは結果を待つだけ)
+            with observe_stage('image_process'):
+                processed = image_processor.process(spool.read())
+            spool.seek(0)
+        if processed:
+            data, mime_type, image_size = processed
+            logger.debug('Resized image %s: %d -> %d bytes (%dx%d).', message_id, size, len(data), *image_size)
+            chunks, upload_size = iter([data]), len(data)
+        else:
+            chunks, upload_size = iter_file(spool), size
+
+        fname = _media_file_name(kind, message_id, mime_type)
+        logger.debug('Attempting to upload %s to Drive: %s', kind, fname)
+        # 共有設定が済んだかは、アップロードの後 (background モードではさらに後) に分かる
+        sharing = Future() if MEDIA_DEDUP_ENABLED else None
+        with observe_stage('drive_upload'):
+            # 縮小・再エンコードしたデータは同じバイト列になるとは限らないので、続きから送るのは元のデータだけ
+            file_id, direct_link, webview_link = _upload_stream_to_drive(
+                chunks, fname, mime_type, size=upload_size, resume_key=None if processed else f"{kind}:{message_id}",
+                on_shared=sharing.set_result if sharing else None,
+            )
+        logger.info('Successfully uploaded %s bytes of %s content for ID: %s to Drive.', upload_size, kind, message_id)
+
+    remember_image_size(direct_link or webview_link, image_size)
+    if file_id and sharing is not None:
+        # size は Drive に保存したファイルのバイト数
+        fields = dict(
+            sha256=digest, file_id=file_id, file_name=fname, mime_type=mime_type, size=upload_size,
+            direct_link=direct_link, webview_link=webview_link,
+        )
+        sharing.add_done_callback(lambda f: _record_shared_media_blob(f.result(), **fields))
+    return file_id, direct_link, webview_link, fname, mime_type
+
+
+def _media_file_name(kind: str, message_id: str, mime_type: str) -> str:
+    # ファイル名にはタイムスタンプを残しておきます（管理のため）
+    timestamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+    ext = mime_type.split('/')[-1] if '/' in mime_type else 'bin'
+    return f"line_{kind}_{timestamp}_{message_id}.{ext}"
+
+
+# Google API 呼び出しの入口。非同期クライアントが有効なら、イベントループ上で実行して結果を待つ
+# (多数のハンドラの Google I/O を 1 つのイベントループと共有コネクションプールでまとめて処理できる)
+def _send_google_doc(document_id: str, text=None, image_uri=None):
+    with observe_stage('docs_write'):
+        # 追記をまとめる場合は DocWriteBuffer を通すため、同期クライアントを使う
+        if GOOGLE_ASYNC_CLIENT_ENABLED and _main_loop is not None and DOCS_BATCH_WINDOW_MS <= 0:
+            coro = send_google_doc_async(document_id, text=text, image_uri=image_uri)
+            return asyncio.run_coroutine_threadsafe(coro, _main_loop).result()
+        return send_google_doc(document_id=document_id, text=text, image_uri=image_uri)
+
+
+# ドキュメントへの追記の入口。アウトボックスが有効なら DB に記録するだけで、反映はバックグラウンドで行う
+def _write_to_doc(document_id: str, db, text=None, image_uri=None, user_id: str | None = None) -> str:
+    if doc_outbox_drainer is None:
+        doc_url = _send_google_doc(document_id=document_id, text=text, image_uri=image_uri)
+    else:
+        with observe_stage('outbox_enqueue'):
+            enqueue_doc_write(db, document_id, text=text, image_uri=image_uri, user_id=user_id)
+        doc_outbox_drainer.wake()
+        doc_url = f"https://docs.google.com/document/d/{document_id}/edit"
+    _record_note(document_id, db, text=text, image_uri=image_uri, user_id=user_id)
+    return doc_url
+
+
+def _record_note(document_id: str, db, text=None, image_uri=None, user_id: str | None = None):
+    # 検索用の控え。記録できなくても追記自体は済んでいるので、警告だけ出す
+    if not NOTE_INDEX_ENABLED or not user_id:
+        return
+    try:
+        with observe_stage('note_index'):
+            record_note(db, document_id, user_id, text=text, image_uri=image_uri)
+    except Exception as e:
+        db.rollback()
+        logger.warning('Failed to record note for user %s (doc: %s): %s', user_id, document_id, e)
+
+
+def _search_reply(user_id: str, query: str, db) -> str:
+    if not NOTE_INDEX_ENABLED:
+        return "検索機能は無効になっています。"
+    if not query:
+        return f"検索する語を指定してください。\n例: `{SEARCH_COMMAND_PREFIX}会議 メモ`"
+    with observe_stage('note_search'):
+        results = search_notes(db, user_id, query, limit=NOTE_SEARCH_LIMIT)
+    if not results:
+        return f"「{query}」に一致するメモは見つかりませんでした。"
+    lines = [f"「{query}」の検索結果 (新しい順に {len(results)} 件):"]
+    for created_at, note_text, image_uri in results:
+        snippet = (note_text or f"画像: {image_uri}").strip().replace("\n", " ")
+        if len(snippet) > SEARCH_SNIPPET_LENGTH:
+            snippet = snippet[:SEARCH_SNIPPET_LENGTH] + "…"
+        lines.append(f"\n{created_at:%Y-%m-%d} {snippet}")
+    return "\n".join(lines)
+
+
+# resume_key はアップロード元のメッセージの識別子。同じ resume_key で途中まで送ったセッションがあれば続きから送る
+# (非同期クライアントでは続きから送る処理は行わない)
+def _upload_stream_to_drive(chunks, file_name: str, mime_type: str, size: int | None = None, resume_key: str | None = None,
+                            on_shared=None):
+    if GOOGLE_ASYNC_CLIENT_ENABLED and _main_loop is not None:
+        coro = upload_file_to_drive_async(chunks, file_name, mime_type, size=size, on_shared=on_shared)
+        return asyncio.run_coroutine_threadsafe(coro, _main_loop).result()
+    return upload_stream_to_drive(chunks, file_name, mime_type, size=size, resume_key=resume_key, sessions=upload_sessions,
+                                  on_shared=on_shared)
+
+
+@instrument_event('text')
+def handle_text(event: WebhookEvent):
     user_id = event.source.user_id
     user_text = event.message.text
     reply_token = event.reply_token
     reply = ""
+    ok = True  # 失敗をエラー返信で伝えた場合は False を返し、LINE の再送で処理し直せるようにする
 
     db = None
     try:
-        db = next(get_db())
+        db = SessionLocal()
 
         if user_text.startswith(SET_DOC_COMMAND_PREFIX):
             doc_id_candidate = user_text[len(SET_DOC_COMMAND_PREFIX):].strip()
-            print(f"User {user_id} attempting to set doc ID: '{doc_id_candidate}'", file=sys.stderr)
+            logger.info("User %s attempting to set doc ID: '%s'", user_id, doc_id_candidate)
 
             if re.fullmatch(DOC_ID_REGEX, doc_id_candidate):
                  try:
                      set_user_doc_id(user_id, doc_id_candidate, db)
                      reply = f"ドキュメントID '{doc_id_candidate}' をあなたの設定として保存しました！\nこれからはこのドキュメントにメモを追記します。"
                  except Exception as e:
-                     print(f"Database error setting doc_id for user {user_id}: {e}", file=sys.stderr)
+                     ok = False
+                     logger.error('Database error setting doc_id for user %s: %s', user_id, e)
                      reply = f"ドキュメントIDの設定中にデータベースエラーが発生しました。\nエラー詳細: {type(e).__name__}"
             else:
                  reply = f"無効なドキュメントIDの形式です。\nドキュメントIDは通常URLの`/.../d/YOUR_ID/.../` の `YOUR_ID` の部分です。\n例: `!setdoc abcdefghijklmnopqrstuvwxyz1234567890`"
 
             _reply_line(reply_token, reply)
-            return
+            return ok
+
+        if user_text.startswith(SEARCH_COMMAND_PREFIX) or user_text.strip() == SEARCH_COMMAND_PREFIX.strip():
+            # 検索は DB の控えだけで答え、Google には問い合わせない
+            query = user_text[len(SEARCH_COMMAND_PREFIX):].strip()
+            logger.info("User %s searching notes (%d terms).", user_id, len(query.split()))
+            try:
+                reply = _search_reply(user_id, query, db)
+            except Exception as e:
+                ok = False
+                logger.error('Database error searching notes for user %s: %s', user_id, e)
+                reply = f"検索中にデータベースエラーが発生しました。\nエラー詳細: {type(e).__name__}"
+            _reply_line(reply_token, reply)
+            return ok
 
-        print(f"User {user_id} sent text message. Checking for doc ID...", file=sys.stderr)
-        doc_id = get_user_doc_id(user_id, db)
+        logger.debug('User %s sent text message. Checking for doc ID...', user_id)
+        doc_id = get_user_doc_id(user_id)
 
         if not doc_id:
             reply = f"ドキュメントが設定されていません。\n書き込みたいGoogleドキュメントIDを `!setdoc [ドキュメントID]` コマンドで指定してください。"
             _reply_line(reply_token, reply)
-            return
+            return ok
 
-        print(f"Doc ID {doc_id} found for user {user_id}. Attempting to write text.", file=sys.stderr)
+        logger.debug('Doc ID %s found for user %s. Attempting to write text.', doc_id, user_id)
         try:
             # 追記するテキストはユーザーの入力そのものにする (タイムスタンプ削除済み)
             text_to_append = user_text
-            print(f"Appending text: '{text_to_append}' to doc '{doc_id}'", file=sys.stderr) # デバッグログ
+            logger.debug('Appending %d chars of text to doc %s', len(text_to_append), doc_id)
 
             # send_google_doc 関数に新しいテキストを渡す
             # send_google_doc 側で、テキストの前に改行を入れる処理を試みます。
-            doc_url = send_google_doc(document_id=doc_id, text=text_to_append)
+            doc_url = _write_to_doc(doc_id, db, text=text_to_append, user_id=user_id)
 
             reply = f"メッセージをドキュメントに追記しました！\n編集: {doc_url}"
         except (ValueError, PermissionError, RuntimeError, HttpError) as e:
-            print(f"Docs Text Write Error for user {user_id} (doc: {doc_id}): {e}", file=sys.stderr)
+            ok = False
+            logger.error('Docs Text Write Error for user %s (doc: %s): %s', user_id, doc_id, e)
             if isinstance(e, ValueError):
                  # Google Doc with ID '{document_id}' not found. Check the ID.
                  # Google Docs API rejected the update request (Status 400). Error details: ...
@@ -258,81 +709,71 @@ def handle_text(event: MessageEvent):
             elif isinstance(e, HttpError):
                  reply = f"ドキュメントへの書き込み中にGoogle Docs APIエラーが発生しました。\nエラーコード: {e.resp.status}"
                  if e.content:
-                     print(f"HTTP Error Response Body: {e.content.decode('utf-8', errors='ignore')}", file=sys.stderr)
+                     logger.debug('HTTP Error Response Body: %r', e.content[:500])
             else:
                  reply = f"ドキュメントへの書き込み中にエラーが発生しました。\nエラー詳細: {type(e).__name__}"
         except Exception as e:
-            print(f"Unexpected Error in send_google_doc (text) for user {user_id} (doc: {doc_id}): {e}", file=sys.stderr)
-            traceback.print_exc(file=sys.stderr) # 予期しないエラーのトレースバックを出力
+            ok = False
+            logger.exception('Unexpected Error in send_google_doc (text) for user %s (doc: %s): %s', user_id, doc_id, e)
             reply = f"ドキュメントへの書き込み中に予期しないエラーが発生しました。\nエラー詳細: {type(e).__name__}"
 
         _reply_line(reply_token, reply)
+        return ok
 
     except Exception as e:
-        print(f"Unexpected top-level error in handle_text for user {user_id}: {e}", file=sys.stderr)
-        traceback.print_exc(file=sys.stderr) # トップレベルエラーのトレースバックもログ出力
+        logger.exception('Unexpected top-level error in handle_text for user %s: %s', user_id, e)
         _reply_line(reply_token, f"メッセージ処理中に予期しないエラーが発生しました。\nエラー詳細: {type(e).__name__}")
+        return False
     finally:
         if db:
             db.close()
 
 
-@handler.add(MessageEvent, message=ImageMessageContent)
-def handle_image(event: MessageEvent):
+@instrument_event('image')
+def handle_image(event: WebhookEvent):
     user_id = event.source.user_id
     image_id = event.message.id
     reply_token = event.reply_token
-    mime_type = "image/jpeg" # 推測値、実際はContent-Typeヘッダーから取得が望ましい
+    mime_type = "image/jpeg" # 推測値 (Content-Type ヘッダーや画像の先頭バイトから判定できなかった場合に使う)
     reply = ""
+    ok = True
 
     db = None
     try:
-        db = next(get_db())
-        print(f"User {user_id} sent image message (ID: {image_id}). Checking for doc ID...", file=sys.stderr)
-        doc_id = get_user_doc_id(user_id, db)
+        db = SessionLocal()
+        logger.debug('User %s sent image message (ID: %s). Checking for doc ID...', user_id, image_id)
+        doc_id = get_user_doc_id(user_id)
 
         if not doc_id:
             reply = f"ドキュメントが設定されていません。\n画像を貼り付けたいGoogleドキュメントIDを `!setdoc [ドキュメントID]` コマンドで指定してください。"
             _reply_line(reply_token, reply)
-            return
+            return ok
 
-        print(f"Doc ID {doc_id} found for user {user_id}. Attempting to process image.", file=sys.stderr)
+        logger.debug('Doc ID %s found for user %s. Attempting to process image.', doc_id, user_id)
         try:
-            print(f"Attempting to get image content for ID: {image_id}", file=sys.stderr)
-            with ApiClient(configuration) as api_client:
-                blob_api = MessagingApiBlob(api_client)
-                # get_message_content は bytes を返します
-                # 正確なMIMEタイプを取得するには get_message_content_with_http_info を使う
-                # resp = blob_api.get_message_content_with_http_info(message_id=image_id)
-                # image_data = resp.data
-                # actual_mime_type = resp.headers.get('Content-Type', mime_type) # ヘッダーから取得
-                image_data = blob_api.get_message_content(message_id=image_id) # 簡単化のためBytesのみ取得
-            print(f"Successfully got {len(image_data)} bytes of image content for ID: {image_id}. Assumed MIME type: {mime_type}", file=sys.stderr)
-
-
-            # ファイル名にはタイムスタンプを残しておきます（管理のため）
-            # datetime モジュールは handle_image 関数内でもファイル名生成に使われているため、削除しませんでした。
-            timestamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
-            ext = mime_type.split('/')[-1] if '/' in mime_type else 'bin'
-            fname = f"line_image_{timestamp}_{image_id}.{ext}"
-            print(f"Attempting to upload image to Drive: {fname}", file=sys.stderr)
-            file_id, direct_link, webview_link = upload_file_to_drive(image_data, fname, mime_type)
+            file_id, direct_link, webview_link, fname, mime_type = _store_media(image_id, "image", mime_type, db)
 
             if not direct_link and not webview_link:
                  raise RuntimeError(f"Google Drive upload succeeded but no usable link (webContentLink or webViewLink) was obtained for file ID: {file_id or 'N/A'}")
 
             image_uri_to_embed = direct_link if direct_link else webview_link # どちらか取得できた方を使う
-            print(f"Attempting to send image to Docs (doc: {doc_id}) via URI: {image_uri_to_embed}", file=sys.stderr)
+            # Docs が画像を取得できるよう、共有設定をバックグラウンドで行っている場合は反映を待つ
+            with observe_stage('drive_sharing_wait'):
+                shared = wait_for_sharing(file_id, timeout=30)
+            if not shared:
+                logger.warning('Sharing for image file %s is not confirmed. Docs may fail to fetch the image.', file_id)
+            logger.debug('Attempting to send image to Docs (doc: %s) via URI: %s', doc_id, image_uri_to_embed)
 
             # send_google_doc 関数に画像URIを渡す。send_google_doc 側で、画像の前に改行を入れる処理を試みます。
-            doc_url = send_google_doc(document_id=doc_id, image_uri=image_uri_to_embed)
-            print(f"Successfully sent image to Docs. Doc URL: {doc_url}", file=sys.stderr)
+            doc_url = _write_to_doc(doc_id, db, image_uri=image_uri_to_embed, user_id=user_id)
+            logger.info('Successfully sent image to Docs. Doc URL: %s', doc_url)
 
             image_access_link = webview_link if webview_link else file_id
             reply = f"画像をドキュメントに貼り付けました！\n編集: {doc_url}\n画像リンク: {image_access_link}"
 
         except (ValueError, PermissionError, RuntimeError, HttpError) as e:
-            print(f"Image Handling Error for user {user_id} (doc: {doc_id}, image: {image_id}): {e}", file=sys.stderr)
+            ok = False
+            logger.error('Image Handling Error for user %s (doc: %s, image: %s): %s', user_id, doc_id, image_id, e)
             if isinstance(e, ValueError):
                  reply_msg = f"画像の処理に失敗しました。\nエラー: {e}"
                  if isinstance(e, HttpError) and e.resp.status == 400 and e.content:
@@ -343,79 +784,69 @@ def handle_image(event: MessageEvent):
             elif isinstance(e, HttpError):
                  reply = f"画像処理中にGoogle APIエラーが発生しました。\nエラーコード: {e.resp.status}"
                  if e.content:
-                     print(f"HTTP Error Response Body: {e.content.decode('utf-8', errors='ignore')}", file=sys.stderr)
+                     logger.debug('HTTP Error Response Body: %r', e.content[:500])
             elif isinstance(e, RuntimeError) and "obtain usable link" in str(e):
                  reply = f"画像をGoogle Driveにアップロードしましたが、リンクの取得に失敗しました。サービスアカウントの共有設定をご確認ください。"
             else:
                  reply = f"画像の処理中にエラーが発生しました。\nエラー詳細: {type(e).__name__}"
         except Exception as e:
-            print(f"Unexpected Error in handle_image for user {user_id} (doc: {doc_id}, image: {image_id}): {e}", file=sys.stderr)
-            traceback.print_exc(file=sys.stderr)
+            ok = False
+            logger.exception('Unexpected Error in handle_image for user %s (doc: %s, image: %s): %s', user_id, doc_id, image_id, e)
             reply = f"画像処理中に予期しないエラーが発生しました。\nエラー詳細: {type(e).__name__}"
 
         _reply_line(reply_token, reply)
+        return ok
 
     except Exception as e:
-        print(f"Unexpected top-level error in handle_image for user {user_id}: {e}", file=sys.stderr)
-        traceback.print_exc(file=sys.stderr)
+        logger.exception('Unexpected top-level error in handle_image for user %s: %s', user_id, e)
         _reply_line(reply_token, f"画像処理中に予期しないエラーが発生しました。\nエラー詳細: {type(e).__name__}")
+        return False
     finally:
         if db:
             db.close()
 
 
-@handler.add(MessageEvent, message=VideoMessageContent)
-def handle_video(event: MessageEvent):
+@instrument_event('video')
+def handle_video(event: WebhookEvent):
     user_id = event.source.user_id
     video_id = event.message.id
     reply_token = event.reply_token
     mime_type = "video/mp4" # 推測値、実際はContent-Typeヘッダーから取得が望ましい
     reply = ""
+    ok = True
 
     db = None
     try:
-        db = next(get_db())
-        print(f"User {user_id} sent video message (ID: {video_id}). Checking for doc ID...", file=sys.stderr)
-        doc_id = get_user_doc_id(user_id, db)
+        db = SessionLocal()
+        logger.debug('User %s sent video message (ID: %s). Checking for doc ID...', user_id, video_id)
+        doc_id = get_user_doc_id(user_id)
 
         if not doc_id:
             reply = f"ドキュメントが設定されていません。\n動画のリンクを追記したいGoogleドキュメントIDを `!setdoc [ドキュメントID]` コマンドで指定してください。"
             _reply_line(reply_token, reply)
-            return
+            return ok
 
-        print(f"Doc ID {doc_id} found for user {user_id}. Attempting to process video.", file=sys.stderr)
+        logger.debug('Doc ID %s found for user %s. Attempting to process video.', doc_id, user_id)
         try:
-            print(f"Attempting to get video content for ID: {video_id}", file=sys.stderr)
-            with ApiClient(configuration) as api_client:
-                blob_api = MessagingApiBlob(api_client)
-                # get_message_content は bytes を返します
-                video_data = blob_api.get_message_content(message_id=video_id)
-            print(f"Successfully got {len(video_data)} bytes of video content for ID: {video_id}. Assumed MIME type: {mime_type}", file=sys.stderr)
-
-
-            # ファイル名にはタイムスタンプを残しておきます（管理のため）
-            timestamp_file = datetime.datetime.now().strftime('%Y%m%d_%H%M%S') # handle_video 関数内でも必要なので残します
-            ext = mime_type.split('/')[-1] if '/' in mime_type else 'bin'
-            fname = f"line_video_{timestamp_file}_{video_id}.{ext}"
-            print(f"Attempting to upload video to Drive: {fname}", file=sys.stderr)
-            file_id, direct_link, webview_link = upload_file_to_drive(video_data, fname, mime_type)
+            file_id, direct_link, webview_link, fname, mime_type = _store_media(video_id, "video", mime_type, db)
 
             if not webview_link:
                  raise RuntimeError(f"Google Drive upload succeeded but webViewLink was not obtained for video file ID: {file_id or 'N/A'}.")
 
-            print(f"Attempting to send video link to Docs (doc: {doc_id})", file=sys.stderr)
+            logger.debug('Attempting to send video link to Docs (doc: %s)', doc_id)
 
             # ドキュメントに追記するテキストからタイムスタンプを削除済み
             doc_text = f"動画 ({fname}) : {webview_link}\n"
 
             # send_google_doc 関数にテキストを渡す。send_google_doc 側で、テキストの前に改行を入れる処理を試みます。
-            doc_url = send_google_doc(document_id=doc_id, text=doc_text)
-            print(f"Successfully sent video link to Docs. Doc URL: {doc_url}", file=sys.stderr)
+            doc_url = _write_to_doc(doc_id, db, text=doc_text, user_id=user_id)
+            logger.info('Successfully sent video link to Docs. Doc URL: %s', doc_url)
 
             reply = f"動画をDriveにアップロードしました！\nドキュメントにリンクを追記しました！\n編集: {doc_url}\n動画リンク: {webview_link}"
 
         except (ValueError, PermissionError, RuntimeError, HttpError) as e:
-            print(f"Video Handling Error for user {user_id} (doc: {doc_id}, video: {video_id}): {e}", file=sys.stderr)
+            ok = False
+            logger.error('Video Handling Error for user %s (doc: %s, video: %s): %s', user_id, doc_id, video_id, e)
             if isinstance(e, ValueError):
                  reply_msg = f"動画の処理に失敗しました。\nエラー: {e}"
                  if isinstance(e, HttpError) and e.resp.status == 400 and e.content:
@@ -426,89 +857,176 @@ def handle_video(event: MessageEvent):
             elif isinstance(e, HttpError):
                  reply = f"動画処理中にGoogle APIエラーが発生しました。\nエラーコード: {e.resp.status}"
                  if e.content:
-                     print(f"HTTP Error Response Body: {e.content.decode('utf-8', errors='ignore')}", file=sys.stderr)
+                     logger.debug('HTTP Error Response Body: %r', e.content[:500])
             elif isinstance(e, RuntimeError) and "webViewLink was not obtained" in str(e):
                  reply = f"動画をGoogle Driveにアップロードしましたが、閲覧リンクの取得に失敗しました。サービスアカウントの共有設定をご確認ください。"
             else:
                  reply = f"動画の処理中にエラーが発生しました。\nエラー詳細: {type(e).__name__}"
         except Exception as e:
-            print(f"Unexpected Error in handle_video for user {user_id} (doc: {doc_id}, video: {video_id}): {e}", file=sys.stderr)
-            traceback.print_exc(file=sys.stderr)
+            ok = False
+            logger.exception('Unexpected Error in handle_video for user %s (doc: %s, video: %s): %s', user_id, doc_id, video_id, e)
             reply = f"動画処理中に予期しないエラーが発生しました。\nエラー詳細: {type(e).__name__}"
 
         _reply_line(reply_token, reply)
+        return ok
 
     except Exception as e:
-        print(f"Unexpected top-level error in handle_video for user {user_id}: {e}", file=sys.stderr)
-        traceback.print_exc(file=sys.stderr)
+        logger.exception('Unexpected top-level error in handle_video for user %s: %s', user_id, e)
         _reply_line(reply_token, f"動画処理中に予期しないエラーが発生しました。\nエラー詳細: {type(e).__name__}")
+        return False
     finally:
         if db:
             db.close()
 
 
+def _warm_up():
+    # 失敗しても最初に使うときにやり直されるので、警告だけ出して続行する
+    steps = [
+        ('warmup_line_client', lambda: line_clients.messaging_api),
+        ('warmup_google', lambda: warm_up_google([('docs', 'v1', DOCS_SCOPES), ('drive', 'v3', DRIVE_SCOPES)])),
+        ('warmup_db', lambda: engine.connect().close()),
+    ]
+    for name, step in steps:
+        try:
+            with _startup_phase(name):
+                step()
+        except Exception as e:
+            logger.warning('Startup warm-up step %s failed: %s', name, e)
+    _record_startup_phase('warm', time.perf_counter() - _STARTUP_STARTED)
+
+
 def _reply_line(token: str, text: str):
+    if LINE_ASYNC_CLIENT_ENABLED and _main_loop is not None:
+        # 返信はイベントループ上の非同期クライアントで送り、完了を待つ
+        with observe_stage('line_reply'):
+            asyncio.run_coroutine_threadsafe(_reply_line_async(token, text), _main_loop).result()
+        return
     try:
-        with ApiClient(configuration) as api_client:
-            messaging_api = MessagingApi(api_client)
-            req = ReplyMessageRequest(
-                reply_token=token,
-                messages=[TextMessage(text=text)]
-            )
-            try:
+        # 共有クライアントを使うので、返信ごとに接続や TLS ハンドシェイクをやり直さない
+        messaging_api = line_clients.messaging_api
+        from linebot.v3.messaging.models import ReplyMessageRequest, TextMessage
+
+        req = ReplyMessageRequest(
+            reply_token=token,
+            messages=[TextMessage(text=text)]
+        )
+        try:
+            with observe_stage('line_reply'), observe_api_call('line', 'reply_message'):
                 messaging_api.reply_message(reply_message_request=req)
-                print(f"Successfully sent reply to token {token[:10]}...", file=sys.stderr)
-            except Exception as reply_e:
-                 print(f"Failed to send reply message to token {token[:10]}...: {reply_e}", file=sys.stderr)
+            logger.debug('Successfully sent reply to token %s...', token[:10])
+        except Exception as reply_e:
+             logger.error('Failed to send reply message to token %s...: %s', token[:10], reply_e)
 
     except Exception as e:
-        print(f"Error creating LINE API client or sending reply: {e}", file=sys.stderr)
+        logger.error('Error creating LINE API client or sending reply: %s', e)
 
 
-# FastAPI アプリケーション起動時にのみ実行される部分
-if __name__ == '__main__':
-    print("\n" + "="*50, file=sys.stderr)
-    print("INFO: Running main.py directly using 'python main.py'.", file=sys.stderr)
-    print("This execution method is primarily for local development and testing (without auto-reload).", file=sys.stderr)
-    print("="*50 + "\n", file=sys.stderr)
-
-    # PORT環境変数があればそれを使い、なければ8000をデフォルトとする
-    # これは `python main.py` で直接実行する場合のポート設定
-    port = int(os.environ.get('PORT', 8000))
-    print(f"INFO: For local 'python main.py' execution, attempting to start server on http://0.0.0.0:{port}", file=sys.stderr)
-
-    print("\n--- Local Development Server Information ---", file=sys.stderr)
-    print("1. For development with auto-reload, it's recommended to use Uvicorn CLI:", file=sys.stderr)
-    print(f"   uvicorn main:app --reload --host 0.0.0.0 --port {port}", file=sys.stderr)
-    print("   (This command respects the PORT environment variable if set, otherwise Uvicorn defaults, e.g. 8000)", file=sys.stderr)
-
-    print("\n2. If using ngrok for exposing this local server:", file=sys.stderr)
-    print(f"   - After starting the server (via 'python main.py' or Uvicorn CLI), run 'ngrok http {port}' in another terminal.", file=sys.stderr)
-    print("   - Use the ngrok HTTPS URL (e.g., https://xxxx.ngrok-free.app) for LINE Webhook settings.", file=sys.stderr)
-    
-    print("\n--- Deployment (e.g., on Fly.io) ---", file=sys.stderr)
-    print("For deploying to services like Fly.io:", file=sys.stderr)
-    print(" - The application is typically started using a command specified in your deployment configuration", file=sys.stderr)
-    print("   (e.g., 'fly.toml' [processes] section, Procfile, or Dockerfile CMD).", file=sys.stderr)
-    print(" - A common startup command for FastAPI apps is: uvicorn main:app --host 0.0.0.0 --port <PORT_NUMBER>", file=sys.stderr)
-    print("   (Where <PORT_NUMBER> is the internal port the app should listen on, e.g., 8000 or 8080).", file=sys.stderr)
-    print("   Fly.io (and similar platforms) often set a $PORT environment variable, which Uvicorn can automatically use if --port is not specified.", file=sys.stderr)
-    print(" - The 'python main.py' execution path (this __main__ block) is NOT used in such deployed environments.", file=sys.stderr)
-    print("---" + "="*38 + "---", file=sys.stderr)
+async def _reply_line_async(token: str, text: str):
+    try:
+        from linebot.v3.messaging.models import ReplyMessageRequest, TextMessage
+
+        req = ReplyMessageRequest(
+            reply_token=token,
+            messages=[TextMessage(text=text)]
+        )
+        with observe_api_call('line', 'reply_message'):
+            await line_clients.async_messaging_api.reply_message(reply_message_request=req)
+        logger.debug('Successfully sent reply to token %s...', token[:10])
+    except Exception as e:
+        logger.error('Failed to send reply message to token %s... (async): %s', token[:10], e)
+
+
+# イベントを対応するハンドラに振り分ける (キューのワーカーとインライン処理で共通)
+_MESSAGE_EVENT_HANDLERS = {
+    'text': handle_text,
+    'image': handle_image,
+    'video': handle_video,
+}
+
+def _dispatch_event(event):
+    event_id = event.webhook_event_id
+    if webhook_dedup is not None and event_id:
+        # 再送されたイベントは、ダウンロードやアップロード、返信を行う前に捨てる
+        is_redelivery = event.is_redelivery
+        if not webhook_dedup.claim(event_id, is_redelivery):
+            WEBHOOK_DUPLICATES_TOTAL.inc(redelivery=str(is_redelivery).lower())
+            logger.info('Skipping already processed webhook event %s (redelivery: %s).', event_id, is_redelivery)
+            return
+    handled = False
+    try:
+        handled = _handle_event(event)
+    finally:
+        if webhook_dedup is not None and event_id:
+            if handled:
+                webhook_dedup.complete(event_id)
+            else:
+                # 失敗したイベント (エラーを返信したものも含む) は記録から消し、LINE の再送で処理し直せるようにする
+                webhook_dedup.release(event_id)
+
+
+def _handle_event(event) -> bool:
+    # ハンドラは処理に失敗した場合 (エラーを返信した場合も含む) に False を返す
+    if event.type == 'message' and event.message is not None:
+        func = _MESSAGE_EVENT_HANDLERS.get(event.message.type)
+        if func:
+            return func(event) is not False
+    logger.debug('No handler for %s event. Skipping.', event.type)
+    return True
+
+
+async def _prefetch_user_doc_ids(events):
+    # 非同期エンジンが有効なら、キャッシュにないユーザーの doc_id を 1 回のクエリでまとめて読み込んでおく
+    if not DB_ASYNC_ENABLED:
+        return
+    user_ids = {_event_key(event) for event in events} - {None}
+    # ハンドラの get で数えるので、ここではヒット・ミスを数えない
+    missing = [user_id for user_id in user_ids if user_doc_cache.peek(user_id) is None]
+    if not missing:
+        return
+    try:
+        with observe_stage('db_lookup', 'webhook'):
+            doc_ids = await fetch_doc_ids_async(missing)
+    except Exception as e:
+        # 読み込めなくても各ハンドラが同期のクエリで取得する
+        logger.warning('Failed to prefetch doc IDs for %d users: %s', len(missing), e)
+        return
+    for user_id, doc_id in doc_ids.items():
+        user_doc_cache.set(user_id, doc_id)
+
+
+def _event_key(event):
+    # 同じユーザーのイベント (= 同じドキュメントへの追記) は順番どおりに処理する
+    return event.source.user_id if event.source is not None else None
+
+
+async def _dispatch_events(events):
+    futures = [asyncio.wrap_future(event_executor.submit(_event_key(event), _dispatch_event, event)) for event in events]
+    # すべてのイベントの処理を待ってから、最初の例外があれば送出する
+    results = await asyncio.gather(*futures, return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
 
 
+event_executor = KeyedExecutor(max_workers=WEBHOOK_DISPATCH_WORKERS)
+
+work_queue = EventWorkQueue(
+    _dispatch_event,
+    maxsize=WEBHOOK_QUEUE_MAXSIZE,
+    workers=WEBHOOK_QUEUE_WORKERS,
+    key_func=_event_key,
+)
+
+
+def preload_shared_state():
+    """gunicorn のマスタープロセス (preload_app) で呼び、fork しても安全な準備を済ませてワーカーで共有する。
+
+    モジュールの読み込み、アクセストークンの取得、discovery ドキュメントの読み込みだけを行う。
+    コネクションプールやスレッドはワーカーごとに lifespan で作る。
+    """
     try:
-        import uvicorn
-        # The uvicorn.run() call below is only for when 'python main.py' is executed directly.
-        # In deployed environments (like Fly.io), Uvicorn is typically started via a CLI command.
-        uvicorn.run(app, host='0.0.0.0', port=port)
-    except ImportError:
-        print("ERROR: 'uvicorn' is not installed. 'python main.py' requires it to run the server.", file=sys.stderr)
-        print("Please install it using: pip install uvicorn[standard]", file=sys.stderr)
-        print("Alternatively, for development, you can run directly with Uvicorn CLI:", file=sys.stderr)
-        print(f"uvicorn main:app --reload --host 0.0.0.0 --port {port}", file=sys.stderr)
+        with _startup_phase('preload'):
+            import linebot.v3.messaging  # noqa: F401
+            warm_up_google([('docs', 'v1', DOCS_SCOPES), ('drive', 'v3', DRIVE_SCOPES)])
     except Exception as e:
-        print(f"Error starting uvicorn server via 'python main.py': {e}", file=sys.stderr)
-
-if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=8000)
+        logger.warning('Preloading shared state failed; workers will load it on demand: %s', e)
@@ -0,0 +1,183 @@
+"""user_id -> doc_id の対応 (user_doc_mappings) を CSV / JSONL でまとめて書き出し・取り込みする。
+
+    python mapping_cli.py export mappings.csv
+    python mapping_cli.py import mappings.jsonl --batch-size 1000
+
+CSV は見出し行 (user_id,doc_id) つき、JSONL は 1 行に {"user_id": ..., "doc_id": ...} を 1 つ。
+ファイル名の代わりに - を指定すると標準入出力を使う。取り込みは既存の対応を上書きする。
+"""
+import io
+import re
+import csv
+import sys
+import json
+import time
+import argparse
+import itertools
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+import logging
+from logging_util import setup_logging
+
+setup_logging()
+logger = logging.getLogger(__name__)
+
+from sqlalchemy import text
+
+from database import DOC_ID_REGEX, UserDocMapping, engine, ensure_schema, upsert_doc_mappings
+from user_doc_cache import INVALIDATION_CHANNEL
+
+FORMATS = ('csv', 'jsonl')
+
+
+def _detect_format(path: str, fmt: str | None) -> str:
+    if fmt:
+        return fmt
+    if path.endswith('.csv'):
+        return 'csv'
+    if path.endswith(('.jsonl', '.ndjson')):
+        return 'jsonl'
+    raise SystemExit(f"Cannot tell the format of {path!r}. Specify --format ({' / '.join(FORMATS)}).")
+
+
+def _open(path: str, mode: str):
+    if path == '-':
+        stream = sys.stdin if 'r' in mode else sys.stdout
+        # 標準入出力もファイルと同じく改行を変換しない
+        return open(stream.fileno(), mode, encoding='utf-8', newline='', closefd=False)
+    return open(path, mode, encoding='utf-8', newline='')
+
+
+# --- 書き出し ---
+
+def export_mappings(path: str, fmt: str, batch_size: int) -> int:
+    table = UserDocMapping.__table__
+    count = 0
+    with engine.connect() as conn, _open(path, 'w') as out:
+        # サーバー側カーソルで batch_size 件ずつ読み、全件をメモリに載せない
+        result = conn.execution_options(stream_results=True, yield_per=batch_size).execute(
+            table.select().order_by(table.c.user_id)
+        )
+        writer = csv.writer(out) if fmt == 'csv' else None
+        if writer:
+            writer.writerow(('user_id', 'doc_id'))
+        for rows in result.partitions():
+            if writer:
+                writer.writerows((row.user_id, row.doc_id) for row in rows)
+            else:
+                out.writelines(json.dumps({'user_id': row.user_id, 'doc_id': row.doc_id}, ensure_ascii=False) + '\n' for row in rows)
+            count += len(rows)
+    return count
+
+
+# --- 取り込み ---
+
+def _read_rows(path: str, fmt: str):
+    # (行番号, user_id, doc_id) を 1 行ずつ返す。不正な行は警告して読み飛ばす
+    with _open(path, 'r') as f:
+        if fmt == 'csv':
+            for line_no, record in enumerate(csv.DictReader(f), start=2):
+                yield line_no, (record.get('user_id') or '').strip(), (record.get('doc_id') or '').strip()
+        else:
+            for line_no, line in enumerate(f, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError as e:
+                    logger.warning('Line %d: invalid JSON (%s). Skipping.', line_no, e)
+                    continue
+                yield line_no, str(record.get('user_id') or '').strip(), str(record.get('doc_id') or '').strip()
+
+
+def _valid_rows(rows):
+    for line_no, user_id, doc_id in rows:
+        if not user_id or not doc_id:
+            logger.warning('Line %d: user_id and doc_id are required. Skipping.', line_no)
+            continue
+        if not re.fullmatch(DOC_ID_REGEX, doc_id):
+            # !setdoc と同じ条件。不正な ID をキャッシュや追記先に使わせない
+            logger.warning('Line %d: invalid doc_id %r. Skipping.', line_no, doc_id[:100])
+            continue
+        yield user_id, doc_id
+
+
+def _copy_batch(conn, batch) -> int:
+    # PostgreSQL (psycopg2): 一時テーブルに COPY で流し込んでから 1 文で反映する
+    latest = dict(batch)
+    buf = io.StringIO()
+    csv.writer(buf).writerows(latest.items())
+    buf.seek(0)
+    cursor = conn.connection.dbapi_connection.cursor()
+    try:
+        cursor.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS _user_doc_mapping_import (user_id text, doc_id text) ON COMMIT DELETE ROWS"
+        )
+        cursor.copy_expert("COPY _user_doc_mapping_import (user_id, doc_id) FROM STDIN WITH (FORMAT csv)", buf)
+        cursor.execute(
+            "INSERT INTO user_doc_mappings (user_id, doc_id) SELECT user_id, doc_id FROM _user_doc_mapping_import "
+            "ON CONFLICT (user_id) DO UPDATE SET doc_id = EXCLUDED.doc_id"
+        )
+    finally:
+        cursor.close()
+    return len(latest)
+
+
+def _use_copy(conn) -> bool:
+    return conn.dialect.name == 'postgresql' and conn.dialect.driver == 'psycopg2'
+
+
+def import_mappings(path: str, fmt: str, batch_size: int, dry_run: bool = False) -> int:
+    rows = _valid_rows(_read_rows(path, fmt))
+    count = 0
+    with engine.connect() as conn:
+        use_copy = _use_copy(conn)
+        while True:
+            batch = list(itertools.islice(rows, batch_size))
+            if not batch:
+                break
+            if dry_run:
+                count += len(dict(batch))
+                continue
+            # バッチごとにコミットし、途中で失敗してもそれまでの分は反映されたままにする
+            with conn.begin():
+                count += _copy_batch(conn, batch) if use_copy else upsert_doc_mappings(conn, batch)
+                if conn.dialect.name == 'postgresql':
+                    # 稼働中のワーカーのキャッシュを無効化する (USER_DOC_CACHE_INVALIDATION=postgres の場合)
+                    conn.execute(
+                        text("SELECT pg_notify(:channel, user_id) FROM unnest(CAST(:user_ids AS text[])) AS user_id"),
+                        {"channel": INVALIDATION_CHANNEL, "user_ids": list(dict(batch))},
+                    )
+            logger.info('Imported %d mappings so far.', count)
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    for name, help_text in (('export', '対応を書き出す'), ('import', '対応を取り込む (既存の対応は上書き)')):
+        sub = subparsers.add_parser(name, help=help_text)
+        sub.add_argument('path', help='ファイル名 (- なら標準入出力)')
+        sub.add_argument('--format', choices=FORMATS, help='省略時は拡張子 (.csv / .jsonl) から判定する')
+        sub.add_argument('--batch-size', type=int, default=1000, help='1 回に読み書きする件数')
+        if name == 'import':
+            sub.add_argument('--dry-run', action='store_true', help='ファイルの検証だけ行い、DB には書き込まない')
+    args = parser.parse_args()
+
+    fmt = _detect_format(args.path, args.format)
+    batch_size = max(1, args.batch_size)
+    ensure_schema()
+    started = time.perf_counter()
+    if args.command == 'export':
+        count = export_mappings(args.path, fmt, batch_size)
+        logger.info('Exported %d mappings in %.2fs.', count, time.perf_counter() - started)
+    else:
+        count = import_mappings(args.path, fmt, batch_size, dry_run=args.dry_run)
+        logger.info('%s %d mappings in %.2fs.', 'Validated' if args.dry_run else 'Imported', count, time.perf_counter() - started)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+import os
+import hashlib
+import tempfile
+import threading
+from collections import deque
+
+# 重複判定のために一時保存するとき、この大きさまではメモリ上に置き、超えたらディスクに書き出す
+MEDIA_SPOOL_MAX_MEMORY = int(os.environ.get('MEDIA_SPOOL_MAX_MEMORY', 4 * 1024 * 1024))
+MEDIA_SPOOL_READ_SIZE = int(os.environ.get('MEDIA_SPOOL_READ_SIZE', 1024 * 1024))
+
+
+def spool_and_hash(chunks, max_memory: int = MEDIA_SPOOL_MAX_MEMORY):
+    """チャンクを一時ファイルに書き出しながら SHA-256 を計算する。
+
+    戻り値は (先頭に巻き戻した一時ファイル, 16 進のダイジェスト, バイト数)。
+    一時ファイルは呼び出し側で close すること。
+    """
+    digest = hashlib.sha256()
+    size = 0
+    spool = tempfile.SpooledTemporaryFile(max_size=max_memory)
+    try:
+        for chunk in chunks:
+            digest.update(chunk)
+            spool.write(chunk)
+            size += len(chunk)
+        spool.seek(0)
+    except BaseException:
+        spool.close()
+        raise
+    return spool, digest.hexdigest(), size
+
+
+def iter_file(f, chunk_size: int = MEDIA_SPOOL_READ_SIZE):
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+def prefetch_chunks(chunks, max_bytes: int):
+    """チャンクを別スレッドで先読みし、読み出し (ダウンロードやディスク) と呼び出し側の処理 (送信) を重ねる。
+
+    先読みしておくのは max_bytes まで。読み出しで起きた例外は、それまでのチャンクを返した後に送出する。
+    途中でやめる場合は close() を呼ぶ。先読みのスレッドが終わるまで待つので、その後は chunks の元 (レスポンスなど) を閉じてよい。
+    """
+    cond = threading.Condition()
+    buffer = deque()
+    state = {'bytes': 0, 'done': False, 'closed': False, 'error': None}
+
+    def read():
+        try:
+            for chunk in chunks:
+                with cond:
+                    while state['bytes'] >= max_bytes and not state['closed']:
+                        cond.wait()
+                    if state['closed']:
+                        return
+                    buffer.append(chunk)
+                    state['bytes'] += len(chunk)
+                    cond.notify_all()
+        except BaseException as e:
+            with cond:
+                state['error'] = e
+        finally:
+            with cond:
+                state['done'] = True
+                cond.notify_all()
+
+    reader = threading.Thread(target=read, name="chunk-prefetch", daemon=True)
+    reader.start()
+    try:
+        while True:
+            with cond:
+                while not buffer and not state['done']:
+                    cond.wait()
+                if buffer:
+                    chunk = buffer.popleft()
+                    state['bytes'] -= len(chunk)
+                    cond.notify_all()
+                elif state['error'] is not None:
+                    raise state['error']
+                else:
+                    return
+            yield chunk
+    finally:
+        # 途中でやめた場合も先読みのスレッドを止め、読み出し中のチャンクを読み終えるまで待つ
+        with cond:
+            state['closed'] = True
+            cond.notify_all()
+        reader.join()
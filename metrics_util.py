@@ -0,0 +1,203 @@
+import os
+import time
+import bisect
+import threading
+import functools
+import contextvars
+from contextlib import contextmanager
+
+# 処理時間のヒストグラムのバケット境界 (秒)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# 処理中のイベントの種類 (text / image / video)。ステージの計測でラベルに使う
+_event_type = contextvars.ContextVar('event_type', default='none')
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()) -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)] + list(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}  # ラベル値のタプル -> 値
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[n]) for n in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def collect(self, extra=()):
+        with self._lock:
+            values = sorted(self._values.items())
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        for key, value in values:
+            lines.append(f'{self.name}{_format_labels(self.labelnames, key, extra)} {_format_value(value)}')
+        return lines
+
+
+_INF_LABEL = 'le="+Inf"'
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._values = {}  # ラベル値のタプル -> [バケットごとの件数..., 合計, 件数]
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels[n]) for n in self.labelnames)
+        index = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [0] * (len(self._buckets) + 2)
+            if index < len(self._buckets):
+                entry[index] += 1
+            entry[-2] += value
+            entry[-1] += 1
+
+    def collect(self, extra=()):
+        extra = list(extra)
+        with self._lock:
+            values = sorted((key, list(entry)) for key, entry in self._values.items())
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        for key, entry in values:
+            cumulative = 0
+            for bound, count in zip(self._buckets, entry):
+                cumulative += count
+                le = f'le="{_format_value(float(bound))}"'
+                lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, key, extra + [le])} {cumulative}')
+            lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, key, extra + [_INF_LABEL])} {entry[-1]}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labelnames, key, extra)} {_format_value(float(entry[-2]))}')
+            lines.append(f'{self.name}_count{_format_labels(self.labelnames, key, extra)} {entry[-1]}')
+        return lines
+
+
+def worker_id() -> str:
+    # gunicorn のワーカーごとに異なる値 (fork 後に呼ぶので、マスターの PID にはならない)
+    return str(os.getpid())
+
+
+class Registry:
+    """メトリクスはプロセスごとに持つ。gunicorn で複数のワーカーを動かす場合、1 回の取得で見えるのは
+    リクエストを受けたワーカーの値だけなので、すべての系列に worker ラベル (PID) を付けて区別できるようにする。
+    全体の値はワーカーごとの系列を sum by (...) で合算する (再起動したワーカーの値は引き継がれない)。
+    """
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def exposition(self) -> str:
+        """Prometheus のテキスト形式で全メトリクスを出力する。"""
+        extra = [f'worker="{worker_id()}"']
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.collect(extra))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+EVENTS_TOTAL = REGISTRY.register(Counter(
+    'linebot_events_total', 'Webhook events handled, by event type and outcome.', ('event_type', 'outcome')))
+STAGE_DURATION = REGISTRY.register(Histogram(
+    'linebot_stage_duration_seconds', 'Time spent in each processing stage, by event type.', ('stage', 'event_type')))
+API_CALLS_TOTAL = REGISTRY.register(Counter(
+    'linebot_api_calls_total', 'Outbound API calls, by API, operation and HTTP status.', ('api', 'operation', 'status')))
+API_CALL_DURATION = REGISTRY.register(Histogram(
+    'linebot_api_call_duration_seconds', 'Outbound API call latency, by API and operation.', ('api', 'operation')))
+API_BYTES_TOTAL = REGISTRY.register(Counter(
+    'linebot_api_bytes_total', 'Bytes transferred to and from external APIs.', ('api', 'direction')))
+API_RETRIES_TOTAL = REGISTRY.register(Counter(
+    'linebot_api_retries_total', 'Outbound API calls retried after a 429/5xx response.', ('api', 'status')))
+RATE_LIMIT_WAIT = REGISTRY.register(Histogram(
+    'linebot_rate_limit_wait_seconds', 'Time spent waiting for a rate limit token, by bucket scope.', ('scope',)))
+WEBHOOK_DUPLICATES_TOTAL = REGISTRY.register(Counter(
+    'linebot_webhook_duplicates_total', 'Webhook events skipped because their webhookEventId was already processed.', ('redelivery',)))
+STARTUP_PHASE_DURATION = REGISTRY.register(Histogram(
+    'linebot_startup_phase_duration_seconds', 'Time spent in each startup phase of this process.', ('phase',)))
+
+
+def current_event_type() -> str:
+    return _event_type.get()
+
+
+@contextmanager
+def observe_stage(stage: str, event_type: str | None = None):
+    """ブロックの処理時間を linebot_stage_duration_seconds に記録する。"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_DURATION.observe(time.perf_counter() - start, stage=stage, event_type=event_type or _event_type.get())
+
+
+def instrument_event(event_type: str):
+    """イベントハンドラ用のデコレーター。処理全体の時間と件数を記録し、内側のステージにイベントの種類を伝える。"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            token = _event_type.set(event_type)
+            outcome = 'error'
+            try:
+                with observe_stage('total', event_type):
+                    result = func(*args, **kwargs)
+                # エラーを返信して False を返したハンドラも失敗として数える
+                outcome = 'error' if result is False else 'ok'
+                return result
+            finally:
+                EVENTS_TOTAL.inc(event_type=event_type, outcome=outcome)
+                _event_type.reset(token)
+        return wrapper
+    return decorator
+
+
+def _status_of(error) -> str:
+    # HttpError (googleapiclient) は resp.status、LINE SDK の ApiException は status を持つ
+    status = getattr(getattr(error, 'resp', None), 'status', None) or getattr(error, 'status', None)
+    return str(status) if status else 'error'
+
+
+def record_api_call(api: str, operation: str, status, duration: float | None = None):
+    API_CALLS_TOTAL.inc(api=api, operation=operation, status=status)
+    if duration is not None:
+        API_CALL_DURATION.observe(duration, api=api, operation=operation)
+
+
+def record_api_bytes(api: str, direction: str, amount: int):
+    if amount:
+        API_BYTES_TOTAL.inc(amount, api=api, direction=direction)
+
+
+@contextmanager
+def observe_api_call(api: str, operation: str, success_status='200'):
+    """API 呼び出しの件数 (ステータス別) と時間を記録する。例外のときは例外からステータスを取り出す。"""
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException as e:
+        record_api_call(api, operation, _status_of(e), time.perf_counter() - start)
+        raise
+    record_api_call(api, operation, success_status, time.perf_counter() - start)
@@ -0,0 +1,79 @@
+import re
+
+from sqlalchemy import text
+
+from database import NoteEntry
+
+# FTS5 の trigram トークナイザーが一致させられる最短の文字数。これより短い語は LIKE で探す
+_TRIGRAM_MIN_LENGTH = 3
+# 検索語の最大数 (長すぎるクエリで重い SQL を作らない)
+_MAX_TERMS = 8
+
+# エンジン (方言) ごとの全文検索インデックスの有無
+_fts_available = {}
+
+
+def record_note(db, doc_id: str, user_id: str, text: str | None = None, image_uri: str | None = None):
+    """ドキュメントに追記した内容を控えとして記録する (コミットまで行う)。"""
+    db.execute(NoteEntry.__table__.insert(), {
+        "user_id": user_id, "doc_id": doc_id, "text": text, "image_uri": image_uri,
+    })
+    db.commit()
+
+
+def _has_fts(db) -> bool:
+    bind = db.get_bind()
+    if bind.url not in _fts_available:
+        dialect = bind.dialect.name
+        if dialect == 'sqlite':
+            found = db.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'notes_fts'")).first()
+        elif dialect == 'postgresql':
+            found = db.execute(text(
+                "SELECT 1 FROM information_schema.columns WHERE table_name = 'notes' AND column_name = 'search_vector'"
+            )).first()
+        else:
+            found = None
+        _fts_available[bind.url] = found is not None
+    return _fts_available[bind.url]
+
+
+def _like_pattern(term: str) -> str:
+    return '%' + re.sub(r'([\\%_])', r'\\\1', term) + '%'
+
+
+def _is_word(term: str) -> bool:
+    # PostgreSQL の 'simple' 設定は空白と記号で区切るので、分かち書きしない日本語などは部分一致で探す
+    return term.isascii()
+
+
+def search_notes(db, user_id: str, query: str, limit: int = 5) -> list:
+    """user_id の控えから、すべての語を含むものを新しい順に返す ((created_at, text, image_uri) のリスト)。"""
+    terms = query.split()[:_MAX_TERMS]
+    if not terms:
+        return []
+    table = NoteEntry.__table__
+    dialect = db.get_bind().dialect.name
+    use_fts = _has_fts(db)
+    conditions = ["n.user_id = :user_id"]
+    params = {"user_id": user_id, "limit": limit}
+    fts_terms = []
+    for i, term in enumerate(terms):
+        if use_fts and dialect == 'sqlite' and len(term) >= _TRIGRAM_MIN_LENGTH:
+            fts_terms.append('"' + term.replace('"', '""') + '"')
+        elif use_fts and dialect == 'postgresql' and _is_word(term):
+            conditions.append(f"n.search_vector @@ plainto_tsquery('simple', :term{i})")
+            params[f"term{i}"] = term
+        else:
+            op = "ILIKE" if dialect == 'postgresql' else "LIKE"
+            conditions.append(f"(n.text {op} :term{i} ESCAPE '\\' OR n.image_uri {op} :term{i} ESCAPE '\\')")
+            params[f"term{i}"] = _like_pattern(term)
+    if fts_terms:
+        # 語をスペースで並べると FTS5 ではすべてを含む (AND) 検索になる
+        conditions.append("n.id IN (SELECT rowid FROM notes_fts WHERE notes_fts MATCH :match)")
+        params["match"] = ' '.join(fts_terms)
+    statement = text(
+        "SELECT n.created_at, n.text, n.image_uri FROM notes n WHERE "
+        + " AND ".join(conditions)
+        + " ORDER BY n.id DESC LIMIT :limit"
+    ).columns(table.c.created_at, table.c.text, table.c.image_uri)
+    return [tuple(row) for row in db.execute(statement, params)]
@@ -0,0 +1,11 @@
+import os
+import sys
+import tempfile
+
+# リポジトリ直下のモジュール (database.py など) を読み込めるようにする
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# database.py は読み込み時にエンジンを作るので、テスト用の SQLite を先に指定しておく
+os.environ.setdefault("DATABASE_URL", "sqlite:///" + os.path.join(tempfile.mkdtemp(prefix="linebot-test-"), "test.db"))
+# Google のクライアントは読み込み時に資格情報を読むので、ダミーのサービスアカウントを指定しておく (通信はしない)
+os.environ.setdefault("CREDENTIALS_JSON", '{"type": "service_account", "project_id": "test", "client_email": "test@example.com", "token_uri": "http://127.0.0.1:9/token"}')
@@ -0,0 +1,45 @@
+import pytest
+from sqlalchemy.dialects import mysql, postgresql
+
+import database
+from database import UserDocMapping, _doc_mapping_upsert, engine, ensure_schema, upsert_doc_mappings
+
+
+def _mappings(user_ids):
+    table = UserDocMapping.__table__
+    with engine.connect() as conn:
+        return dict(conn.execute(
+            table.select().with_only_columns(table.c.user_id, table.c.doc_id).where(table.c.user_id.in_(user_ids))
+        ).all())
+
+
+@pytest.mark.parametrize("native", [True, False])
+def test_upsert_inserts_updates_and_keeps_last_duplicate(monkeypatch, native):
+    ensure_schema()
+    if not native:
+        # ON CONFLICT を使えない方言の、行ごとの UPDATE / INSERT
+        monkeypatch.setattr(database, "_doc_mapping_upsert", lambda dialect_name: None)
+    prefix = f"U-upsert-{native}-"
+    with engine.begin() as conn:
+        assert upsert_doc_mappings(conn, [(prefix + "1", "doc-old")]) == 1
+    with engine.begin() as conn:
+        assert upsert_doc_mappings(conn, [
+            (prefix + "1", "doc-new"), (prefix + "2", "doc-a"), (prefix + "2", "doc-b"),
+        ]) == 2
+    assert _mappings([prefix + "1", prefix + "2"]) == {prefix + "1": "doc-new", prefix + "2": "doc-b"}
+
+
+def test_upsert_with_no_rows_does_nothing():
+    assert upsert_doc_mappings(None, []) == 0
+
+
+@pytest.mark.parametrize("dialect, clause", [
+    (postgresql.dialect(), "ON CONFLICT (user_id) DO UPDATE SET doc_id = excluded.doc_id"),
+    (mysql.dialect(), "ON DUPLICATE KEY UPDATE doc_id = VALUES(doc_id)"),
+])
+def test_dialect_upsert_statements(dialect, clause):
+    assert clause in str(_doc_mapping_upsert(dialect.name).compile(dialect=dialect))
+
+
+def test_unknown_dialect_has_no_upsert_statement():
+    assert _doc_mapping_upsert("oracle") is None
@@ -0,0 +1,104 @@
+import datetime
+
+import httplib2
+from googleapiclient.errors import HttpError
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from database import DocWriteOutbox
+from doc_outbox import DocOutboxDrainer, enqueue_doc_write
+
+
+def _http_error(status):
+    return HttpError(httplib2.Response({"status": str(status)}), b"error")
+
+
+def _setup(tmp_path, texts, doc_id="doc-1"):
+    engine = create_engine(f"sqlite:///{tmp_path / 'outbox.db'}")
+    DocWriteOutbox.__table__.create(engine)
+    session_factory = sessionmaker(bind=engine)
+    db = session_factory()
+    try:
+        for text in texts:
+            enqueue_doc_write(db, doc_id, text=text)
+    finally:
+        db.close()
+    return engine, session_factory
+
+
+def _drainer(engine, session_factory, append, **kwargs):
+    return DocOutboxDrainer(session_factory, engine, append, **kwargs)
+
+
+def _rows(session_factory):
+    db = session_factory()
+    try:
+        return [(row.text, row.status, row.attempts) for row in db.query(DocWriteOutbox).order_by(DocWriteOutbox.seq)]
+    finally:
+        db.close()
+
+
+def test_drain_applies_writes_in_seq_order_in_one_batch(tmp_path):
+    engine, session_factory = _setup(tmp_path, ["a", "b", "c"])
+    calls = []
+    drainer = _drainer(engine, session_factory, lambda doc_id, items: calls.append((doc_id, items)))
+    assert drainer.drain_once() == 3
+    assert calls == [("doc-1", [("a", None), ("b", None), ("c", None)])]
+    assert _rows(session_factory) == []
+
+
+def test_claimed_rows_are_not_claimed_again_until_lease_expires(tmp_path):
+    engine, session_factory = _setup(tmp_path, ["a", "b"])
+    first = _drainer(engine, session_factory, None, lease=60)
+    other = _drainer(engine, session_factory, None, lease=60)
+    now = datetime.datetime.utcnow()
+    assert [entry.text for entry in first._claim("doc-1", now)] == ["a", "b"]
+    # first が反映中 (リースが有効) の間は、他のプロセスは取れない
+    assert other._claim("doc-1", now) == []
+    # first が止まってリースが切れたら取り直す
+    reclaimed = other._claim("doc-1", now + datetime.timedelta(seconds=61))
+    assert [(entry.text, entry.status) for entry in reclaimed] == [("a", "applying"), ("b", "applying")]
+
+
+def test_rejected_batch_falls_back_to_one_by_one(tmp_path):
+    engine, session_factory = _setup(tmp_path, ["a", "bad", "c"])
+    calls = []
+
+    def append(doc_id, items):
+        calls.append(items)
+        if len(items) > 1 or items[0][0] == "bad":
+            raise _http_error(400)
+
+    drainer = _drainer(engine, session_factory, append)
+    assert drainer.drain_once() == 2
+    assert calls[1:] == [[("a", None)], [("bad", None)], [("c", None)]]
+    # 原因の追記だけ failed にして、後続は先に進める
+    assert _rows(session_factory) == [("bad", "failed", 1)]
+
+
+def test_transient_error_keeps_order_and_schedules_retry(tmp_path):
+    engine, session_factory = _setup(tmp_path, ["a", "b"])
+
+    def append(doc_id, items):
+        raise _http_error(503)
+
+    drainer = _drainer(engine, session_factory, append)
+    assert drainer.drain_once() == 0
+    assert _rows(session_factory) == [("a", "pending", 1), ("b", "pending", 1)]
+    # 再試行待ちの間は反映しない
+    assert drainer.drain_once() == 0
+
+
+def test_ambiguous_server_error_is_not_resent(tmp_path):
+    engine, session_factory = _setup(tmp_path, ["a", "b"])
+    calls = []
+
+    def append(doc_id, items):
+        calls.append(items)
+        raise _http_error(500)
+
+    drainer = _drainer(engine, session_factory, append)
+    assert drainer.drain_once() == 0
+    # 反映済みかもしれないので、1 件ずつ送り直さずに failed にする
+    assert len(calls) == 1
+    assert _rows(session_factory) == [("a", "failed", 1), ("b", "failed", 1)]
@@ -0,0 +1,52 @@
+import datetime
+
+from sqlalchemy import create_engine
+
+from database import ProcessedWebhookEvent
+from event_dedup import WebhookEventDeduplicator
+
+
+def _engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'dedup.db'}")
+    ProcessedWebhookEvent.__table__.create(engine)
+    return engine
+
+
+def _expire_claim(engine, event_id):
+    table = ProcessedWebhookEvent.__table__
+    with engine.begin() as conn:
+        conn.execute(
+            table.update().where(table.c.webhook_event_id == event_id)
+            .values(claimed_at=datetime.datetime.utcnow() - datetime.timedelta(hours=1))
+        )
+
+
+def test_redelivery_after_crash_is_processed_once_lease_expires(tmp_path):
+    engine = _engine(tmp_path)
+    crashed = WebhookEventDeduplicator(engine=engine, lease=600)
+    assert crashed.claim("evt-1")
+    # crashed のワーカーは release も complete も呼ばずに止まった。別のワーカーが再送を受ける
+    other = WebhookEventDeduplicator(engine=engine, lease=600)
+    assert not other.claim("evt-1", is_redelivery=True)
+
+    _expire_claim(engine, "evt-1")
+    assert other.claim("evt-1", is_redelivery=True)
+    # 引き継いだ後の再送は弾く
+    assert not WebhookEventDeduplicator(engine=engine, lease=600).claim("evt-1", is_redelivery=True)
+
+
+def test_completed_event_is_never_taken_over(tmp_path):
+    engine = _engine(tmp_path)
+    dedup = WebhookEventDeduplicator(engine=engine, lease=600)
+    assert dedup.claim("evt-2")
+    dedup.complete("evt-2")
+    _expire_claim(engine, "evt-2")
+    assert not WebhookEventDeduplicator(engine=engine, lease=600).claim("evt-2", is_redelivery=True)
+
+
+def test_released_event_can_be_claimed_again(tmp_path):
+    engine = _engine(tmp_path)
+    dedup = WebhookEventDeduplicator(engine=engine)
+    assert dedup.claim("evt-3")
+    dedup.release("evt-3")
+    assert dedup.claim("evt-3", is_redelivery=True)
@@ -0,0 +1,75 @@
+import threading
+import time
+
+import httplib2
+import pytest
+from googleapiclient.errors import HttpError
+
+import google_docs_util
+from google_docs_util import DocWriteBuffer
+
+
+def _submit_while_leader_waits(buffer, document_id, texts):
+    # 最初の追記 (リーダー) が待っている間に残りを順に追記し、すべての Future を返す
+    futures = {}
+    leader = threading.Thread(target=lambda: futures.setdefault(0, buffer.submit(document_id, text=texts[0])))
+    leader.start()
+    while document_id not in buffer._docs:
+        time.sleep(0.001)
+    for i, text in enumerate(texts[1:], 1):
+        futures[i] = buffer.submit(document_id, text=text)
+    leader.join(5)
+    return [futures[i] for i in range(len(texts))]
+
+
+def test_appends_are_coalesced_in_submit_order(monkeypatch):
+    calls = []
+    monkeypatch.setattr(google_docs_util, "append_to_document", lambda doc_id, items: calls.append((doc_id, items)) or "url")
+    buffer = DocWriteBuffer(window_seconds=0.2, max_ops=10)
+    futures = _submit_while_leader_waits(buffer, "doc-1", ["a", "b", "c"])
+    assert calls == [("doc-1", [("a", None), ("b", None), ("c", None)])]
+    assert [f.result(1) for f in futures] == ["url", "url", "url"]
+
+
+def test_max_ops_splits_batches_without_reordering(monkeypatch):
+    calls = []
+    monkeypatch.setattr(google_docs_util, "append_to_document", lambda doc_id, items: calls.append(items) or "url")
+    buffer = DocWriteBuffer(window_seconds=1, max_ops=2)
+    futures = _submit_while_leader_waits(buffer, "doc-1", ["a", "b", "c"])
+    for f in futures:
+        f.result(5)
+    assert calls == [[("a", None), ("b", None)], [("c", None)]]
+
+
+def test_batch_failure_is_set_on_every_waiter(monkeypatch):
+    error = RuntimeError("Docs is unavailable")
+
+    def fail(doc_id, items):
+        raise error
+
+    monkeypatch.setattr(google_docs_util, "append_to_document", fail)
+    buffer = DocWriteBuffer(window_seconds=0.2, max_ops=10)
+    futures = _submit_while_leader_waits(buffer, "doc-1", ["a", "b", "c"])
+    for f in futures:
+        with pytest.raises(RuntimeError):
+            f.result(1)
+        assert f.exception() is error
+
+
+def test_rejected_batch_is_retried_one_by_one(monkeypatch):
+    calls = []
+
+    def append(doc_id, items):
+        calls.append(items)
+        if len(items) > 1 or items[0][0] == "bad":
+            raise HttpError(httplib2.Response({"status": "400"}), b"invalid")
+        return "url"
+
+    monkeypatch.setattr(google_docs_util, "append_to_document", append)
+    buffer = DocWriteBuffer(window_seconds=0.2, max_ops=10)
+    futures = _submit_while_leader_waits(buffer, "doc-1", ["a", "bad", "c"])
+    # まとめた追記が 400 で拒否されたら 1 件ずつ送り直し、原因の追記だけ失敗させる
+    assert calls[1:] == [[("a", None)], [("bad", None)], [("c", None)]]
+    assert futures[0].result(1) == "url"
+    assert isinstance(futures[1].exception(1), HttpError)
+    assert futures[2].result(1) == "url"
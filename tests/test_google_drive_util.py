@@ -0,0 +1,92 @@
+import io
+import json
+from concurrent.futures import Future
+
+import httplib2
+from googleapiclient.http import MediaIoBaseUpload
+
+from google_drive_util import UPLOAD_FIELDS, PermissionBatcher, _query_upload_status, _resume_upload
+
+
+def test_wait_returns_false_when_grant_does_not_finish_in_time():
+    batcher = PermissionBatcher(window_seconds=0.01)
+    # 共有設定の送信が終わらない (Future が完了しない) 状態
+    batcher._futures["file-1"] = Future()
+    assert batcher.wait("file-1", timeout=0.05) is False
+
+
+def test_wait_returns_true_for_unknown_file():
+    assert PermissionBatcher(window_seconds=0.01).wait("unknown", timeout=0.05) is True
+
+
+class _FakeHttp:
+    def __init__(self, status, headers=None, content=b""):
+        self.response = httplib2.Response({"status": str(status), **(headers or {})})
+        self.content = content
+        self.requests = []
+
+    def request(self, uri, method="GET", body=None, headers=None):
+        self.requests.append((uri, method, headers))
+        return self.response, self.content
+
+
+def test_query_upload_status_returns_committed_offset():
+    http = _FakeHttp(308, {"range": "bytes=0-262143"})
+    assert _query_upload_status(http, "https://upload.example/session", 1000000) == 262144
+    assert http.requests[0][2]["Content-Range"] == "bytes */1000000"
+    # まだ何も受け取っていなければ Range ヘッダーがない
+    assert _query_upload_status(_FakeHttp(308), "https://upload.example/session", None) == 0
+
+
+def test_query_upload_status_returns_completed_file():
+    http = _FakeHttp(200, content=json.dumps({"id": "file-1"}).encode())
+    assert _query_upload_status(http, "https://upload.example/session", 10) == {"id": "file-1"}
+
+
+def test_query_upload_status_returns_none_for_expired_session():
+    assert _query_upload_status(_FakeHttp(404), "https://upload.example/session", 10) is None
+
+
+class _FakeFiles:
+    def __init__(self):
+        self.gets = []
+
+    def get(self, fileId, fields):
+        self.gets.append((fileId, fields))
+        file = {"id": fileId, "webContentLink": "https://drive.example/uc", "webViewLink": "https://drive.example/view"}
+        return type("Request", (), {"execute": lambda self: file})()
+
+
+class _FakeService:
+    def __init__(self):
+        self.fake_files = _FakeFiles()
+
+    def files(self):
+        return self.fake_files
+
+
+def test_resume_upload_refetches_completed_file_with_upload_fields():
+    service = _FakeService()
+    request = type("Request", (), {})()
+    request.http = _FakeHttp(200, content=json.dumps({"id": "file-1"}).encode())
+    media = MediaIoBaseUpload(io.BytesIO(b"x" * 10), mimetype="image/jpeg", resumable=True)
+    saved = {"session_uri": "https://upload.example/session", "total_size": 10}
+    # 状態の問い合わせの応答にはリンクが含まれないので、files().get で取り直す
+    file = _resume_upload(service, request, media, saved)
+    assert service.fake_files.gets == [("file-1", UPLOAD_FIELDS)]
+    assert file["webViewLink"] == "https://drive.example/view"
+
+
+def test_background_sharing_reports_result_after_batch(monkeypatch):
+    import google_drive_util
+
+    grants = {}
+    batcher = type("Batcher", (), {"grant": lambda self, file_id: grants.setdefault(file_id, Future())})()
+    monkeypatch.setattr(google_drive_util, "DRIVE_SHARING_MODE", "background")
+    monkeypatch.setattr(google_drive_util, "_permission_batcher", batcher)
+    results = []
+    google_drive_util._share_later("file-1", results.append)
+    # batch を送り終えるまでは結果を伝えない
+    assert results == []
+    grants["file-1"].set_result(False)
+    assert results == [False]
@@ -0,0 +1,80 @@
+import email.utils
+import time
+
+import httplib2
+import pytest
+from googleapiclient.errors import HttpError
+
+import google_rate_limit_util
+from google_rate_limit_util import NON_IDEMPOTENT_RETRYABLE_STATUSES, GoogleApiScheduler, TokenBucket, _retry_after
+
+
+def _http_error(status, **headers):
+    return HttpError(httplib2.Response({"status": str(status), **headers}), b"error")
+
+
+def _failing(*errors, result="ok"):
+    errors = list(errors)
+
+    def func():
+        if errors:
+            raise errors.pop(0)
+        return result
+    return func
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    recorded = []
+    monkeypatch.setattr(google_rate_limit_util.time, "sleep", recorded.append)
+    # full jitter の上限をそのまま使う
+    monkeypatch.setattr(google_rate_limit_util.random, "uniform", lambda low, high: high)
+    return recorded
+
+
+def _scheduler(**kwargs):
+    kwargs.setdefault("project_limits", {})
+    kwargs.setdefault("doc_rate", 0)
+    return GoogleApiScheduler(backoff_base=0.5, backoff_max=4, **kwargs)
+
+
+def test_backoff_doubles_up_to_max_then_raises(sleeps):
+    scheduler = _scheduler(max_retries=4)
+    with pytest.raises(HttpError):
+        scheduler.call(_failing(*[_http_error(500) for _ in range(5)]))
+    assert sleeps == [0.5, 1.0, 2.0, 4.0]
+
+
+def test_retry_after_is_a_lower_bound_on_the_delay(sleeps):
+    scheduler = _scheduler(max_retries=3)
+    assert scheduler.call(_failing(_http_error(429, **{"retry-after": "7"}), _http_error(503))) == "ok"
+    assert sleeps == [7.0, 1.0]
+
+
+def test_retry_after_accepts_http_date():
+    when = email.utils.formatdate(time.time() + 30, usegmt=True)
+    assert 25 < _retry_after(httplib2.Response({"status": "429", "retry-after": when})) <= 30
+    assert _retry_after(httplib2.Response({"status": "429", "retry-after": "soon"})) is None
+
+
+def test_non_idempotent_calls_do_not_retry_ambiguous_errors(sleeps):
+    scheduler = _scheduler(max_retries=3)
+    with pytest.raises(HttpError):
+        scheduler.call(_failing(_http_error(500)), retry_statuses=NON_IDEMPOTENT_RETRYABLE_STATUSES)
+    assert sleeps == []
+    assert scheduler.call(_failing(_http_error(503)), retry_statuses=NON_IDEMPOTENT_RETRYABLE_STATUSES) == "ok"
+    assert sleeps == [0.5]
+
+
+def test_429_halves_the_bucket_rate(sleeps):
+    scheduler = _scheduler(project_limits={"google_docs": (10, 10)}, max_retries=1)
+    scheduler.call(_failing(_http_error(429)), api="google_docs")
+    bucket = scheduler._projects["google_docs"]
+    # 429 で半分に下げ、成功で少し戻す
+    assert bucket.rate == pytest.approx(5.5)
+
+
+def test_token_bucket_reports_wait_when_empty():
+    bucket = TokenBucket(rate=2, capacity=1)
+    assert bucket.reserve() == 0.0
+    assert bucket.reserve() == pytest.approx(0.5, abs=0.05)
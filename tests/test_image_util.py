@@ -0,0 +1,50 @@
+import io
+
+import pytest
+
+from image_util import SNIFF_SIZE, image_object_size, remember_image_size, sniff_image
+
+
+def _encode(fmt, size=(123, 45), **kwargs):
+    Image = pytest.importorskip("PIL.Image")
+    buffer = io.BytesIO()
+    Image.new("RGB", size, (200, 100, 50)).save(buffer, fmt, **kwargs)
+    return buffer.getvalue()
+
+
+@pytest.mark.parametrize("fmt, kwargs, mime_type", [
+    ("JPEG", {}, "image/jpeg"),
+    ("JPEG", {"progressive": True, "exif": b"Exif\x00\x00" + b"\x00" * 2000}, "image/jpeg"),
+    ("PNG", {}, "image/png"),
+    ("GIF", {}, "image/gif"),
+    ("WEBP", {}, "image/webp"),
+    ("WEBP", {"lossless": True}, "image/webp"),
+])
+def test_sniff_image_reads_type_and_size_from_header(fmt, kwargs, mime_type):
+    data = _encode(fmt, **kwargs)
+    assert sniff_image(data[:SNIFF_SIZE]) == (mime_type, (123, 45))
+
+
+def test_sniff_image_handles_unknown_and_truncated_data():
+    assert sniff_image(b"not an image") == (None, None)
+    assert sniff_image(b"") == (None, None)
+    assert sniff_image(b"\x89PNG\r\n\x1a\n\x00\x00") == ("image/png", None)
+    assert sniff_image(b"\x00\x00\x00\x18ftypheic\x00\x00") == ("image/heic", None)
+
+
+def test_image_object_size_fits_the_frame_and_keeps_aspect_ratio():
+    remember_image_size("https://drive.example/large", (1600, 1200))
+    remember_image_size("https://drive.example/small", (100, 50))
+    assert image_object_size("https://drive.example/large") == {
+        "height": {"magnitude": 300.0, "unit": "PT"},
+        "width": {"magnitude": 400.0, "unit": "PT"},
+    }
+    # 元の大きさより拡大しない (1px = 0.75pt)
+    assert image_object_size("https://drive.example/small") == {
+        "height": {"magnitude": 37.5, "unit": "PT"},
+        "width": {"magnitude": 75.0, "unit": "PT"},
+    }
+
+
+def test_image_object_size_without_known_size_sets_width_only():
+    assert image_object_size("https://drive.example/unknown") == {"width": {"magnitude": 400.0, "unit": "PT"}}
@@ -0,0 +1,61 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import urllib3
+
+from line_api_util import LineContentStream
+
+_BODY = b"x" * (256 * 1024)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", str(len(_BODY)))
+        self.end_headers()
+        try:
+            self.wfile.write(_BODY)
+        except OSError:
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server_url():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/content"
+    server.shutdown()
+    server.server_close()
+
+
+def _open(pool, url):
+    return LineContentStream("m1", pool.request("GET", url, preload_content=False))
+
+
+def test_partially_read_connection_is_closed_before_release(server_url):
+    pool = urllib3.PoolManager(maxsize=1)
+    content = _open(pool, server_url)
+    connection = content._response.connection
+    next(content.iter_chunks(1024))
+    content.close()
+    # 読みかけの本文が残ったソケットはプールに戻さない
+    assert connection.sock is None
+    with _open(pool, server_url) as content:
+        assert b"".join(content.iter_chunks(64 * 1024)) == _BODY
+
+
+def test_fully_read_connection_is_reused(server_url):
+    pool = urllib3.PoolManager(maxsize=1)
+    with _open(pool, server_url) as content:
+        assert b"".join(content.iter_chunks(64 * 1024)) == _BODY
+    with _open(pool, server_url) as content:
+        assert b"".join(content.iter_chunks(64 * 1024)) == _BODY
+    assert pool.connection_from_url(server_url).num_connections == 1
@@ -0,0 +1,84 @@
+import base64
+import hashlib
+import hmac
+
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+
+import main
+from database import ProcessedWebhookEvent
+from event_dedup import WebhookEventDeduplicator
+from webhook_util import WebhookEvent, WebhookVerifier
+
+
+def _text_event(event_id, text="hello"):
+    return WebhookEvent.from_dict({
+        "type": "message",
+        "webhookEventId": event_id,
+        "replyToken": "token",
+        "source": {"type": "user", "userId": "U1"},
+        "message": {"id": "m1", "type": "text", "text": text},
+    })
+
+
+def _dedup(tmp_path, monkeypatch):
+    engine = create_engine(f"sqlite:///{tmp_path / 'dedup.db'}")
+    ProcessedWebhookEvent.__table__.create(engine)
+    dedup = WebhookEventDeduplicator(engine=engine, lease=600)
+    monkeypatch.setattr(main, "webhook_dedup", dedup)
+    return dedup
+
+
+def test_failed_handler_leaves_event_claimable(tmp_path, monkeypatch):
+    dedup = _dedup(tmp_path, monkeypatch)
+    replies = []
+    monkeypatch.setattr(main, "_reply_line", lambda token, text: replies.append(text))
+    monkeypatch.setattr(main, "get_user_doc_id", lambda user_id: "doc-1")
+
+    def fail(*args, **kwargs):
+        raise RuntimeError("Docs is unavailable")
+
+    monkeypatch.setattr(main, "_write_to_doc", fail)
+    main._dispatch_event(_text_event("evt-1"))
+    # ハンドラはエラーを返信して例外を握りつぶすが、イベントは再送で処理し直せる
+    assert len(replies) == 1
+    assert dedup.claim("evt-1", is_redelivery=True)
+
+
+def test_handled_event_is_completed(tmp_path, monkeypatch):
+    dedup = _dedup(tmp_path, monkeypatch)
+    monkeypatch.setattr(main, "_reply_line", lambda token, text: None)
+    monkeypatch.setattr(main, "get_user_doc_id", lambda user_id: "doc-1")
+    monkeypatch.setattr(main, "_write_to_doc", lambda *args, **kwargs: "https://docs.google.com/document/d/doc-1/edit")
+    main._dispatch_event(_text_event("evt-2"))
+    assert not dedup.claim("evt-2", is_redelivery=True)
+
+
+def test_media_blob_is_recorded_only_when_sharing_succeeded():
+    fields = dict(file_name="f.jpg", mime_type="image/jpeg", size=1, direct_link=None, webview_link="https://drive.example/view")
+    main._record_shared_media_blob(False, sha256="a" * 64, file_id="file-unshared", **fields)
+    main._record_shared_media_blob(True, sha256="b" * 64, file_id="file-shared", **fields)
+    db = main.SessionLocal()
+    try:
+        assert main.find_media_blob("a" * 64, db) is None
+        assert main.find_media_blob("b" * 64, db).file_id == "file-shared"
+    finally:
+        db.close()
+
+
+def _post_callback(monkeypatch, body, secret="secret"):
+    monkeypatch.setattr(main, "webhook_verifier", WebhookVerifier("secret"))
+    signature = base64.b64encode(hmac.new(secret.encode(), body, hashlib.sha256).digest()).decode()
+    return TestClient(main.app).post("/callback", content=body, headers={"X-Line-Signature": signature})
+
+
+def test_callback_rejects_invalid_signature_with_400(monkeypatch):
+    body = b'{"destination": "U0", "events": []}'
+    assert _post_callback(monkeypatch, body, secret="wrong").status_code == 400
+    # Webhook の検証ツールからの短いボディは 200 を返す
+    assert _post_callback(monkeypatch, b"{}", secret="wrong").status_code == 200
+    assert _post_callback(monkeypatch, body).status_code == 200
+
+
+def test_callback_rejects_wrong_shape_body_with_400(monkeypatch):
+    assert _post_callback(monkeypatch, b'{"destination": "U0", "events": [1]}').status_code == 400
@@ -0,0 +1,28 @@
+from database import UserDocMapping, engine, ensure_schema
+from mapping_cli import import_mappings
+
+_GOOD_DOC_ID = "1AbCdEfGhIjKlMnOpQrStUvWxYz_0123456789-"
+
+
+def test_import_skips_rows_with_invalid_doc_id(tmp_path, caplog):
+    ensure_schema()
+    path = tmp_path / "mappings.csv"
+    path.write_text(
+        "user_id,doc_id\n"
+        f"U-good,{_GOOD_DOC_ID}\n"
+        "U-bad,not a doc id; DROP TABLE\n"
+        "U-short,abc123\n",
+        encoding="utf-8",
+    )
+
+    assert import_mappings(str(path), "csv", batch_size=10) == 1
+
+    table = UserDocMapping.__table__
+    with engine.connect() as conn:
+        rows = dict(conn.execute(
+            table.select().with_only_columns(table.c.user_id, table.c.doc_id)
+            .where(table.c.user_id.in_(["U-good", "U-bad", "U-short"]))
+        ).all())
+    assert rows == {"U-good": _GOOD_DOC_ID}
+    assert "Line 3: invalid doc_id" in caplog.text
+    assert "Line 4: invalid doc_id" in caplog.text
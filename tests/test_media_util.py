@@ -0,0 +1,34 @@
+import threading
+
+from media_util import prefetch_chunks
+
+
+def test_close_stops_and_joins_reader_thread():
+    produced = []
+
+    def source():
+        for i in range(1000):
+            produced.append(i)
+            yield b"x" * 10
+
+    chunks = prefetch_chunks(source(), max_bytes=30)
+    assert next(chunks) == b"x" * 10
+    chunks.close()
+    read = len(produced)
+    assert not any(t.name == "chunk-prefetch" and t.is_alive() for t in threading.enumerate())
+    assert len(produced) == read < 1000
+
+
+def test_reader_error_is_raised_after_buffered_chunks():
+    def source():
+        yield b"a"
+        raise OSError("connection reset")
+
+    chunks = prefetch_chunks(source(), max_bytes=10)
+    assert next(chunks) == b"a"
+    try:
+        next(chunks)
+    except OSError as e:
+        assert "connection reset" in str(e)
+    else:
+        raise AssertionError("expected OSError")
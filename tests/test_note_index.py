@@ -0,0 +1,52 @@
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from database import NoteEntry
+from note_index import record_note, search_notes
+
+
+@pytest.fixture
+def db(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'notes.db'}")
+    NoteEntry.__table__.create(engine)
+    session = sessionmaker(bind=engine)()
+    for user_id, text in [
+        ("U1", "weekly meeting notes"),
+        ("U1", "会議のメモ 100% 完了"),
+        ("U1", "meeting with design team"),
+        ("U2", "meeting notes from another user"),
+    ]:
+        record_note(session, "doc-1", user_id, text=text)
+    record_note(session, "doc-1", "U1", image_uri="https://drive.example/meeting.png")
+    yield session
+    session.close()
+
+
+def _texts(rows):
+    return [text or image_uri for _, text, image_uri in rows]
+
+
+def test_all_terms_must_match_and_newest_come_first(db):
+    assert _texts(search_notes(db, "U1", "meeting")) == [
+        "https://drive.example/meeting.png", "meeting with design team", "weekly meeting notes",
+    ]
+    assert _texts(search_notes(db, "U1", "meeting notes")) == ["weekly meeting notes"]
+    assert _texts(search_notes(db, "U1", "meeting", limit=1)) == ["https://drive.example/meeting.png"]
+
+
+def test_search_is_limited_to_the_user(db):
+    assert _texts(search_notes(db, "U2", "notes")) == ["meeting notes from another user"]
+    assert search_notes(db, "U3", "meeting") == []
+
+
+def test_short_terms_and_wildcards_match_literally(db):
+    # トライグラムより短い語は部分一致で探す
+    assert _texts(search_notes(db, "U1", "会議")) == ["会議のメモ 100% 完了"]
+    # % や _ はワイルドカードとして扱わない
+    assert _texts(search_notes(db, "U1", "%")) == ["会議のメモ 100% 完了"]
+    assert search_notes(db, "U1", "_") == []
+
+
+def test_empty_query_returns_nothing(db):
+    assert search_notes(db, "U1", "   ") == []
@@ -0,0 +1,19 @@
+from user_doc_cache import UserDocCache
+
+
+def test_peek_does_not_count_hits_or_misses():
+    cache = UserDocCache(maxsize=10, ttl=60)
+    cache.set("U1", "doc-1")
+    assert cache.peek("U1") == "doc-1"
+    assert cache.peek("U2") is None
+    assert (cache.hits, cache.misses) == (0, 0)
+    assert cache.get("U1") == "doc-1"
+    assert cache.get("U2") is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_expired_entries_are_not_returned():
+    cache = UserDocCache(maxsize=10, ttl=-1)
+    cache.set("U1", "doc-1")
+    assert cache.peek("U1") is None
+    assert cache.get("U1") is None
@@ -0,0 +1,58 @@
+import base64
+import hashlib
+import hmac
+import json
+
+import pytest
+
+from webhook_util import WebhookVerifier
+
+
+def _sign(secret, body):
+    return base64.b64encode(hmac.new(secret.encode(), body, hashlib.sha256).digest()).decode()
+
+
+def test_verify_checks_signature_over_raw_bytes():
+    verifier = WebhookVerifier("secret")
+    body = '{"events": [], "destination": "U\u3042"}'.encode()
+    assert verifier.verify(body, _sign("secret", body))
+    assert not verifier.verify(body, _sign("other-secret", body))
+    # 同じ JSON でも、バイト列が違えば署名は一致しない
+    assert not verifier.verify(json.dumps(json.loads(body)).encode(), _sign("secret", body))
+    assert not verifier.verify(body, "")
+
+
+def test_parse_reads_event_fields():
+    body = json.dumps({"destination": "U0", "events": [
+        {
+            "type": "message",
+            "webhookEventId": "evt-1",
+            "deliveryContext": {"isRedelivery": True},
+            "replyToken": "token",
+            "source": {"type": "user", "userId": "U1"},
+            "message": {"id": "m1", "type": "text", "text": "hello"},
+        },
+        {"type": "follow", "source": {"type": "user", "userId": "U2"}},
+    ]}).encode()
+    message, follow = WebhookVerifier("secret").parse(body)
+    assert (message.type, message.webhook_event_id, message.is_redelivery, message.reply_token) == ("message", "evt-1", True, "token")
+    assert (message.source.user_id, message.message.id, message.message.type, message.message.text) == ("U1", "m1", "text", "hello")
+    assert (follow.type, follow.is_redelivery, follow.message, follow.source.user_id) == ("follow", False, None, "U2")
+
+
+def test_parse_rejects_non_object_body():
+    with pytest.raises(ValueError):
+        WebhookVerifier("secret").parse(b"[]")
+
+
+@pytest.mark.parametrize("payload", [
+    {"events": [1]},
+    {"events": {"type": "message"}},
+    {"events": [{"type": "message", "source": None}]},
+    {"events": [{"type": "message", "source": "U1"}]},
+    {"events": [{"type": "message", "message": ["text"]}]},
+    {"events": [{"type": "message", "deliveryContext": 1}]},
+])
+def test_parse_rejects_wrong_shape_with_value_error(payload):
+    with pytest.raises(ValueError):
+        WebhookVerifier("secret").parse(json.dumps(payload).encode())
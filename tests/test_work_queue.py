@@ -0,0 +1,82 @@
+import threading
+
+from work_queue import EventWorkQueue, KeyedExecutor
+
+
+def test_same_key_events_count_against_maxsize():
+    release = threading.Event()
+    started = threading.Event()
+
+    def handle(item):
+        started.set()
+        release.wait(5)
+
+    q = EventWorkQueue(handle, maxsize=2, workers=4, key_func=lambda item: "same-user")
+    q.start()
+    try:
+        assert q.submit(0, timeout=0)
+        assert started.wait(5)
+        # 0 を処理中。後続は同じキーなので後回しになるが、maxsize に数える
+        results = [q.submit(i, timeout=0) for i in range(1, 50)]
+        assert results[:2] == [True, True]
+        assert not any(results[2:])
+        assert q.depth() == 2
+        assert q.stats()["rejected"] == 47
+    finally:
+        release.set()
+        q.stop(drain=True, timeout=5)
+    assert q.depth() == 0
+    assert q.stats()["processed"] == 3
+
+
+def test_submit_waits_for_room():
+    release = threading.Event()
+    q = EventWorkQueue(lambda item: release.wait(5), maxsize=1, workers=1, key_func=lambda item: "k")
+    q.start()
+    try:
+        assert q.submit(0)
+        assert q.submit(1, timeout=1)
+        assert not q.submit(2, timeout=0.05)
+        threading.Timer(0.1, release.set).start()
+        assert q.submit(3, timeout=5)
+    finally:
+        release.set()
+        q.stop(drain=True, timeout=5)
+    assert q.stats()["processed"] == 3
+
+
+def test_keyed_executor_shutdown_is_bounded():
+    release = threading.Event()
+    executor = KeyedExecutor(max_workers=1)
+    executor.submit("k", release.wait, 5)
+    executor.submit("k", lambda: None)
+    # 実行中・実行待ちのタスクが残っていれば timeout で戻る
+    assert not executor.shutdown(wait=True, timeout=0.1)
+    release.set()
+    assert executor.shutdown(wait=True, timeout=5)
+
+
+def test_same_key_events_are_processed_in_order_and_failures_counted():
+    seen = []
+    lock = threading.Lock()
+
+    def handle(item):
+        key, n = item
+        with lock:
+            seen.append(item)
+        if n == 3:
+            raise RuntimeError("handler failed")
+
+    q = EventWorkQueue(handle, maxsize=100, workers=4, key_func=lambda item: item[0])
+    q.start()
+    try:
+        for n in range(10):
+            for key in ("u1", "u2"):
+                assert q.submit((key, n))
+    finally:
+        q.stop(drain=True, timeout=5)
+    # 失敗したイベントがあっても、同じキーの後続は投入順に処理される
+    for key in ("u1", "u2"):
+        assert [n for k, n in seen if k == key] == list(range(10))
+    assert q.stats()["failed"] == 2
+    assert q.stats()["processed"] == 18
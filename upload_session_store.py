@@ -0,0 +1,90 @@
+import os
+import time
+import logging
+import datetime
+import threading
+
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+
+from database import DriveUploadSession
+
+logger = logging.getLogger(__name__)
+
+# 保存したセッションを使う期限 (秒)。Drive の resumable upload のセッションは約 1 週間で失効する
+DRIVE_UPLOAD_SESSION_TTL = float(os.environ.get('DRIVE_UPLOAD_SESSION_TTL', 6 * 24 * 3600))
+# 期限切れの行を削除する間隔 (秒)
+_PURGE_INTERVAL = 3600
+
+
+class UploadSessionStore:
+    """Drive の resumable upload のセッションを DB (drive_upload_sessions) に保存し、再試行時に続きから送れるようにする。
+
+    保存や削除に失敗してもアップロード自体は続けられるので、警告だけ出す。
+    """
+
+    def __init__(self, engine, ttl=DRIVE_UPLOAD_SESSION_TTL):
+        self._engine = engine
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._next_purge = 0.0
+
+    def load(self, source_key: str) -> dict | None:
+        """保存されているセッション (session_uri, committed_bytes, total_size) を返す。なければ None。"""
+        table = DriveUploadSession.__table__
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=self._ttl)
+        try:
+            with self._engine.connect() as conn:
+                row = conn.execute(
+                    table.select().where(table.c.source_key == source_key, table.c.created_at >= cutoff)
+                ).first()
+        except SQLAlchemyError as e:
+            logger.warning('Could not load upload session for %s: %s', source_key, e)
+            return None
+        if row is None:
+            return None
+        return {'session_uri': row.session_uri, 'committed_bytes': row.committed_bytes, 'total_size': row.total_size}
+
+    def save(self, source_key: str, session_uri: str, committed_bytes: int, file_name: str, mime_type: str,
+             total_size: int | None = None):
+        """送信済みのバイト数を記録する (チャンクを送るたびに呼ぶ)。"""
+        self._purge_expired()
+        table = DriveUploadSession.__table__
+        now = datetime.datetime.utcnow()
+        values = {
+            'session_uri': session_uri, 'committed_bytes': committed_bytes, 'total_size': total_size,
+            'file_name': file_name, 'mime_type': mime_type, 'updated_at': now,
+        }
+        try:
+            with self._engine.begin() as conn:
+                updated = conn.execute(table.update().where(table.c.source_key == source_key).values(**values)).rowcount
+                if not updated:
+                    conn.execute(table.insert(), {'source_key': source_key, 'created_at': now, **values})
+        except IntegrityError:
+            # 同じメッセージを別のワーカーが同時に送り始めた場合。先に記録した方を残す
+            pass
+        except SQLAlchemyError as e:
+            logger.warning('Could not save upload session for %s: %s', source_key, e)
+
+    def delete(self, source_key: str):
+        table = DriveUploadSession.__table__
+        try:
+            with self._engine.begin() as conn:
+                conn.execute(table.delete().where(table.c.source_key == source_key))
+        except SQLAlchemyError as e:
+            logger.warning('Could not delete upload session for %s: %s', source_key, e)
+
+    def _purge_expired(self):
+        now = time.monotonic()
+        with self._lock:
+            if now < self._next_purge:
+                return
+            self._next_purge = now + _PURGE_INTERVAL
+        table = DriveUploadSession.__table__
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=self._ttl)
+        try:
+            with self._engine.begin() as conn:
+                purged = conn.execute(table.delete().where(table.c.created_at < cutoff)).rowcount
+            if purged:
+                logger.info('Purged %d expired upload sessions.', purged)
+        except SQLAlchemyError as e:
+            logger.warning('Could not purge expired upload sessions: %s', e)
@@ -0,0 +1,128 @@
+import logging
+import select
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+# 他のワーカープロセスへ user_id の変更を知らせる PostgreSQL の NOTIFY チャンネル名
+INVALIDATION_CHANNEL = "user_doc_mapping_changed"
+
+
+class UserDocCache:
+    """user_id -> doc_id の対応を保持する、件数上限 (LRU) と有効期限 (TTL) つきのキャッシュ。"""
+
+    def __init__(self, maxsize=10000, ttl=300.0):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # user_id -> (doc_id, expires_at)
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, user_id: str) -> str | None:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[1] > now:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                del self._entries[user_id]
+            self.misses += 1
+            return None
+
+    def peek(self, user_id: str) -> str | None:
+        # get と同じだが、ヒット・ミスの件数と LRU の順番は変えない (先読みの判定用)
+        with self._lock:
+            entry = self._entries.get(user_id)
+            return entry[0] if entry is not None and entry[1] > time.monotonic() else None
+
+    def set(self, user_id: str, doc_id: str):
+        if self._maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[user_id] = (doc_id, time.monotonic() + self._ttl)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self._maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id: str):
+        with self._lock:
+            if self._entries.pop(user_id, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "maxsize": self._maxsize,
+                "ttl": self._ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+            }
+
+
+def publish_invalidation(db, user_id: str):
+    # NOTIFY はトランザクションのコミット時に配信されるので、マッピング更新と同じセッションで呼ぶ
+    db.execute(text("SELECT pg_notify(:channel, :user_id)"), {"channel": INVALIDATION_CHANNEL, "user_id": user_id})
+
+
+class PgInvalidationListener:
+    """PostgreSQL の LISTEN/NOTIFY で他プロセスの !setdoc を受け取り、ローカルのキャッシュを無効化する。"""
+
+    def __init__(self, engine, cache: UserDocCache, poll_interval=5.0):
+        self._engine = engine
+        self._cache = cache
+        self._poll_interval = poll_interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="user-doc-cache-listener", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=self._poll_interval + 1)
+
+    def _run(self):
+        while not self._stop.is_set():
+            raw = None
+            try:
+                raw = self._engine.raw_connection()
+                conn = raw.driver_connection
+                conn.autocommit = True
+                with conn.cursor() as cur:
+                    cur.execute(f"LISTEN {INVALIDATION_CHANNEL}")
+                # 接続していなかった間の通知は受け取れていないので、(再)接続時にキャッシュを空にする
+                self._cache.clear()
+                logger.info("Listening for user->doc mapping invalidations on channel %s.", INVALIDATION_CHANNEL)
+                while not self._stop.is_set():
+                    if select.select([conn], [], [], self._poll_interval) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        self._cache.invalidate(notify.payload)
+            except Exception as e:
+                logger.warning("User->doc cache invalidation listener error: %s. Reconnecting.", e)
+                self._stop.wait(self._poll_interval)
+            finally:
+                if raw is not None:
+                    try:
+                        # LISTEN 済み・autocommit の接続をプールに戻さないよう破棄する
+                        raw.invalidate()
+                    except Exception:
+                        pass
@@ -0,0 +1,118 @@
+import os
+import hmac
+import base64
+import hashlib
+
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    import json
+    _json_loads = json.loads
+
+# 受け付ける Webhook のボディの最大バイト数。これを超えるリクエストは読み切る前に 413 を返す
+WEBHOOK_MAX_BODY_BYTES = int(os.environ.get('WEBHOOK_MAX_BODY_BYTES', 1024 * 1024))
+
+
+class BodyTooLargeError(Exception):
+    pass
+
+
+class EventSource:
+    __slots__ = ('type', 'user_id')
+
+    def __init__(self, type=None, user_id=None):
+        self.type = type
+        self.user_id = user_id
+
+
+class EventMessage:
+    __slots__ = ('id', 'type', 'text')
+
+    def __init__(self, id=None, type=None, text=None):
+        self.id = id
+        self.type = type
+        self.text = text
+
+
+def _optional_object(data: dict, key: str) -> dict | None:
+    # キーがなければ None。あるのに dict でない (null を含む) 場合は ValueError
+    if key not in data:
+        return None
+    value = data[key]
+    if not isinstance(value, dict):
+        raise ValueError(f"Webhook event field '{key}' is not a JSON object: {type(value).__name__}")
+    return value
+
+
+class WebhookEvent:
+    """ハンドラが使うフィールドだけを持つ Webhook イベント (SDK の pydantic モデルの代わり)。
+
+    属性名は SDK のモデル (event.source.user_id, event.message.id など) に合わせている。
+    """
+
+    __slots__ = ('type', 'webhook_event_id', 'is_redelivery', 'reply_token', 'source', 'message')
+
+    def __init__(self, type, webhook_event_id=None, is_redelivery=False, reply_token=None, source=None, message=None):
+        self.type = type
+        self.webhook_event_id = webhook_event_id
+        self.is_redelivery = is_redelivery
+        self.reply_token = reply_token
+        self.source = source
+        self.message = message
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'WebhookEvent':
+        """形の合わない JSON (イベントやその中のオブジェクトが dict でないなど) は ValueError を送出する。"""
+        if not isinstance(data, dict):
+            raise ValueError(f"Webhook event is not a JSON object: {type(data).__name__}")
+        source = _optional_object(data, 'source')
+        message = _optional_object(data, 'message')
+        return cls(
+            data.get('type'),
+            webhook_event_id=data.get('webhookEventId'),
+            is_redelivery=bool((_optional_object(data, 'deliveryContext') or {}).get('isRedelivery')),
+            reply_token=data.get('replyToken'),
+            source=EventSource(source.get('type'), source.get('userId')) if source else None,
+            message=EventMessage(message.get('id'), message.get('type'), message.get('text')) if message else None,
+        )
+
+    def __repr__(self):
+        return f"<WebhookEvent(type='{self.type}', webhook_event_id='{self.webhook_event_id}')>"
+
+
+class WebhookVerifier:
+    """X-Line-Signature の検証と、イベントの読み込みを行う。"""
+
+    def __init__(self, channel_secret: str):
+        self._secret = channel_secret.encode('utf-8')
+
+    def verify(self, body: bytes, signature: str) -> bool:
+        # 受け取ったバイト列のまま HMAC-SHA256 を計算し、一定時間で比較する
+        expected = base64.b64encode(hmac.digest(self._secret, body, hashlib.sha256))
+        return hmac.compare_digest(expected, signature.encode('utf-8'))
+
+    def parse(self, body: bytes) -> list:
+        """ボディの JSON を 1 回だけ読み込み、イベントのリストを返す (署名は verify で確認しておく)。"""
+        payload = _json_loads(body)
+        if not isinstance(payload, dict):
+            raise ValueError("Webhook body is not a JSON object.")
+        events = payload.get('events', ())
+        if not isinstance(events, (list, tuple)):
+            raise ValueError("Webhook 'events' is not a JSON array.")
+        return [WebhookEvent.from_dict(event) for event in events]
+
+
+async def read_body(request, max_bytes: int = WEBHOOK_MAX_BODY_BYTES) -> bytes:
+    """リクエストのボディを読む。max_bytes を超える場合は BodyTooLargeError を送出する。"""
+    content_length = request.headers.get('content-length')
+    if content_length and content_length.isdigit() and int(content_length) > max_bytes:
+        raise BodyTooLargeError(f"Request body is {content_length} bytes (limit: {max_bytes}).")
+    chunks = []
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > max_bytes:
+            raise BodyTooLargeError(f"Request body exceeds {max_bytes} bytes.")
+        chunks.append(chunk)
+    return b''.join(chunks)
@@ -0,0 +1,231 @@
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# ワーカースレッドに停止を伝えるための番兵
+_STOP = object()
+
+
+class EventWorkQueue:
+    """Webhook イベントを有界キューに積み、ワーカースレッドのプールで処理する。
+
+    キューが満杯の場合 submit() は False を返すので、呼び出し側で
+    503 を返すなどしてバックプレッシャーをかける。
+    key_func を渡すと、同じキーのイベントは投入順に 1 つずつ処理する (異なるキーは並行に処理する)。
+    同じキーの処理待ちで後回しにしたイベントも、処理を始めるまでは maxsize に数える。
+    """
+
+    def __init__(self, worker_func, maxsize=1000, workers=4, name="webhook-worker", key_func=None):
+        self._worker_func = worker_func
+        self._key_func = key_func
+        # 処理中のキー -> 後から届いた同じキーのイベント
+        self._pending = {}
+        # 上限は _backlog で管理するので、キュー自体には上限を設けない
+        self._queue = queue.Queue()
+        self._maxsize = maxsize
+        self._workers = max(1, workers)
+        self._name = name
+        self._threads = []
+        self._lock = threading.Lock()
+        self._not_full = threading.Condition(self._lock)
+        # 受け付けてまだ処理を始めていないイベントの数 (キューにあるもの + 同じキーの処理待ちで後回しにしたもの)
+        self._backlog = 0
+        self._in_flight = 0
+        self._processed = 0
+        self._failed = 0
+        self._rejected = 0
+
+    def start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self._workers):
+                t = threading.Thread(target=self._run, name=f"{self._name}-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+        logger.info("Started %d %s threads (queue maxsize=%d).", self._workers, self._name, self._maxsize)
+
+    def submit(self, item, timeout=None) -> bool:
+        # timeout=0 なら待たずに判定、None なら空きが出るまで待つ
+        with self._not_full:
+            has_room = lambda: self._backlog < self._maxsize
+            if not (has_room() if timeout == 0 else self._not_full.wait_for(has_room, timeout)):
+                self._rejected += 1
+                return False
+            self._backlog += 1
+        self._queue.put(item)
+        return True
+
+    def depth(self) -> int:
+        # 後回しにしたイベントも含めた処理待ちの数
+        with self._lock:
+            return self._backlog
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "depth": self._backlog,
+                "maxsize": self._maxsize,
+                "workers": self._workers,
+                "in_flight": self._in_flight,
+                "processed": self._processed,
+                "failed": self._failed,
+                "rejected": self._rejected,
+                "deferred": sum(len(items) for items in self._pending.values()),
+            }
+
+    def stop(self, drain=True, timeout=None):
+        # drain=True の場合、キューに残っているイベントを処理し終えるまで待つ
+        deadline = None if timeout is None else time.monotonic() + timeout
+        if drain:
+            while self._queue.unfinished_tasks:
+                if deadline is not None and time.monotonic() >= deadline:
+                    logger.warning("Timed out draining %s queue; %d events left.", self._name, self.depth())
+                    break
+                time.sleep(0.05)
+        else:
+            dropped = 0
+            while True:
+                try:
+                    self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                self._queue.task_done()
+                self._release_slot()
+                dropped += 1
+            if dropped:
+                logger.warning("Dropped %d queued events from %s queue on shutdown.", dropped, self._name)
+
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for _ in threads:
+            self._queue.put(_STOP)
+        for t in threads:
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            t.join(timeout=remaining)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                self._queue.task_done()
+                return
+            key = self._key_func(item) if self._key_func else None
+            if key is None:
+                self._process(item)
+                continue
+            with self._lock:
+                pending = self._pending.get(key)
+                if pending is not None:
+                    # 同じキーを処理中のワーカーに任せる (task_done はそのワーカーが処理後に呼ぶ)
+                    pending.append(item)
+                    continue
+                self._pending[key] = deque()
+            while True:
+                self._process(item)
+                with self._lock:
+                    pending = self._pending[key]
+                    if not pending:
+                        del self._pending[key]
+                        break
+                    item = pending.popleft()
+
+    def _release_slot(self):
+        with self._not_full:
+            self._backlog -= 1
+            self._not_full.notify()
+
+    def _process(self, item):
+        self._release_slot()
+        with self._lock:
+            self._in_flight += 1
+        try:
+            self._worker_func(item)
+            with self._lock:
+                self._processed += 1
+        except Exception:
+            logger.exception("Unhandled error while processing queued event in %s.", self._name)
+            with self._lock:
+                self._failed += 1
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+            self._queue.task_done()
+
+
+class KeyedExecutor:
+    """同じキーのタスクは投入順に 1 つずつ、異なるキーのタスクはスレッドプールで並行に実行する。
+
+    key が None のタスクは順序を気にせずそのまま実行する。submit() は concurrent.futures.Future を返す。
+    """
+
+    def __init__(self, max_workers=8, name="event-dispatch"):
+        self._executor = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix=name)
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._chains = {}  # 実行中のキー -> 後から投入された (func, args, future)
+        self._unfinished = 0  # 投入されてまだ終わっていないタスクの数
+
+    def submit(self, key, func, *args) -> Future:
+        with self._lock:
+            self._unfinished += 1
+        if key is None:
+            try:
+                future = self._executor.submit(func, *args)
+            except RuntimeError:
+                # シャットダウン後の投入
+                self._task_done(None)
+                raise
+        else:
+            future = Future()
+            with self._lock:
+                chain = self._chains.get(key)
+                if chain is None:
+                    self._chains[key] = deque()
+                else:
+                    chain.append((func, args, future))
+            if chain is None:
+                try:
+                    self._executor.submit(self._run_chain, key, func, args, future)
+                except RuntimeError:
+                    with self._lock:
+                        self._chains.pop(key, None)
+                    self._task_done(None)
+                    raise
+        future.add_done_callback(self._task_done)
+        return future
+
+    def _task_done(self, future):
+        with self._idle:
+            self._unfinished -= 1
+            if not self._unfinished:
+                self._idle.notify_all()
+
+    def _run_chain(self, key, func, args, future):
+        # 同じキーのタスクがなくなるまで、このスレッドで順に実行する
+        while True:
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(func(*args))
+                except BaseException as e:
+                    future.set_exception(e)
+            with self._lock:
+                chain = self._chains[key]
+                if not chain:
+                    del self._chains[key]
+                    return
+                func, args, future = chain.popleft()
+
+    def shutdown(self, wait=True, timeout=None) -> bool:
+        """新しいタスクの受け付けを止める。wait=True なら実行中・実行待ちのタスクが終わるまで最大 timeout 秒待ち、
+        すべて終わったかを返す。"""
+        self._executor.shutdown(wait=False)
+        if not wait:
+            return True
+        with self._idle:
+            return self._idle.wait_for(lambda: not self._unfinished, timeout)